@@ -4,52 +4,357 @@
 # [DICOM settings]
 # AET: MY_SCP
 # PORT: 104
-# 
+#
 # [STORAGE LOCATION]
 # Folder: dicom_storage
 #
+# Batch mode queries every ID in a text or CSV file over a few associations
+# that are reused for all the queries and writes the matches to CSV or JSON
+# Lines as they arrive:
+#   python "DICOM Query SCU WORKING.py" --ids ids.txt --output matches.csv
+#   python "DICOM Query SCU WORKING.py" --ids ids.csv --concurrency 8 \
+#       --template '{"QueryRetrieveLevel": "STUDY", "PatientID": "{PatientID}",
+#                    "StudyDate": "", "StudyInstanceUID": ""}' --output studies.jsonl
+# A text file has one Patient ID per line, a CSV file needs a header row. The
+# template is a JSON identifier (or a file holding one) whose values can use
+# {column} from the CSV file, {id} is the first column. Empty values are
+# returned by the PACS. Without a template the patient level is queried for
+# PatientID with the name, birth date and sex returned.
+# Every ID gets at least one output row, Status is 'match', 'no match' or
+# the failure. The exit code is 1 if any query failed. The queries go
+# through dicom_query.py, which other scripts can import to query and
+# retrieve over pooled associations.
+#
+# [CACHE]
+# TTL: 300
+# MaxEntries: 10000
+# Database: query_cache.sqlite
+#
+# --depth study, series or image prints the studies, series and images of
+# the PatientID in the ini file as a tree, querying the levels one at a time
+# and the siblings at each level concurrently:
+#   python "DICOM Query SCU WORKING.py" --depth series --model study
+#
+# The [CACHE] section is optional. Results of queries are kept for TTL
+# seconds, up to MaxEntries in memory and all of them in Database if given,
+# so the same query isn't sent to the PACS again. --no-cache always asks the
+# PACS and updates the cache with its answer.
+#
 # Alban Killingback July 2024
 ################################################################################
 
+import os
+import re
+import csv
+import sys
+import json
+import queue
+import string
+import argparse
+import threading
 import configparser
 from pydicom.dataset import Dataset
-from pynetdicom import AE, debug_logger
-from pynetdicom.sop_class import PatientRootQueryRetrieveInformationModelFind
+from pydicom.multival import MultiValue
+from pynetdicom import debug_logger
+from dicom_query import AssociationPool, RemoteAE, QueryCache, QueryTree, AssociationError, QueryError
 
 #debug_logger()
 
-# load the COM port number from the config file
-config = configparser.ConfigParser()
-config.read(r'DICOM Query SCU WORKING.ini')
-my_ae_title = config['MY AET']['AET']
-patient_id = config['SEARCH']['PATIENTID']
-PACSAET = config['PACS DICOM settings']['AET']
-PACSPORT = int(config['PACS DICOM settings']['PORT'])
-PACSIP = config['PACS DICOM settings']['IPADDRESS']
-
-# Create our Application Entity (AE)
-ae = AE(ae_title=my_ae_title)
-ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
-
-# Create our Identifier (query) dataset
-ds = Dataset()
-ds.PatientID = patient_id  # Replace with the actual PatientID you want to search for
-ds.QueryRetrieveLevel = 'PATIENT'
-
-# Associate with the peer AE at IP 10.165.131.130 and port 1133, with AE title 'MEDCON_SERVER'
-assoc = ae.associate(PACSIP, PACSPORT, ae_title=PACSAET)
-if assoc.is_established:
-    # Send the C-FIND request
-    responses = assoc.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind)
-    for (status, identifier) in responses:
-        if status:
-            print('C-FIND query status: 0x{0:04X}'.format(status.Status))
-            if identifier:
-                print(identifier)
+# Settings, read from the config file by load_config()
+my_ae_title = patient_id = PACSAET = PACSPORT = PACSIP = None
+cache_enabled = False
+cache_ttl = 300
+cache_max_entries = 10000
+cache_database = None
+
+
+def load_config():
+    """Load the settings from the config file."""
+    global my_ae_title, patient_id, PACSAET, PACSPORT, PACSIP
+    global cache_enabled, cache_ttl, cache_max_entries, cache_database
+    config = configparser.ConfigParser()
+    config.read(r'DICOM Query SCU WORKING.ini')
+    my_ae_title = config['MY AET']['AET']
+    patient_id = config['SEARCH']['PATIENTID']
+    PACSAET = config['PACS DICOM settings']['AET']
+    PACSPORT = int(config['PACS DICOM settings']['PORT'])
+    PACSIP = config['PACS DICOM settings']['IPADDRESS']
+    cache_enabled = config.has_section('CACHE')
+    cache_ttl = config.getfloat('CACHE', 'TTL', fallback=300)
+    cache_max_entries = config.getint('CACHE', 'MaxEntries', fallback=10000)
+    cache_database = config.get('CACHE', 'Database', fallback=None)
+
+
+# Query used in batch mode when no template is given
+DEFAULT_TEMPLATE = {
+    'QueryRetrieveLevel': 'PATIENT',
+    'PatientID': '{id}',
+    'PatientName': '',
+    'PatientBirthDate': '',
+    'PatientSex': '',
+}
+
+_DONE = object()
+
+
+def open_cache():
+    """Return the QueryCache set up in the ini file or None."""
+    if not cache_enabled:
+        return None
+    return QueryCache(ttl=cache_ttl, max_entries=cache_max_entries, database=cache_database)
+
+
+def single_query(use_cache=True):
+    """Query the PatientID from the ini file and print the results."""
+    pool = AssociationPool(my_ae_title, max_size=1)
+    cache = open_cache()
+    pacs = RemoteAE(PACSAET, PACSIP, PACSPORT, pool, cache)
+
+    # Create our Identifier (query) dataset
+    ds = Dataset()
+    ds.PatientID = patient_id  # Replace with the actual PatientID you want to search for
+    ds.QueryRetrieveLevel = 'PATIENT'
+
+    try:
+        for identifier in pacs.find(ds, model='patient', use_cache=use_cache):
+            print(identifier)
+        print('C-FIND query complete' + (' (cached)' if cache and cache.hits else ''))
+    except QueryError as e:
+        print('C-FIND query status: 0x{0:04X}'.format(e.status.Status))
+    except AssociationError as e:
+        print(e)
+    finally:
+        pool.close()
+        if cache:
+            cache.close()
+
+
+def print_tree(tree, nodes, depth, indent=0):
+    """Print nodes and their children down to the depth level."""
+    expanded = {}
+    if nodes and nodes[0].level != depth:
+        expanded = tree.expand(nodes)
+    for node in nodes:
+        values = ', '.join(
+            f'{keyword}: {text(node.identifier.get(keyword))}'
+            for keyword in tree.return_keys[node.level] if node.identifier.get(keyword)
+        )
+        print(f"{'    ' * indent}{node.level} {node.key}  {values}")
+        if node in expanded:
+            print_tree(tree, expanded[node], depth, indent + 1)
+
+
+def tree_query(args):
+    """Print the tree of the PatientID in the ini file down to args.depth."""
+    pool = AssociationPool(my_ae_title, max_size=args.concurrency)
+    cache = open_cache()
+    pacs = RemoteAE(PACSAET, PACSIP, PACSPORT, pool, cache)
+    tree = QueryTree(pacs, model=args.model, max_workers=args.concurrency, use_cache=not args.no_cache)
+    depth = args.depth.upper()
+    if depth not in tree.levels:
+        print(f'--depth must be one of {", ".join(tree.levels).lower()} with the {args.model} model')
+        return
+
+    try:
+        print_tree(tree, tree.roots(PatientID=patient_id), depth)
+    except QueryError as e:
+        print('C-FIND query status: 0x{0:04X}'.format(e.status.Status))
+    except AssociationError as e:
+        print(e)
+    finally:
+        pool.close()
+        if cache:
+            cache.close()
+
+
+def read_rows(filename):
+    """Yield a dict for every row of a CSV file or line of a text file.
+
+    'id' is always set to the first column.
+    """
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        first = f.readline()
+        f.seek(0)
+        if filename.lower().endswith('.csv') or ',' in first:
+            for row in csv.DictReader(f):
+                values = list(row.values())
+                if values and values[0]:
+                    yield {'id': values[0].strip(), **row}
         else:
-            print('Connection timed out, was aborted or received invalid response')
+            for line in f:
+                if line.strip():
+                    yield {'id': line.strip()}
+
+
+def load_template(value):
+    """Return the identifier template from a JSON string or file."""
+    if value is None:
+        return dict(DEFAULT_TEMPLATE)
+    if os.path.exists(value):
+        with open(value) as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+def build_identifier(template, row):
+    """Return the C-FIND identifier for template filled in from row."""
+    ds = Dataset()
+    for keyword, value in template.items():
+        setattr(ds, keyword, str(value).format_map(row) if value else '')
+    return ds
+
+
+def template_fields(template):
+    """Return the {column} names used by the values of template."""
+    fields = set()
+    for value in template.values():
+        if not value:
+            continue
+        for _, field, _, _ in string.Formatter().parse(str(value)):
+            if field:
+                fields.add(re.split(r'[.\[]', field, 1)[0])
+    return fields
+
+
+def text(value):
+    """Return an element value as text for the output file."""
+    if value is None:
+        return ''
+    if isinstance(value, MultiValue):
+        return '\\'.join(str(item) for item in value)
+    return str(value)
+
+
+class ResultWriter:
+    """Writes result rows to a CSV or JSON Lines file as they arrive."""
+
+    def __init__(self, filename, columns):
+        self.columns = columns
+        self.file = open(filename, 'w', newline='', encoding='utf-8') if filename else sys.stdout
+        self.csv = None
+        if filename and filename.lower().endswith('.csv'):
+            self.csv = csv.DictWriter(self.file, fieldnames=columns, extrasaction='ignore')
+            self.csv.writeheader()
+        self._lock = threading.Lock()
+
+    def write(self, row):
+        with self._lock:
+            if self.csv:
+                self.csv.writerow(row)
+            else:
+                self.file.write(json.dumps({column: row.get(column, '') for column in self.columns}) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+def query_worker(jobs, writer, template, pacs, model, use_cache, counts):
+    """Answer queries from jobs over associations borrowed from the pool.
+
+    counts is this worker's own tally of queries done and failed.
+    """
+    while True:
+        row = jobs.get()
+        if row is _DONE:
+            return
+
+        matches = 0
+        status_text = 'no match'
+        try:
+            for identifier in pacs.find(build_identifier(template, row), model=model, use_cache=use_cache):
+                matches += 1
+                result = {keyword: text(identifier.get(keyword)) for keyword in template}
+                writer.write({**row, **result, 'Status': 'match'})
+        except QueryError as e:
+            status_text = f'failed 0x{e.status.Status:04X}'
+        except AssociationError as e:
+            status_text = str(e)
+        except Exception as e:
+            # Anything else only fails this row, the worker carries on
+            status_text = f'failed {type(e).__name__}: {e}'
+
+        if not matches or status_text != 'no match':
+            writer.write({**row, 'Status': status_text})
+        counts['done' if status_text == 'no match' else 'failed'] += 1
+
+
+def batch_query(args):
+    """Query every row of args.ids over args.concurrency associations."""
+    template = load_template(args.template)
+
+    rows = read_rows(args.ids)
+    first = next(rows, None)
+    if first is None:
+        print(f'No IDs in {args.ids}')
+        return
+
+    missing = template_fields(template) - set(first)
+    if missing:
+        sys.exit(f"The template uses {', '.join(sorted(missing))}, which {args.ids} doesn't have")
+
+    input_columns = [column for column in first if column not in template]
+    writer = ResultWriter(args.output, input_columns + list(template) + ['Status'])
+
+    # Keep only a few rows queued ahead of the workers so very long lists
+    # aren't read into memory
+    jobs = queue.Queue(maxsize=args.concurrency * 4)
+    # The workers share the pool's associations, one per worker at most
+    pool = AssociationPool(my_ae_title, max_size=args.concurrency)
+    cache = open_cache()
+    pacs = RemoteAE(PACSAET, PACSIP, PACSPORT, pool, cache)
+    use_cache = not args.no_cache
+    counts = [{'done': 0, 'failed': 0} for _ in range(args.concurrency)]
+    workers = [
+        threading.Thread(target=query_worker, args=(jobs, writer, template, pacs, args.model, use_cache, worker_counts))
+        for worker_counts in counts
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        jobs.put(first)
+        for row in rows:
+            jobs.put(row)
+    finally:
+        for _ in workers:
+            jobs.put(_DONE)
+        for worker in workers:
+            worker.join()
+        writer.close()
+        pool.close()
+        if cache:
+            cache.close()
+
+    done = sum(worker_counts['done'] for worker_counts in counts)
+    failed = sum(worker_counts['failed'] for worker_counts in counts)
+    print(f'Queried {done + failed} IDs, {failed} failed', file=sys.stderr)
+    if cache:
+        print(f'{cache.hits} answered from the cache', file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a PACS with C-FIND.")
+    parser.add_argument("--ids", help="Text or CSV file of IDs to query in batch mode")
+    parser.add_argument("--template", help="JSON identifier, or a file holding one, filled in from each row")
+    parser.add_argument("--model", choices=["patient", "study"], default="patient", help="Query/Retrieve information model")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of associations to query over")
+    parser.add_argument("--output", help="CSV or JSON Lines (.jsonl) file for the results, JSON Lines on stdout by default")
+    parser.add_argument("--no-cache", action="store_true", help="Ask the PACS even if the answer is cached")
+    parser.add_argument("--depth", choices=["patient", "study", "series", "image"], help="Print the PatientID's tree down to this level")
+    args = parser.parse_args()
+    load_config()
+
+    if args.ids:
+        batch_query(args)
+    elif args.depth:
+        tree_query(args)
+    else:
+        single_query(use_cache=not args.no_cache)
+
 
-    # Release the association
-    assoc.release()
-else:
-    print('Association rejected, aborted or never connected')
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+###############################################################################
+# Retrieves studies or series from a PACS with C-GET or C-MOVE
+#
+# [MY AET]
+# AET: MY_SCU
+# PORT: 11113
+#
+# [PACS DICOM settings]
+# AET: PACS
+# PORT: 104
+# IPADDRESS: 192.168.0.5
+#
+# [STORAGE LOCATION]
+# Folder: retrieved
+# Layout: patient
+#
+# PORT in [MY AET] is only needed for C-MOVE, a Storage SCP is started on it
+# for the PACS to send to, so the PACS must know this AE title. Layout is one
+# of the Store SCP layouts (flat, patient, hash or date).
+#
+# The studies come from --study or an --input file, which can be a text file
+# of Study Instance UIDs (optionally followed by a Series Instance UID) or the
+# CSV or JSON Lines output of "DICOM Query SCU WORKING.py" with
+# StudyInstanceUID and SeriesInstanceUID columns:
+#   python "DICOM Retrieve SCU.py" --input studies.csv --concurrency 4
+#   python "DICOM Retrieve SCU.py" --study 1.2.3.4 --method move
+# Every series is retrieved over its own request, up to --concurrency at a
+# time. Before a series is retrieved its instances are listed with a C-FIND
+# and the ones already in Folder are skipped, so an interrupted retrieve can
+# simply be run again. Received instances are written to disk as they come
+# off the network and renamed into place without being decoded. The exit
+# code is 1 if any series failed.
+################################################################################
+
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import functools
+import tempfile
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.dataset import Dataset
+from pynetdicom import AE, evt, _config, StoragePresentationContexts
+from dicom_query import AssociationPool, RemoteAE, QueryTree, AssociationError, QueryError
+from dicom_storage import make_layout, read_header, move_into_place
+
+# Settings, read from the config file by load_config()
+my_ae_title = my_port = PACSAET = PACSPORT = PACSIP = None
+storage_location = 'retrieved'
+layout_name = 'patient'
+
+
+def load_config():
+    """Load the settings from the config file."""
+    global my_ae_title, my_port, PACSAET, PACSPORT, PACSIP, storage_location, layout_name
+    config = configparser.ConfigParser()
+    config.read(r'DICOM Retrieve SCU.ini')
+    my_ae_title = config['MY AET']['AET']
+    my_port = config.getint('MY AET', 'PORT', fallback=None)
+    PACSAET = config['PACS DICOM settings']['AET']
+    PACSPORT = int(config['PACS DICOM settings']['PORT'])
+    PACSIP = config['PACS DICOM settings']['IPADDRESS']
+    storage_location = config.get('STORAGE LOCATION', 'Folder', fallback='retrieved')
+    layout_name = config.get('STORAGE LOCATION', 'Layout', fallback='patient')
+
+
+# Largest number of SOP Instance UIDs sent in one IMAGE level request
+MAX_UIDS_PER_REQUEST = 500
+
+# Only ask for what is needed to place the files on disk
+RETURN_KEYS = {
+    'STUDY': ['PatientID', 'StudyDate'],
+    'SERIES': ['Modality', 'SeriesNumber'],
+    'IMAGE': [],
+}
+
+
+class Progress:
+    """Counts what has been retrieved and prints a line now and then."""
+
+    def __init__(self, series_total):
+        self.series_total = series_total
+        self.series_done = 0
+        self.series_skipped = 0
+        self.series_failed = 0
+        self.instances = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.remaining = {}
+        self.started = time.monotonic()
+        self._last_print = 0.0
+        self._lock = threading.Lock()
+
+    def stored(self, nbytes):
+        with self._lock:
+            self.instances += 1
+            self.bytes += nbytes
+        self.maybe_print()
+
+    def pending(self, series_uid, status):
+        """Note the sub-operations left from a pending C-GET or C-MOVE status."""
+        with self._lock:
+            self.remaining[series_uid] = status.get('NumberOfRemainingSuboperations', 0) or 0
+        self.maybe_print()
+
+    def store_failed(self):
+        with self._lock:
+            self.failed += 1
+
+    def series_finished(self, series_uid, skipped=0, failed=0, result='done'):
+        with self._lock:
+            self.remaining.pop(series_uid, None)
+            self.skipped += skipped
+            self.failed += failed
+            if result == 'done':
+                self.series_done += 1
+            elif result == 'skipped':
+                self.series_skipped += 1
+            else:
+                self.series_failed += 1
+        self.maybe_print(force=True)
+
+    def maybe_print(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_print < 2:
+            return
+        self._last_print = now
+        print(self.summary())
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        finished = self.series_done + self.series_skipped + self.series_failed
+        return (
+            f'Series {finished}/{self.series_total} ({self.series_skipped} already on disk, '
+            f'{self.series_failed} failed), {self.instances} instances retrieved, '
+            f'{sum(self.remaining.values())} to come, {self.skipped} skipped, {self.failed} failed, '
+            f'{self.bytes / 1e6:.1f} MB at {self.bytes / elapsed / 1e6:.1f} MB/s'
+        )
+
+
+def read_input(filename):
+    """Yield (Study Instance UID, Series Instance UID or None) from filename."""
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        if filename.lower().endswith('.jsonl'):
+            rows = (json.loads(line) for line in f if line.strip())
+        elif filename.lower().endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = (
+                dict(zip(('StudyInstanceUID', 'SeriesInstanceUID'), line.replace(',', ' ').split()))
+                for line in f if line.strip()
+            )
+        for row in rows:
+            if row.get('Status', 'match') != 'match' or not row.get('StudyInstanceUID'):
+                continue
+            yield row['StudyInstanceUID'].strip(), (row.get('SeriesInstanceUID') or '').strip() or None
+
+
+def plan(tree, studies):
+    """Return the series nodes to retrieve for [(study UID, series UID or None)]."""
+    wanted = {}
+    for study_uid, series_uid in studies:
+        series = wanted.setdefault(study_uid, set())
+        if series_uid is None or None in series:
+            # The whole study
+            wanted[study_uid] = {None}
+        else:
+            series.add(series_uid)
+
+    with ThreadPoolExecutor(max_workers=tree.max_workers) as executor:
+        found = executor.map(lambda uid: tree.roots(StudyInstanceUID=uid), wanted)
+        study_nodes = [node for nodes in found for node in nodes]
+
+    series_nodes = []
+    for study, children in tree.expand(study_nodes).items():
+        series_uids = wanted[study.key]
+        series_nodes += [node for node in children if None in series_uids or node.key in series_uids]
+    return series_nodes
+
+
+def on_disk(layout, series, image):
+    """Return True if the image of series is already in the storage folder."""
+    study = series.parent
+    ds = Dataset()
+    ds.PatientID = study.PatientID or ''
+    ds.StudyDate = study.StudyDate or ''
+    ds.StudyInstanceUID = study.key
+    ds.SeriesInstanceUID = series.key
+    ds.SOPInstanceUID = image.key
+    return os.path.exists(os.path.join(layout.root, *layout.parts(ds)))
+
+
+def retrieve_series(pacs, series, layout, progress, method, resume):
+    """Retrieve the instances of series that aren't already on disk."""
+    skipped = 0
+    failed = 0
+    pending = functools.partial(progress.pending, series.key)
+    try:
+        identifiers = []
+        if resume:
+            images = series.children()
+            missing = [image.key for image in images if not on_disk(layout, series, image)]
+            skipped = len(images) - len(missing)
+            if not missing:
+                progress.series_finished(series.key, skipped=skipped, result='skipped')
+                return
+            if skipped:
+                # Only ask for what is missing
+                for start in range(0, len(missing), MAX_UIDS_PER_REQUEST):
+                    ds = Dataset()
+                    ds.QueryRetrieveLevel = 'IMAGE'
+                    ds.StudyInstanceUID = series.parent.key
+                    ds.SeriesInstanceUID = series.key
+                    ds.SOPInstanceUID = missing[start:start + MAX_UIDS_PER_REQUEST]
+                    identifiers.append(ds)
+
+        if not identifiers:
+            ds = Dataset()
+            ds.QueryRetrieveLevel = 'SERIES'
+            ds.StudyInstanceUID = series.parent.key
+            ds.SeriesInstanceUID = series.key
+            identifiers.append(ds)
+
+        for ds in identifiers:
+            if method == 'get':
+                status = pacs.get(ds, store, model='study', progress=pending)
+            else:
+                status = pacs.move(ds, my_ae_title, model='study', progress=pending)
+            failed += status.get('NumberOfFailedSuboperations', 0) or 0
+    except (QueryError, AssociationError) as e:
+        print(f'Series {series.key}: {e}')
+        progress.series_finished(series.key, skipped=skipped, failed=failed, result='failed')
+        return
+    progress.series_finished(series.key, skipped=skipped, failed=failed, result='failed' if failed else 'done')
+
+
+# Set up by main()
+layout = None
+progress = None
+
+
+def store(event):
+    """Handle a C-STORE request, renaming the received file into place."""
+    path = event.dataset_path
+    try:
+        ds = read_header(path, layout.tags)
+        filename = layout.path_for(ds)
+        nbytes = os.path.getsize(path)
+        move_into_place(path, filename)
+    except Exception as e:
+        print(f'Unable to store {event.request.AffectedSOPInstanceUID}: {e}')
+        progress.store_failed()
+        return 0xA700  # Out of resources
+    progress.stored(nbytes)
+    return 0x0000  # Success status
+
+
+def start_move_destination():
+    """Start the Storage SCP the PACS sends to for C-MOVE."""
+    if not my_port:
+        sys.exit('C-MOVE needs PORT in the [MY AET] section of the ini file')
+    ae = AE(ae_title=my_ae_title)
+    for context in StoragePresentationContexts:
+        ae.add_supported_context(context.abstract_syntax)
+    return ae.start_server(('', my_port), block=False, evt_handlers=[(evt.EVT_C_STORE, store)])
+
+
+def main():
+    global layout, progress
+
+    parser = argparse.ArgumentParser(description="Retrieve studies or series from a PACS.")
+    parser.add_argument("--input", help="Text, CSV or JSON Lines file of Study (and Series) Instance UIDs")
+    parser.add_argument("--study", action="append", default=[], help="Study Instance UID to retrieve, may be repeated")
+    parser.add_argument("--method", choices=["get", "move"], default="get", help="Retrieve with C-GET or C-MOVE")
+    parser.add_argument("--concurrency", type=int, default=4, help="Number of series retrieved at the same time")
+    parser.add_argument("--no-resume", action="store_true", help="Retrieve whole series without checking what is on disk")
+    args = parser.parse_args()
+
+    studies = [(uid, None) for uid in args.study]
+    if args.input:
+        studies += list(read_input(args.input))
+    if not studies:
+        parser.error('give --study or --input')
+
+    load_config()
+    layout = make_layout(layout_name, storage_location)
+
+    # Write what arrives straight to a file next to the storage folder so
+    # it can be renamed into place
+    _config.STORE_RECV_CHUNKED_DATASET = True
+    spool = os.path.join(storage_location, '.incoming')
+    os.makedirs(spool, exist_ok=True)
+    tempfile.tempdir = spool
+
+    pool = AssociationPool(my_ae_title, max_size=args.concurrency)
+    pacs = RemoteAE(PACSAET, PACSIP, PACSPORT, pool)
+    tree = QueryTree(pacs, model='study', return_keys=RETURN_KEYS, max_workers=args.concurrency)
+    server = start_move_destination() if args.method == 'move' else None
+
+    try:
+        series = plan(tree, studies)
+        print(f'Retrieving {len(series)} series from {PACSAET} with C-{args.method.upper()}')
+        progress = Progress(len(series))
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = {
+                executor.submit(retrieve_series, pacs, node, layout, progress, args.method, not args.no_resume): node
+                for node in series
+            }
+            for future, node in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f'Series {node.key}: {type(e).__name__}: {e}')
+                    progress.series_finished(node.key, result='failed')
+        print(progress.summary())
+    except (QueryError, AssociationError) as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        pool.close()
+        if server:
+            server.shutdown()
+
+    if progress.series_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+###############################################################################
+# Sends every DICOM file in a folder to a PACS with C-STORE
+#
+# [MY AET]
+# AET: MY_SCU
+#
+# [PACS DICOM settings]
+# AET: PACS
+# PORT: 104
+# IPADDRESS: 192.168.0.5
+#
+#   python "DICOM Send SCU.py" folder --associations 4 --output sent.csv
+# The folder is searched recursively, skipping hidden folders such as the
+# .incoming spool of the Store SCP, and only the file meta information of
+# each file is read, to find the SOP Class and Transfer Syntax it needs a
+# presentation context for. The files are then sent as they are, straight
+# from disk, over --associations parallel associations. Files that can't be
+# sent because the association was lost or the PACS was out of resources are
+# tried again up to --retries times, waiting --backoff seconds before the
+# first retry and twice as long before each one after that. If the PACS
+# rejects the association outright, the rest of the group fails at once; a
+# Sender that can't associate after 3 tries leaves its files to the others.
+# --output writes a CSV line per file with its status, otherwise only
+# failures are printed.
+################################################################################
+
+import os
+import csv
+import sys
+import time
+import queue
+import random
+import argparse
+import threading
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.errors import InvalidDicomError
+from pydicom.filereader import read_file_meta_info
+from pynetdicom import AE, _config
+from pynetdicom.status import code_to_category
+
+# Settings, read from the config file by load_config()
+my_ae_title = PACSAET = PACSPORT = PACSIP = None
+
+
+def load_config():
+    """Load the settings from the config file."""
+    global my_ae_title, PACSAET, PACSPORT, PACSIP
+    config = configparser.ConfigParser()
+    config.read(r'DICOM Send SCU.ini')
+    my_ae_title = config['MY AET']['AET']
+    PACSAET = config['PACS DICOM settings']['AET']
+    PACSPORT = int(config['PACS DICOM settings']['PORT'])
+    PACSIP = config['PACS DICOM settings']['IPADDRESS']
+
+
+# An association can have at most 128 presentation contexts
+MAX_CONTEXTS = 128
+
+# Longest wait between two tries, in seconds
+MAX_BACKOFF = 60
+
+# Tries a Sender makes to associate before leaving its files to the others
+MAX_CONNECT_ATTEMPTS = 3
+
+REPORT_COLUMNS = ['Path', 'SOPInstanceUID', 'SOPClassUID', 'TransferSyntaxUID', 'Status', 'Attempts', 'Bytes']
+
+
+class DicomFile:
+    """A file to send and what is known about it from its file meta."""
+
+    __slots__ = ('path', 'size', 'sop_class_uid', 'sop_instance_uid', 'transfer_syntax_uid', 'attempts')
+
+    def __init__(self, path, size, sop_class_uid, sop_instance_uid, transfer_syntax_uid):
+        self.path = path
+        self.size = size
+        self.sop_class_uid = sop_class_uid
+        self.sop_instance_uid = sop_instance_uid
+        self.transfer_syntax_uid = transfer_syntax_uid
+        self.attempts = 0
+
+    @property
+    def context(self):
+        return self.sop_class_uid, self.transfer_syntax_uid
+
+
+class Report:
+    """Writes a line per file and keeps the totals."""
+
+    def __init__(self, filename, total_files, total_bytes):
+        self.file = open(filename, 'w', newline='', encoding='utf-8') if filename else None
+        self.csv = csv.DictWriter(self.file, fieldnames=REPORT_COLUMNS) if self.file else None
+        if self.csv:
+            self.csv.writeheader()
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._last_print = 0.0
+        self._lock = threading.Lock()
+
+    def result(self, dicom_file, status):
+        """Record the final status of dicom_file, 'sent' or why it failed."""
+        with self._lock:
+            if status.startswith('sent'):
+                self.sent += 1
+                self.bytes += dicom_file.size
+            else:
+                self.failed += 1
+                print(f'{dicom_file.path}: {status}')
+            if self.csv:
+                self.csv.writerow({
+                    'Path': dicom_file.path,
+                    'SOPInstanceUID': dicom_file.sop_instance_uid,
+                    'SOPClassUID': dicom_file.sop_class_uid,
+                    'TransferSyntaxUID': dicom_file.transfer_syntax_uid,
+                    'Status': status,
+                    'Attempts': dicom_file.attempts,
+                    'Bytes': dicom_file.size,
+                })
+            now = time.monotonic()
+            if now - self._last_print >= 2:
+                self._last_print = now
+                print(self.summary())
+
+    def retry(self):
+        with self._lock:
+            self.retried += 1
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (
+            f'Sent {self.sent}/{self.total_files} files, {self.failed} failed, {self.retried} retries, '
+            f'{self.bytes / 1e6:.1f} of {self.total_bytes / 1e6:.1f} MB at {self.bytes / elapsed / 1e6:.1f} MB/s'
+        )
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def find_files(folder):
+    """Yield the paths of the files below folder.
+
+    Hidden folders are skipped, they include the .incoming spool of the
+    Store SCP and Retrieve SCU where files are still being received.
+    """
+    for directory, subdirs, filenames in os.walk(folder):
+        subdirs[:] = [subdir for subdir in subdirs if not subdir.startswith('.')]
+        for filename in filenames:
+            if not filename.startswith('.') and not filename.endswith('.part'):
+                yield os.path.join(directory, filename)
+
+
+def read_meta(path):
+    """Return a DicomFile for path, or (path, reason) if it can't be sent."""
+    try:
+        meta = read_file_meta_info(path)
+        size = os.path.getsize(path)
+    except (InvalidDicomError, OSError) as e:
+        return path, f'not a DICOM file: {e}'
+    sop_class_uid = meta.get('MediaStorageSOPClassUID')
+    transfer_syntax_uid = meta.get('TransferSyntaxUID')
+    if not sop_class_uid or not transfer_syntax_uid:
+        return path, 'no SOP Class or Transfer Syntax in the file meta'
+    return DicomFile(path, size, sop_class_uid, meta.get('MediaStorageSOPInstanceUID', ''), transfer_syntax_uid)
+
+
+def scan(folder, threads=8):
+    """Return the DicomFiles in folder and [(path, reason)] for the others."""
+    files, skipped = [], []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for result in executor.map(read_meta, find_files(folder)):
+            if isinstance(result, DicomFile):
+                files.append(result)
+            else:
+                skipped.append(result)
+    return files, skipped
+
+
+def group_by_context(files):
+    """Return [(contexts, files)] with at most MAX_CONTEXTS contexts in each group.
+
+    Each presentation context is a (SOP Class, Transfer Syntax) pair found in
+    the files, with only the file's own Transfer Syntax proposed because the
+    files are sent without being re-encoded.
+    """
+    by_context = {}
+    for dicom_file in files:
+        by_context.setdefault(dicom_file.context, []).append(dicom_file)
+
+    contexts = list(by_context)
+    groups = []
+    for start in range(0, len(contexts), MAX_CONTEXTS):
+        group = contexts[start:start + MAX_CONTEXTS]
+        groups.append((group, [dicom_file for context in group for dicom_file in by_context[context]]))
+    return groups
+
+
+def backoff_delay(backoff, attempts):
+    """Seconds to wait before try number attempts + 1, with some jitter."""
+    return min(MAX_BACKOFF, backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+class SendGroup:
+    """What the Senders of one group of files share.
+
+    failure is set to why the files can't be sent once the PACS has
+    rejected the association outright or the last Sender has given up,
+    the remaining files are then reported as failed without being tried.
+    """
+
+    def __init__(self, jobs, senders):
+        self.jobs = jobs
+        self.senders = senders
+        self.failure = None
+        self._lock = threading.Lock()
+
+    def next_file(self):
+        """Return the next file to send or None once there are none left."""
+        with self._lock:
+            try:
+                return self.jobs.get_nowait()
+            except queue.Empty:
+                self.senders -= 1
+                return None
+
+    def give_up(self, dicom_file):
+        """Hand dicom_file to the other Senders, return False if there are none."""
+        with self._lock:
+            if self.senders == 1:
+                return False
+            self.jobs.put(dicom_file)
+            self.senders -= 1
+            return True
+
+    def fail(self, reason):
+        with self._lock:
+            if self.failure is None:
+                self.failure = reason
+
+
+class Sender(threading.Thread):
+    """Sends files taken from the group's jobs over its own association."""
+
+    def __init__(self, ae, group, report, retries, backoff):
+        super().__init__(daemon=True)
+        self.ae = ae
+        self.group = group
+        self.report = report
+        self.retries = retries
+        self.backoff = backoff
+        self.assoc = None
+
+    def run(self):
+        try:
+            while True:
+                dicom_file = self.group.next_file()
+                if dicom_file is None:
+                    return
+                if self.group.failure is None:
+                    reason = self.connect()
+                    if reason is not None:
+                        if self.group.give_up(dicom_file):
+                            # The other Senders carry on without this one
+                            return
+                        self.group.fail(reason)
+                if self.group.failure is not None:
+                    self.report.result(dicom_file, self.group.failure)
+                    continue
+                self.send(dicom_file)
+        finally:
+            if self.assoc is not None and self.assoc.is_established:
+                self.assoc.release()
+
+    def connect(self):
+        """Return None once associated, otherwise why it wasn't possible.
+
+        A permanent rejection or an association without any accepted
+        presentation context fails the whole group at once. Anything else,
+        such as a transient rejection or the PACS not answering, is tried
+        MAX_CONNECT_ATTEMPTS times with backoff.
+        """
+        attempts = 0
+        while self.assoc is None or not self.assoc.is_established:
+            if self.group.failure is not None:
+                return self.group.failure
+            attempts += 1
+            self.assoc = self.ae.associate(PACSIP, PACSPORT, ae_title=PACSAET)
+            if self.assoc.is_established:
+                break
+
+            reason = 'association aborted or never connected'
+            rsp = self.assoc.acceptor.primitive
+            if self.assoc.is_rejected and rsp is not None:
+                reason = f'association rejected ({rsp.result_str}): {rsp.reason_str}'
+                if rsp.result == 0x01:
+                    self.group.fail(reason)
+                    return reason
+            elif self.assoc.rejected_contexts and not self.assoc.accepted_contexts:
+                reason = 'association aborted, no presentation context was accepted'
+                self.group.fail(reason)
+                return reason
+
+            if attempts >= MAX_CONNECT_ATTEMPTS:
+                return reason
+            self.report.retry()
+            time.sleep(backoff_delay(self.backoff, attempts))
+        return None
+
+    def send(self, dicom_file):
+        """Send dicom_file, retrying with backoff, and report the result.
+
+        Only a lost association or an Out of Resources status is retried.
+        """
+        while True:
+            dicom_file.attempts += 1
+            retry, status_text = self.try_send(dicom_file)
+            if not retry or dicom_file.attempts > self.retries:
+                self.report.result(dicom_file, status_text)
+                return
+            self.report.retry()
+            time.sleep(backoff_delay(self.backoff, dicom_file.attempts))
+            reason = self.connect()
+            if reason is not None:
+                self.report.result(dicom_file, reason)
+                return
+
+    def try_send(self, dicom_file):
+        """Send dicom_file once and return (worth retrying, status text)."""
+        try:
+            status = self.assoc.send_c_store(dicom_file.path)
+        except ValueError as e:
+            # No accepted presentation context for the file
+            return False, f'not sent: {e}'
+        except (OSError, RuntimeError) as e:
+            self.assoc.abort()
+            return True, f'not sent: {e}'
+
+        if not status:
+            # The association was aborted or timed out
+            self.assoc.abort()
+            return True, 'connection timed out, was aborted or received invalid response'
+        category = code_to_category(status.Status)
+        if category in ('Success', 'Warning'):
+            return False, 'sent' if category == 'Success' else f'sent with warning 0x{status.Status:04X}'
+        # 0xA7xx is Out of Resources, which may be gone on the next try
+        return status.Status >> 8 == 0xA7, f'failed 0x{status.Status:04X}'
+
+
+def send_group(contexts, files, report, associations, retries, backoff):
+    """Send files over up to associations associations proposing contexts."""
+    ae = AE(ae_title=my_ae_title)
+    for sop_class_uid, transfer_syntax_uid in contexts:
+        ae.add_requested_context(sop_class_uid, transfer_syntax_uid)
+
+    jobs = queue.Queue()
+    for dicom_file in files:
+        jobs.put(dicom_file)
+    group = SendGroup(jobs, min(associations, len(files)))
+    senders = [Sender(ae, group, report, retries, backoff) for _ in range(group.senders)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a folder of DICOM files to a PACS.")
+    parser.add_argument("folder", help="Folder to send, searched recursively")
+    parser.add_argument("--associations", type=int, default=4, help="Number of parallel associations")
+    parser.add_argument("--retries", type=int, default=3, help="Times a failed file is tried again")
+    parser.add_argument("--backoff", type=float, default=1.0, help="Seconds to wait before the first retry")
+    parser.add_argument("--output", help="CSV file with the status of every file")
+    args = parser.parse_args()
+    load_config()
+
+    # Send the files from disk without decoding them
+    _config.STORE_SEND_CHUNKED_DATASET = True
+
+    files, skipped = scan(args.folder)
+    for path, reason in skipped:
+        print(f'{path}: {reason}')
+    if not files:
+        sys.exit(f'No DICOM files to send in {args.folder}')
+
+    groups = group_by_context(files)
+    print(f'Sending {len(files)} files to {PACSAET} using '
+          f'{sum(len(contexts) for contexts, _ in groups)} presentation contexts')
+
+    report = Report(args.output, len(files), sum(dicom_file.size for dicom_file in files))
+    try:
+        for contexts, group_files in groups:
+            send_group(contexts, group_files, report, args.associations, args.retries, args.backoff)
+    finally:
+        report.close()
+    print(report.summary())
+    if skipped:
+        print(f'{len(skipped)} files skipped')
+    if report.failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
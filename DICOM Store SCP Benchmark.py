@@ -0,0 +1,385 @@
+################################################################################
+# Load generator for "DICOM Store SCP WORKING.py"
+#
+# Starts the Store SCP on a free localhost port in a temporary folder, sends
+# it synthetic instances over several concurrent associations and reports
+#   instances/s and MB/s acknowledged by the SCP
+#   p50 / p99 C-STORE latency as seen by the sender
+#   peak resident memory of the SCP (Linux, macOS and BSD only)
+# The results are written to a JSON file so runs on different commits can be
+# compared with --compare.
+#
+# Instance kinds, add RxCxF to change the rows, columns and frames (or the
+# number of text items for sr), e.g. --kind ct --kind us:480x640x50
+#   sr - Basic Text SR with 200 text items
+#   ct - 512 x 512 16 bit CT image
+#   us - 200 frame 480 x 640 8 bit ultrasound cine loop
+#   mr - 400 frame 256 x 256 16 bit enhanced MR
+#
+# python "DICOM Store SCP Benchmark.py" --associations 4 --instances 200 --kind ct
+# python "DICOM Store SCP Benchmark.py" --kind us --workers 2 --writers 4 --output us.json
+################################################################################
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pynetdicom import AE
+from pynetdicom.dsutils import encode
+from pynetdicom.sop_class import (
+    Verification,
+    BasicTextSRStorage,
+    CTImageStorage,
+    UltrasoundMultiFrameImageStorage,
+    EnhancedMRImageStorage,
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SCP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DICOM Store SCP WORKING.py')
+SCP_AET = 'BENCH_SCP'
+
+# kind -> (SOP Class, Modality, rows, columns, frames, bits allocated)
+KINDS = {
+    'sr': (BasicTextSRStorage, 'SR', 0, 0, 200, 0),
+    'ct': (CTImageStorage, 'CT', 512, 512, 1, 16),
+    'us': (UltrasoundMultiFrameImageStorage, 'US', 480, 640, 200, 8),
+    'mr': (EnhancedMRImageStorage, 'MR', 256, 256, 400, 16),
+}
+
+# Results compared by --compare, True where bigger is better
+COMPARED = {
+    'instances_per_s': True,
+    'mb_per_s': True,
+    'latency_p50_ms': False,
+    'latency_p99_ms': False,
+    'scp_peak_rss_mb': False,
+}
+
+
+def parse_kind(value):
+    """Return (name, rows, columns, frames) for a --kind argument."""
+    name, _, size = value.lower().partition(':')
+    if name not in KINDS:
+        raise argparse.ArgumentTypeError(f"Unknown kind '{name}', use one of {', '.join(KINDS)}")
+
+    _, _, rows, columns, frames, _ = KINDS[name]
+    if size:
+        try:
+            values = [int(part) for part in size.split('x')]
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Size must look like ROWSxCOLUMNSxFRAMES, not '{size}'")
+        if name == 'sr':
+            frames = values[-1]
+        else:
+            rows, columns, *rest = values + [frames]
+            frames = rest[0]
+    return name, rows, columns, frames
+
+
+def make_dataset(name, rows, columns, frames, pixel_data=None):
+    """Return a synthetic instance of the given kind.
+
+    pixel_data can be passed in so several data sets share the same bytes.
+    """
+    sop_class, modality, _, _, _, bits = KINDS[name]
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = sop_class
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = generate_uid()
+    ds.PatientName = f'BENCHMARK^{name.upper()}'
+    ds.PatientID = 'BENCHMARK'
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.StudyDate = time.strftime('%Y%m%d')
+    ds.Modality = modality
+    ds.SeriesNumber = 1
+    ds.InstanceNumber = 1
+
+    if name == 'sr':
+        ds.ValueType = 'CONTAINER'
+        ds.ContinuityOfContent = 'SEPARATE'
+        items = []
+        for ii in range(frames):
+            item = Dataset()
+            item.RelationshipType = 'CONTAINS'
+            item.ValueType = 'TEXT'
+            item.TextValue = f'Finding {ii}: ' + 'no abnormality detected. ' * 8
+            items.append(item)
+        ds.ContentSequence = items
+        return ds
+
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.BitsAllocated = bits
+    ds.BitsStored = bits
+    ds.HighBit = bits - 1
+    ds.PixelRepresentation = 0
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    if pixel_data is None:
+        length = rows * columns * frames * bits // 8
+        pixel_data = (bytes(range(256)) * (length // 256 + 1))[:length]
+    ds.PixelData = pixel_data
+    return ds
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_ini(folder, port, args):
+    """Write the SCP's ini file into folder."""
+    lines = [
+        '[DICOM settings]',
+        f'AET: {SCP_AET}',
+        f'PORT: {port}',
+        '',
+        '[STORAGE LOCATION]',
+        'Folder: storage',
+        f'ReceiveMode: {args.receive_mode}',
+        f'Writers: {args.writers}',
+        f'FsyncPolicy: {args.fsync}',
+        f'Layout: {args.layout}',
+        '',
+        '[INDEX]',
+        f'Enabled: {"no" if args.no_index else "yes"}',
+        '',
+        '[COMPRESSION]',
+        f'Default: {args.compression}',
+    ]
+    with open(os.path.join(folder, 'DICOM Store SCP WORKING.ini'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def start_scp(folder, port, args):
+    """Start the SCP in folder and wait until it answers a C-ECHO."""
+    write_ini(folder, port, args)
+    command = [sys.executable, SCP_SCRIPT]
+    if args.workers > 1:
+        command += ['--workers', str(args.workers)]
+
+    log = open(os.path.join(folder, 'scp.log'), 'w')
+    process = subprocess.Popen(command, cwd=folder, stdout=log, stderr=subprocess.STDOUT)
+
+    ae = AE(ae_title='BENCH_SCU')
+    ae.add_requested_context(Verification)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        assoc = ae.associate('127.0.0.1', port, ae_title=SCP_AET)
+        if assoc.is_established:
+            assoc.release()
+            return process, log
+        time.sleep(0.2)
+
+    stop_scp(process, log)
+    with open(log.name) as f:
+        print(f.read())
+    sys.exit('The Store SCP did not start')
+
+
+def stop_scp(process, log):
+    """Stop the SCP, letting it write everything it acknowledged."""
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=120)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+    log.close()
+
+
+def send(port, kinds, count, samples, errors):
+    """Send count instances over one association, cycling through kinds.
+
+    The latency and size of every instance sent is appended to samples.
+    """
+    ae = AE(ae_title='BENCH_SCU')
+    for name, *_ in kinds:
+        ae.add_requested_context(KINDS[name][0], ExplicitVRLittleEndian)
+
+    # Each association gets its own data sets, sharing the pixel data
+    datasets = [(make_dataset(name, rows, columns, frames, pixel_data), size)
+                for name, rows, columns, frames, pixel_data, size in kinds]
+
+    assoc = ae.associate('127.0.0.1', port, ae_title=SCP_AET)
+    if not assoc.is_established:
+        errors.append('Association rejected or aborted')
+        return
+
+    try:
+        for ii in range(count):
+            ds, size = datasets[ii % len(datasets)]
+            ds.SOPInstanceUID = generate_uid()
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+            start = time.perf_counter()
+            status = assoc.send_c_store(ds)
+            samples.append((time.perf_counter() - start, size))
+            if not status or status.Status != 0x0000:
+                errors.append(f'C-STORE failed with status {status.Status if status else "none"}')
+    finally:
+        assoc.release()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss_mb():
+    """Return the peak RSS in MB of the largest child process that has exited."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linux and BSD report KB, macOS bytes
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return round(rss / 1024, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(SCP_SCRIPT), capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, filename):
+    """Print the change in each result compared to an earlier run."""
+    with open(filename) as f:
+        previous = json.load(f)['results']
+
+    print(f'\nCompared to {filename}')
+    for key, bigger_is_better in COMPARED.items():
+        old, new = previous.get(key), results.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        better = (change > 0) == bigger_is_better
+        print(f'  {key:18} {old:>10} -> {new:<10} {change:+.1f}% {"better" if better else "worse"}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DICOM Store SCP.")
+    parser.add_argument("--kind", action="append", type=parse_kind,
+                        help="Instance kind to send (sr, ct, us, mr), may be repeated. Default ct")
+    parser.add_argument("--associations", type=int, default=4, help="Number of concurrent associations")
+    parser.add_argument("--instances", type=int, default=100, help="Instances sent over each association")
+    parser.add_argument("--workers", type=int, default=1, help="--workers passed to the SCP")
+    parser.add_argument("--writers", type=int, default=0, help="Writers in the SCP's ini file")
+    parser.add_argument("--receive-mode", default="stream", choices=["stream", "decode"], help="ReceiveMode in the SCP's ini file")
+    parser.add_argument("--fsync", default="none", choices=["none", "file", "batch"], help="FsyncPolicy in the SCP's ini file")
+    parser.add_argument("--layout", default="flat", help="Layout in the SCP's ini file")
+    parser.add_argument("--compression", default="none", help="Default compression in the SCP's ini file")
+    parser.add_argument("--no-index", action="store_true", help="Disable the SCP's instance index")
+    parser.add_argument("--folder", help="Run the SCP in this folder and keep what it stored, instead of a temporary folder")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare with")
+    args = parser.parse_args()
+
+    kinds = []
+    for name, rows, columns, frames in args.kind or [parse_kind('ct')]:
+        ds = make_dataset(name, rows, columns, frames)
+        kinds.append((name, rows, columns, frames, ds.get('PixelData'), len(encode(ds, False, True))))
+    for name, rows, columns, frames, _, size in kinds:
+        print(f'{name}: {rows}x{columns}x{frames}, {size / 1e6:.2f} MB per instance')
+
+    folder = args.folder or tempfile.mkdtemp(prefix='scp-benchmark-')
+    os.makedirs(folder, exist_ok=True)
+    port = free_port()
+    process, log = start_scp(folder, port, args)
+    print(f'Store SCP running in {folder} on port {port}')
+
+    samples = []
+    errors = []
+    threads = [
+        threading.Thread(target=send, args=(port, kinds, args.instances, samples, errors))
+        for _ in range(args.associations)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stop_scp(process, log)
+    if not args.folder:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    sent = len(samples)
+    latencies = [latency for latency, _ in samples]
+    total_bytes = sum(size for _, size in samples)
+
+    results = {
+        'instances': sent,
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'instances_per_s': round(sent / elapsed, 1),
+        'mb_per_s': round(total_bytes / elapsed / 1e6, 2),
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'scp_peak_rss_mb': peak_rss_mb(),
+    }
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'settings': {
+            'kinds': [f'{name}:{rows}x{columns}x{frames}' for name, rows, columns, frames, *_ in kinds],
+            'associations': args.associations,
+            'instances': args.instances,
+            'workers': args.workers,
+            'writers': args.writers,
+            'receive_mode': args.receive_mode,
+            'fsync': args.fsync,
+            'layout': args.layout,
+            'compression': args.compression,
+            'index': not args.no_index,
+        },
+        'results': results,
+    }
+
+    for key, value in results.items():
+        print(f'{key:18} {value}')
+    for error in sorted(set(errors)):
+        print(f'Error: {error}')
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
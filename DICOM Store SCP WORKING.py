@@ -7,15 +7,149 @@
 # 
 # [STORAGE LOCATION]
 # Folder: dicom_storage
+# ReceiveMode: stream
+# SpoolFolder: dicom_storage/.incoming
+# Writers: 4
+# QueueDepth: 64
+# FsyncPolicy: batch
+# FsyncBatchSize: 32
+# FsyncBatchLatency: 1.0
+# Layout: patient
+# HashLevels: 2
+# HashWidth: 2
+# Duplicates: keep
+# DuplicateCache: 100000
+#
+# Everything after Folder is optional.
+# ReceiveMode 'stream' (the default) writes the data set exactly as received
+# to a temporary file in SpoolFolder and renames it into the storage folder,
+# 'decode' decodes every data set with pydicom and saves it again. Put
+# SpoolFolder on a local disk when Folder is a network share.
+# Writers > 0 hands received instances to that many writer threads through a
+# queue holding at most QueueDepth instances, the association waits when the
+# queue is full. Writers: 0 (the default) writes in the association thread.
+# A writer tries a failed write or fsync 3 more times, then moves the
+# instance to the failed folder in SpoolFolder and counts it in the metrics.
+# Queued instances left in SpoolFolder when the SCP stopped are written the
+# next time it starts.
+# FsyncPolicy is none (the default), file (fsync every file) or batch (fsync
+# every FsyncBatchSize files or FsyncBatchLatency seconds, whichever is first).
+# Layout decides where below Folder each instance is stored:
+#   flat    - Folder/{SOPInstanceUID}.dcm (the default)
+#   patient - Folder/PatientID/StudyInstanceUID/SeriesInstanceUID/{SOPInstanceUID}.dcm
+#   hash    - Folder/ab/cd/{SOPInstanceUID}.dcm, HashLevels folders of
+#             HashWidth hex digits taken from a hash of the SOP Instance UID
+#   date    - Folder/YYYY/MM/DD/{SOPInstanceUID}.dcm from the Study Date
+# Duplicates turns on detection of instances that are sent again. A hash of
+# every received data set is recorded and an instance whose SOP Instance UID
+# was stored before with the same hash is acknowledged without being written.
+# An instance sent again while the first copy is still being written waits
+# for that write, so it is only dropped once the first copy is on disk.
+# When the content differs the policy decides:
+#   none      - no detection, every instance is written (the default)
+#   keep      - keep the stored instance and discard the new one
+#   overwrite - replace the stored instance with the new one
+#   version   - store the new one next to it as {SOPInstanceUID}.v1.dcm,
+#               .v2.dcm and so on, the index points at the newest
+# The last DuplicateCache instances are remembered in memory, older ones are
+# looked up in the index.
+#
+# [INDEX]
+# Enabled: yes
+# Database: dicom_storage/index.sqlite
+# BatchSize: 200
+# BatchLatency: 0.5
+#
+# The [INDEX] section is optional. Every stored instance is added to an SQLite
+# index (Folder/index.sqlite by default) in transactions of up to BatchSize
+# instances, committed at least every BatchLatency seconds. Rebuild the index
+# of an existing folder with dicom_index.py.
+# While the index is enabled the SCP also answers Patient Root and Study Root
+# C-FIND requests at the PATIENT, STUDY, SERIES and IMAGE levels from it and
+# sends the matching files for C-GET and C-MOVE requests. Retrieves need the
+# unique key of their level and of every level above it, without wild cards,
+# others fail with 0xA900 (C-GET) or 0xC514 (C-MOVE).
+#
+# [MOVE DESTINATIONS]
+# WORKSTATION: 192.168.0.10, 104, 2
+#
+# The [MOVE DESTINATIONS] section lists the AE titles C-MOVE can send to as
+# AE title: IP address, port, associations. The optional associations value
+# (default 1) is how many C-MOVEs to that AE may run at the same time, each
+# over its own association.
+#
+# [COMPRESSION]
+# Default: none
+# Processes: 2
+# UltrasoundMultiFrameImageStorage: auto
+# XRayAngiographicImageStorage: rle
+# EncapsulatedPDFStorage: deflate
+#
+# The [COMPRESSION] section is optional. Stored instances of the SOP classes
+# listed by keyword (any of storage_sop_classes below, Default for the rest)
+# are transcoded in place by Processes worker processes after they have been
+# acknowledged, so the association doesn't wait for the encoder:
+#   none    - keep the transfer syntax they were received in (the default)
+#   rle     - RLE Lossless
+#   jpegls  - JPEG-LS Lossless, needs pyjpegls
+#   j2k     - JPEG 2000 Lossless, needs pylibjpeg-openjpeg or gdcm
+#   deflate - Deflated Explicit VR Little Endian, for SR, PDF and CDA
+#   auto    - the best of jpegls, j2k and rle that is installed for images,
+#             deflate for everything else
+# Instances that were received compressed are left as they are. C-GET and
+# C-MOVE decompress compressed instances for peers that only accept the
+# uncompressed transfer syntaxes.
+#
+# Run with --workers N to start N SCP processes that share the port (this needs
+# SO_REUSEPORT, so Linux or BSD). A supervisor process restarts any worker
+# that exits and stops them all on Ctrl+C. Workers that keep exiting right
+# after starting are restarted with a growing delay and the supervisor gives
+# up after 5 of those in a row. Workers share the storage folder
+# and index, the C-MOVE association limits apply to each worker.
+#
+# [METRICS]
+# Address: 127.0.0.1
+# Port: 9100
+# LogInterval: 60
+#
+# The [METRICS] section is optional. When present the instances and bytes
+# received, associations, rejected presentation contexts, queue depths and
+# the decode, write and fsync latency of every instance are served in the
+# Prometheus text format at http://Address:Port/metrics and a JSON summary
+# line is printed every LogInterval seconds (0 turns it off). A JSON line is
+# also printed for every association that stored instances. With --workers
+# worker N serves its metrics on Port + N.
 # Alban Killingback July 2024
 ################################################################################
 
 import os
+import re
+import sys
+import time
+import signal
+import socket
+import json
+import hashlib
+import argparse
+import tempfile
+import threading
+import multiprocessing
 import configparser
 import logging
 from pydicom.dataset import Dataset
-from pynetdicom import AE, evt, debug_logger
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pynetdicom import AE, evt, debug_logger, _config
 from pynetdicom.sop_class import Verification
+from pynetdicom import build_context
+from pynetdicom.transport import AssociationServer
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelGet,
+    PatientRootQueryRetrieveInformationModelMove,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+)
 from pynetdicom.sop_class import (
     CTImageStorage,
     MRImageStorage,
@@ -38,6 +172,7 @@ from pynetdicom.sop_class import (
     XRayRadiofluoroscopicImageStorage,
     NuclearMedicineImageStorage,
     UltrasoundImageStorage,
+    UltrasoundMultiFrameImageStorage,
     VLPhotographicImageStorage,
     VLEndoscopicImageStorage,
     VLMicroscopicImageStorage,
@@ -52,44 +187,526 @@ from pynetdicom.sop_class import (
     EncapsulatedPDFStorage,
     EncapsulatedCDAStorage
 )
+from dicom_storage import move_into_place, fsync_file, read_header, make_layout, iter_stored_datasets, WriteBehindQueue
+from dicom_storage import Compressor, compression_available, can_decompress, DuplicateDetector, dataset_hash
+from dicom_index import InstanceIndex, record_from_dataset, connect, find, find_instances, INDEX_TAGS, DEFAULT_DATABASE
+from dicom_metrics import Metrics, serve_metrics
 
 # Enable logging for debugging purposes
 # debug_logger()
+LOGGER = logging.getLogger('dicom_store_scp')
 
-# load the COM port number from the config file
-config = configparser.ConfigParser()
-config.read(r'DICOM Store SCP WORKING.ini')
-ae_title = config['DICOM settings']['AET']
 server_address = '127.0.0.1'  # Listen on all available network interfaces
-server_port = int(config['DICOM settings']['PORT'])
-storage_location = config['STORAGE LOCATION']['Folder']
 
-# Define the storage directory
-storage_dir = storage_location
-if not os.path.exists(storage_dir):
-    os.makedirs(storage_dir)
+# Number of stored files opened ahead of the one being sent
+retrieve_prefetch = 4
+
+# A writer thread tries a failed write or fsync again this many times,
+# write_retry_delay seconds apart, before giving up on the instance
+write_retries = 3
+write_retry_delay = 1.0
+
+# With --workers, a worker that exits within quick_exit seconds of starting
+# is restarted after 1, 2, 4... seconds, at most max_restart_delay, and the
+# supervisor gives up after max_quick_exits of those in a row
+quick_exit = 10
+max_restart_delay = 60
+max_quick_exits = 5
+
+# Filled in by load_config()
+move_destinations = {}
+move_slots = {}
+
+# Settings, read from the config file by load_config() in the process that
+# serves the associations, so the script can be imported without the file
+config = None
+
+def load_config():
+    """Load the settings from the config file."""
+    global config, ae_title, server_port, storage_location, receive_mode, spool_location, writers
+    global queue_depth, fsync_policy, fsync_batch_size, fsync_batch_latency, layout_name
+    global hash_levels, hash_width, duplicate_policy, duplicate_cache, index_enabled
+    global index_database, index_batch_size, index_batch_latency, compression_default
+    global compression_processes, metrics_enabled, metrics_address, metrics_port
+    global metrics_log_interval, storage_dir
+    config = configparser.ConfigParser()
+    config.read(r'DICOM Store SCP WORKING.ini')
+    ae_title = config['DICOM settings']['AET']
+    server_port = int(config['DICOM settings']['PORT'])
+    storage_location = config['STORAGE LOCATION']['Folder']
+    receive_mode = config['STORAGE LOCATION'].get('ReceiveMode', 'stream').lower()
+    spool_location = config['STORAGE LOCATION'].get('SpoolFolder', os.path.join(storage_location, '.incoming'))
+    writers = config['STORAGE LOCATION'].getint('Writers', 0)
+    queue_depth = config['STORAGE LOCATION'].getint('QueueDepth', 64)
+    fsync_policy = config['STORAGE LOCATION'].get('FsyncPolicy', 'none').lower()
+    fsync_batch_size = config['STORAGE LOCATION'].getint('FsyncBatchSize', 32)
+    fsync_batch_latency = config['STORAGE LOCATION'].getfloat('FsyncBatchLatency', 1.0)
+    layout_name = config['STORAGE LOCATION'].get('Layout', 'flat')
+    hash_levels = config['STORAGE LOCATION'].getint('HashLevels', 2)
+    hash_width = config['STORAGE LOCATION'].getint('HashWidth', 2)
+    duplicate_policy = config['STORAGE LOCATION'].get('Duplicates', 'none').lower()
+    duplicate_cache = config['STORAGE LOCATION'].getint('DuplicateCache', 100000)
+    index_enabled = config.getboolean('INDEX', 'Enabled', fallback=True)
+    index_database = config.get('INDEX', 'Database', fallback=os.path.join(storage_location, DEFAULT_DATABASE))
+    index_batch_size = config.getint('INDEX', 'BatchSize', fallback=200)
+    index_batch_latency = config.getfloat('INDEX', 'BatchLatency', fallback=0.5)
+    compression_default = config.get('COMPRESSION', 'Default', fallback='none').lower()
+    compression_processes = config.getint('COMPRESSION', 'Processes', fallback=2)
+    metrics_enabled = config.has_section('METRICS') and config.getboolean('METRICS', 'Enabled', fallback=True)
+    metrics_address = config.get('METRICS', 'Address', fallback='127.0.0.1')
+    metrics_port = config.getint('METRICS', 'Port', fallback=9100)
+    metrics_log_interval = config.getfloat('METRICS', 'LogInterval', fallback=60)
+
+    # AE title -> (IP address, port) and a limit on concurrent associations, AE
+    # titles are matched ignoring case as configparser lower cases the keys
+    move_destinations.clear()
+    move_slots.clear()
+    if config.has_section('MOVE DESTINATIONS'):
+        for move_aet, value in config['MOVE DESTINATIONS'].items():
+            parts = [part.strip() for part in value.split(',')]
+            move_destinations[move_aet.upper()] = (parts[0], int(parts[1]))
+            max_associations = int(parts[2]) if len(parts) > 2 and parts[2] else 1
+            move_slots[move_aet.upper()] = threading.BoundedSemaphore(max_associations)
+
+    # Define the storage directory
+    storage_dir = storage_location
+
+# The layout, index, writer threads and metrics belong to the process serving
+# the associations and are created by start_storage() and start_metrics()
+layout = None
+index = None
+header_tags = None
+write_queue = None
+compressor = None
+compression_policy = {}
+duplicates = None
+metrics = None
+
+def start_storage():
+    """Create the storage folder, index and writer threads."""
+    global layout, index, header_tags, write_queue, compressor, compression_policy, duplicates
+
+    os.makedirs(storage_dir, exist_ok=True)
+
+    if layout_name.lower() == 'hash':
+        layout = make_layout(layout_name, storage_dir, levels=hash_levels, width=hash_width)
+    else:
+        layout = make_layout(layout_name, storage_dir)
+
+    header_tags = layout.tags
+    if index_enabled:
+        index = InstanceIndex(index_database, batch_size=index_batch_size, batch_latency=index_batch_latency)
+        header_tags = sorted(set(layout.tags) | set(INDEX_TAGS))
+
+    if duplicate_policy != 'none':
+        duplicates = DuplicateDetector(
+            duplicate_policy,
+            cache_size=duplicate_cache,
+            lookup=index.lookup if index else None,
+        )
+
+    compression_policy = read_compression_policy()
+    if compression_policy:
+        header_tags = sorted(set(header_tags) | {'SOPClassUID'})
+        compressor = Compressor(
+            compression_processes,
+            on_compressed=compressed,
+            fsync=fsync_policy != 'none',
+        )
+
+    if receive_mode == 'stream':
+        # pynetdicom writes each incoming data set to a temporary file instead
+        # of decoding it. Keep those files in the spool folder so they can be
+        # renamed rather than copied
+        _config.STORE_RECV_CHUNKED_DATASET = True
+        os.makedirs(spool_location, exist_ok=True)
+        tempfile.tempdir = spool_location
+
+    if writers > 0:
+        write_queue = WriteBehindQueue(
+            write_instance,
+            writers=writers,
+            depth=queue_depth,
+            fsync=fsync_policy,
+            fsync_batch_size=fsync_batch_size,
+            fsync_batch_latency=fsync_batch_latency,
+            observe=observe,
+            retries=write_retries,
+            retry_delay=write_retry_delay,
+            on_failed=write_failed,
+        )
+
+def stop_storage():
+    """Write everything that was acknowledged and stop the background threads."""
+    if write_queue:
+        write_queue.close()
+    if compressor:
+        compressor.close()
+    if index:
+        index.close()
+
+def read_compression_policy():
+    """Return SOP Class UID -> compression for the classes to compress."""
+    policy = {sop_class: compression_default for sop_class in storage_sop_classes}
+    keywords = {sop_class.keyword.lower(): sop_class for sop_class in storage_sop_classes}
+    if config.has_section('COMPRESSION'):
+        for key, value in config['COMPRESSION'].items():
+            if key in ('default', 'processes'):
+                continue
+            if key not in keywords:
+                raise ValueError(f"Unknown SOP class '{key}' in [COMPRESSION]")
+            policy[keywords[key]] = value.strip().lower()
+
+    for name in set(policy.values()):
+        if not compression_available(name):
+            raise ValueError(f"The encoder for '{name}' compression is not installed")
+    return {sop_class: name for sop_class, name in policy.items() if name != 'none'}
+
+def compressed(filename, transfer_syntax):
+    """Update the index once a stored file has been compressed."""
+    if index:
+        index.add(record_from_dataset(read_header(filename, header_tags), filename))
+
+def start_metrics(worker=None):
+    """Start serving the metrics if the [METRICS] section is present."""
+    global metrics
+
+    if not metrics_enabled:
+        return
+
+    labels = {} if worker is None else {'worker': worker}
+    metrics = Metrics(constant_labels=labels)
+    if write_queue:
+        metrics.gauge('write_queue_depth', write_queue.depth, 'Received instances waiting for a writer thread')
+    if index:
+        metrics.gauge('index_queue_depth', index.depth, 'Stored instances waiting to be added to the index')
+    if compressor:
+        metrics.gauge('compression_queue_depth', compressor.depth, 'Stored instances waiting to be compressed')
+
+    port = metrics_port + (worker or 0)
+    serve_metrics(metrics, metrics_address, port)
+    print(f'Serving metrics on http://{metrics_address}:{port}/metrics')
+    if metrics_log_interval > 0:
+        metrics.start_log(metrics_log_interval)
+
+def observe(stage, seconds):
+    """Record how long a stage of storing an instance took."""
+    if metrics:
+        metrics.observe('store_stage_seconds', seconds, stage=stage)
+
+def write_instance(job):
+    """Write a received instance to the storage folder and return its path.
+
+    job is (data, content hash) where data is either a decoded Dataset or
+    the path to a file holding the data set exactly as it was received.
+    Returns None if the instance was a duplicate that wasn't written.
+    """
+    data, content_hash = job
+    start = time.perf_counter()
+    if isinstance(data, Dataset):
+        ds = data
+    else:
+        # Only read the tags needed to place and index the file
+        ds = read_header(data, header_tags)
+        decoded = time.perf_counter()
+        observe('decode', decoded - start)
+        start = decoded
+    filename = layout.path_for(ds)
+
+    if duplicates:
+        if content_hash is None:
+            content_hash = dataset_hash(data)
+        action, filename = duplicates.check(ds.SOPInstanceUID, content_hash, filename)
+        if metrics:
+            metrics.inc('duplicates_total', result=action)
+        if action in ('identical', 'kept'):
+            if not isinstance(data, Dataset):
+                try:
+                    os.remove(data)
+                except OSError:
+                    pass
+            return None
+
+    try:
+        if isinstance(data, Dataset):
+            partial = f'{filename}.{os.getpid()}.{threading.get_ident()}.part'
+            ds.save_as(partial, write_like_original=False)
+            os.replace(partial, filename)
+        else:
+            move_into_place(data, filename)
+    except Exception:
+        if duplicates:
+            duplicates.done(ds.SOPInstanceUID, content_hash, filename, stored=False)
+        raise
+    if duplicates:
+        duplicates.done(ds.SOPInstanceUID, content_hash, filename)
+    observe('write', time.perf_counter() - start)
+
+    if index:
+        index.add(record_from_dataset(ds, filename, content_hash=content_hash))
+    if compressor:
+        compression = compression_policy.get(ds.get('SOPClassUID'))
+        if compression:
+            compressor.submit(filename, compression)
+    return filename
+
+def write_failed(job, filename):
+    """Set aside an instance the writer threads gave up on.
+
+    If it was never written it is moved to the failed folder in the spool
+    folder. filename is the path it was written to when only the fsync
+    failed, it is left there but may not survive a crash.
+    """
+    if metrics:
+        metrics.inc('write_failures_total', stage='write' if filename is None else 'fsync')
+    if filename is not None:
+        return
+
+    data, _ = job
+    failed_location = os.path.join(spool_location, 'failed')
+    os.makedirs(failed_location, exist_ok=True)
+    if isinstance(data, Dataset):
+        failed = os.path.join(failed_location, f'{data.SOPInstanceUID}.dcm')
+        data.save_as(failed, write_like_original=False)
+    else:
+        name = re.sub(r'(\.\d+)?\.queued$', '', os.path.basename(data))
+        failed = os.path.join(failed_location, os.path.splitext(name)[0] + '.dcm')
+        move_into_place(data, failed)
+    LOGGER.error(f'Moved an instance that could not be written to {failed}')
+
+def process_running(pid):
+    """Return True if a process with the given id is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def requeue_spooled(worker=None):
+    """Write the queued instances a previous run acknowledged but didn't write.
+
+    Instances waiting for a writer are kept in the spool folder as
+    {name}.{pid}.queued. Those of a process that is no longer running are
+    claimed by renaming them to this process's id, so only one worker
+    picks each one up.
+    """
+    if not os.path.isdir(spool_location):
+        return
+
+    for name in os.listdir(spool_location):
+        match = re.fullmatch(r'(.+?)(?:\.(\d+))?\.queued', name)
+        if not match:
+            continue
+        pid = int(match.group(2)) if match.group(2) else None
+        if pid == os.getpid() or (worker is not None and pid is not None and process_running(pid)):
+            continue
+        claimed = os.path.join(spool_location, f'{match.group(1)}.{os.getpid()}.queued')
+        try:
+            os.replace(os.path.join(spool_location, name), claimed)
+        except FileNotFoundError:
+            # Another worker got there first
+            continue
+
+        LOGGER.warning(f'Writing {claimed}, queued before the SCP last stopped')
+        job = (claimed, None)
+        if write_queue:
+            write_queue.put(job)
+            continue
+        try:
+            filename = write_instance(job)
+            if filename and fsync_policy != 'none':
+                fsync_file(filename)
+        except Exception:
+            LOGGER.exception(f'Failed to write {claimed}')
+            write_failed(job, None)
+
+def received_size(event):
+    """Return the size in bytes of the data set sent with a C-STORE request."""
+    if receive_mode == 'stream':
+        return os.path.getsize(event.dataset_path)
+    with event.request.DataSet.getbuffer() as buffer:
+        return buffer.nbytes
 
 # Define a handler for the C-STORE request
 def handle_store(event):
     """Handle a C-STORE request event."""
-    ds = event.dataset
-    ds.file_meta = event.file_meta
+    start = time.perf_counter()
+    if metrics:
+        metrics.association_stored(event.assoc, received_size(event))
 
-    # Create a filename based on the SOP Instance UID
-    filename = os.path.join(storage_dir, f'{ds.SOPInstanceUID}.dcm')
+    try:
+        content_hash = None
+        if receive_mode == 'stream':
+            data = event.dataset_path
+            if write_queue:
+                # pynetdicom deletes its temporary file once we return, so claim
+                # it under a new name before handing it to the writers. The
+                # process id tells a restarted worker whose files these are
+                data = f'{data}.{os.getpid()}.queued'
+                move_into_place(event.dataset_path, data)
+        else:
+            if duplicates:
+                # Hash the data set as received, it is re-encoded when saved
+                with event.request.DataSet.getbuffer() as buffer:
+                    content_hash = hashlib.sha256(buffer).hexdigest()
+            data = event.dataset
+            data.file_meta = event.file_meta
+            observe('decode', time.perf_counter() - start)
 
-    # Save the DICOM file
-    ds.save_as(filename, write_like_original=False)
+        if write_queue:
+            write_queue.put((data, content_hash))
+        else:
+            filename = write_instance((data, content_hash))
+            # Nothing to batch up when writing in the association thread
+            if filename and fsync_policy != 'none':
+                synced = time.perf_counter()
+                fsync_file(filename)
+                observe('fsync', time.perf_counter() - synced)
+    except Exception:
+        if metrics:
+            metrics.inc('store_failures_total')
+        raise
+
+    observe('handler', time.perf_counter() - start)
     return 0x0000  # Success status
 
+def query_model(event):
+    """Return 'STUDY' for Study Root requests and 'PATIENT' for Patient Root."""
+    if event.request.AffectedSOPClassUID in (
+        StudyRootQueryRetrieveInformationModelFind,
+        StudyRootQueryRetrieveInformationModelGet,
+        StudyRootQueryRetrieveInformationModelMove,
+    ):
+        return 'STUDY'
+    return 'PATIENT'
+
+# Define a handler for the C-FIND request
+def handle_find(event):
+    """Handle a C-FIND request event by searching the index."""
+    conn = connect(index_database)
+    try:
+        try:
+            matches = find(conn, event.identifier, query_model(event))
+            match = next(matches, None)
+        except ValueError as e:
+            LOGGER.warning(f'Invalid C-FIND identifier: {e}')
+            yield 0xA900, None  # Identifier does not match SOP Class
+            return
+
+        while match is not None:
+            if event.is_cancelled:
+                yield 0xFE00, None  # Cancelled
+                return
+            yield 0xFF00, match  # Pending
+            match = next(matches, None)
+    finally:
+        conn.close()
+
+def match_instances(event):
+    """Return the stored instances matching a C-GET or C-MOVE identifier.
+
+    Returns None if the identifier doesn't have the unique keys a retrieve
+    needs, rather than sending everything.
+    """
+    conn = connect(index_database)
+    try:
+        return find_instances(conn, event.identifier, query_model(event))
+    except ValueError as e:
+        LOGGER.warning(f'Invalid retrieve identifier: {e}')
+        return None
+    finally:
+        conn.close()
+
+def accepted_syntaxes(assoc):
+    """Return SOP Class UID -> transfer syntaxes assoc can send instances in."""
+    syntaxes = {}
+    for context in assoc.accepted_contexts:
+        if context.as_scu:
+            syntaxes.setdefault(context.abstract_syntax, set()).add(context.transfer_syntax[0])
+    return syntaxes
+
+def send_instances(event, instances, assoc):
+    """Yield the pending statuses and data sets that send instances.
+
+    assoc is the association the instances are sent over, instances stored
+    in a transfer syntax it didn't accept are decompressed.
+    """
+    transfer_syntaxes = accepted_syntaxes(assoc)
+    for ds in iter_stored_datasets(instances, retrieve_prefetch, transfer_syntaxes):
+        if event.is_cancelled:
+            yield 0xFE00, None  # Cancelled
+            return
+        yield 0xFF00, ds  # Pending
+
+# Define a handler for the C-GET request
+def handle_get(event):
+    """Handle a C-GET request event by sending the matching stored files."""
+    instances = match_instances(event)
+    if instances is None:
+        # pynetdicom only sends a failure after at least one sub-operation
+        yield 1
+        yield 0xA900, None  # Identifier does not match SOP Class
+        return
+    yield len(instances)
+    yield from send_instances(event, instances, event.assoc)
+
+def move_contexts(instances):
+    """Return the presentation contexts needed to send instances.
+
+    Each SOP class is proposed in the transfer syntaxes it is stored in,
+    plus the uncompressed ones if everything stored compressed can be
+    decompressed.
+    """
+    transfer_syntaxes = {}
+    for _, _, sop_class_uid, transfer_syntax_uid in instances:
+        syntaxes = transfer_syntaxes.setdefault(sop_class_uid, [])
+        if transfer_syntax_uid and transfer_syntax_uid not in syntaxes:
+            syntaxes.append(transfer_syntax_uid)
+
+    contexts = []
+    for sop_class_uid, syntaxes in transfer_syntaxes.items():
+        if all(can_decompress(syntax) for syntax in syntaxes):
+            for syntax in (ExplicitVRLittleEndian, ImplicitVRLittleEndian):
+                if syntax not in syntaxes:
+                    syntaxes.append(syntax)
+        contexts.append(build_context(sop_class_uid, syntaxes))
+    return contexts[:128]
+
+# Define a handler for the C-MOVE request
+def handle_move(event):
+    """Handle a C-MOVE request event by sending the matching stored files."""
+    move_aet = event.move_destination.strip().upper()
+    if move_aet not in move_destinations:
+        LOGGER.warning(f'Unknown C-MOVE destination {move_aet}')
+        yield None, None
+        return
+
+    instances = match_instances(event)
+    if instances is None:
+        # pynetdicom can only send a failure status once it has associated
+        # with the destination, failing here answers 0xC514 (Unable to
+        # process) without contacting it
+        raise ValueError('The C-MOVE identifier has no valid unique keys')
+
+    # pynetdicom opens the association to the destination itself, keep hold
+    # of it to see which transfer syntaxes were accepted
+    store_assoc = []
+    handlers = [(evt.EVT_ESTABLISHED, lambda established: store_assoc.append(established.assoc))]
+
+    # Wait until there is a free association to the destination
+    with move_slots[move_aet]:
+        addr, port = move_destinations[move_aet]
+        yield addr, port, {'contexts': move_contexts(instances), 'evt_handlers': handlers}
+        yield len(instances)
+        yield from send_instances(event, instances, store_assoc[0])
+
 # Define a handler for the C-ECHO request
 def handle_echo(event):
     """Handle a C-ECHO request event."""
     return 0x0000  # Success status
 
-# Initialize the Application Entity (AE)
-ae = AE()
-
 # Add supported presentation contexts for storage SOP classes
 storage_sop_classes = [
     CTImageStorage,
@@ -113,6 +730,7 @@ storage_sop_classes = [
     XRayRadiofluoroscopicImageStorage,
     NuclearMedicineImageStorage,
     UltrasoundImageStorage,
+    UltrasoundMultiFrameImageStorage,
     VLPhotographicImageStorage,
     VLEndoscopicImageStorage,
     VLMicroscopicImageStorage,
@@ -128,20 +746,198 @@ storage_sop_classes = [
     EncapsulatedCDAStorage,
 ]
 
-for sop_class in storage_sop_classes:
-    ae.add_supported_context(sop_class)
+def build_ae():
+    """Return an AE supporting all the services this SCP provides."""
+    # Initialize the Application Entity (AE)
+    ae = AE()
+
+    for sop_class in storage_sop_classes:
+        # Allow the peer to act as the Storage SCP for C-GET sub-operations
+        ae.add_supported_context(sop_class, scu_role=True, scp_role=True)
+
+    # Add supported presentation context for Verification SOP Class
+    ae.add_supported_context(Verification)
 
-# Add supported presentation context for Verification SOP Class
-ae.add_supported_context(Verification)
+    # Queries and retrieves are answered from the index so only offer them
+    # when there is one
+    if index_enabled:
+        ae.add_supported_context(PatientRootQueryRetrieveInformationModelFind)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+        ae.add_supported_context(PatientRootQueryRetrieveInformationModelGet)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelGet)
+        ae.add_supported_context(PatientRootQueryRetrieveInformationModelMove)
+        ae.add_supported_context(StudyRootQueryRetrieveInformationModelMove)
+
+    return ae
+
+def handle_established(event):
+    """Start counting what is received over a new association."""
+    metrics.association_started(event.assoc)
+    rejected = len(event.assoc.rejected_contexts)
+    if rejected:
+        metrics.inc('rejected_contexts_total', rejected)
+
+def handle_rejected(event):
+    """Count an association that was rejected."""
+    metrics.inc('associations_rejected_total')
+
+def handle_closed(event):
+    """Print what was received over an association once it has closed."""
+    totals = metrics.association_ended(event.assoc)
+    if totals and totals['instances']:
+        requestor = event.assoc.requestor
+        print(json.dumps({
+            'association': requestor.ae_title,
+            'address': requestor.address,
+            **totals,
+        }))
 
 # Define the handlers for the supported services
 handlers = [
     (evt.EVT_C_STORE, handle_store),
     (evt.EVT_C_ECHO, handle_echo),
+    (evt.EVT_C_FIND, handle_find),
+    (evt.EVT_C_GET, handle_get),
+    (evt.EVT_C_MOVE, handle_move),
+]
+
+# Only bound when metrics are enabled
+metrics_handlers = [
+    (evt.EVT_ESTABLISHED, handle_established),
+    (evt.EVT_REJECTED, handle_rejected),
+    (evt.EVT_CONN_CLOSE, handle_closed),
 ]
 
+class ReusePortServer(AssociationServer):
+    """Association server that shares its port with the other workers."""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def interrupt(signum, frame):
+    """Turn SIGTERM into a KeyboardInterrupt so the SCP shuts down cleanly."""
+    raise KeyboardInterrupt
+
 # AET, Port are loaded from ini file and IP is the host IP
 
-# Start the SCP
-print(f'Starting DICOM Storage SCP on {server_address}:{server_port} with AE title {ae_title}')
-ae.start_server((server_address, server_port), ae_title=ae_title, evt_handlers=handlers)
+def run_server(worker=None):
+    """Run the SCP in this process until it is interrupted.
+
+    worker is the worker number when running as one of several processes
+    sharing the port.
+    """
+    start_storage()
+    start_metrics(worker)
+    requeue_spooled(worker)
+    ae = build_ae()
+    evt_handlers = handlers + metrics_handlers if metrics else handlers
+
+    try:
+        if worker is None:
+            # Start the SCP
+            print(f'Starting DICOM Storage SCP on {server_address}:{server_port} with AE title {ae_title}')
+            ae.start_server((server_address, server_port), ae_title=ae_title, evt_handlers=evt_handlers)
+        else:
+            print(f'Starting DICOM Storage SCP worker {worker} (pid {os.getpid()})')
+            server = ae.make_server(
+                (server_address, server_port),
+                ae_title=ae_title,
+                evt_handlers=evt_handlers,
+                server_class=ReusePortServer,
+            )
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                server.server_close()
+    finally:
+        if worker is not None:
+            # Don't let a second signal interrupt writing what is queued
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        # Make sure everything that was acknowledged is written before exiting
+        stop_storage()
+
+def run_worker(worker):
+    """Entry point of each worker process."""
+    signal.signal(signal.SIGTERM, interrupt)
+    if config is None:
+        # Started with spawn, which imports the script again
+        load_config()
+    run_server(worker)
+
+def supervise(workers):
+    """Run workers SCP processes sharing the port, restarting any that exit.
+
+    A worker that exits within quick_exit seconds of starting is restarted
+    after a delay that doubles each time, up to max_restart_delay. After
+    max_quick_exits quick exits in a row the supervisor gives up, as the
+    workers are most likely failing to start.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        print('--workers needs SO_REUSEPORT, which is not available on this platform')
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, interrupt)
+    print(f'Starting {workers} DICOM Storage SCP workers on {server_address}:{server_port} with AE title {ae_title}')
+
+    processes = [None] * workers
+    started = [0.0] * workers
+    quick_exits = [0] * workers
+    restart_at = [0.0] * workers
+    failed = False
+    try:
+        while True:
+            now = time.monotonic()
+            for ii, process in enumerate(processes):
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    if now - started[ii] < quick_exit:
+                        quick_exits[ii] += 1
+                    else:
+                        quick_exits[ii] = 0
+                    if quick_exits[ii] >= max_quick_exits:
+                        print(f'Worker {ii} exited with code {process.exitcode} {quick_exits[ii]} times in a row '
+                              f'within {quick_exit:g}s of starting, giving up. Check the ini file and that '
+                              f'port {server_port} can be used')
+                        failed = True
+                        return
+                    delay = min(2 ** (quick_exits[ii] - 1), max_restart_delay) if quick_exits[ii] else 0
+                    print(f'Worker {ii} exited with code {process.exitcode}, restarting it in {delay:g}s')
+                    restart_at[ii] = now + delay
+                    processes[ii] = process = None
+                if now < restart_at[ii]:
+                    continue
+                process = multiprocessing.Process(target=run_worker, args=(ii,), name=f'scp-worker-{ii}')
+                process.start()
+                processes[ii] = process
+                started[ii] = now
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in processes:
+            if process is not None:
+                process.join()
+        if failed:
+            sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a DICOM Storage SCP.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of SCP processes sharing the port")
+    args = parser.parse_args()
+    load_config()
+
+    if args.workers > 1:
+        supervise(args.workers)
+    else:
+        signal.signal(signal.SIGTERM, interrupt)
+        run_server()
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,26 @@
 ################################################################################
 # Loads a DICOM image and allows the editing of the patient demographics
 # Alban Killingback Jul 2024
+#
+# Given a rules file and a folder it edits every DICOM file below the folder
+# without opening the GUI, see dicom_edit.py for the rules:
+#   python "EditDICOMtags v2_0.py" --rules fix_study.json studies
+#   python "EditDICOMtags v2_0.py" --rules fix_study.json studies --output-dir fixed --report edits.csv
+# --dry-run reports what would change without writing anything.
 ################################################################################
 
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from tkinter import ttk
 import pydicom
-from PIL import Image, ImageTk
 import os
+import sys
+import time
+import argparse
 import numpy as np
+import dicom_edit
 
 VERSION = "V2_0"
 
-def select_dicom_file():
-    file_path = filedialog.askopenfilename()
-    if file_path:
-        try:
-            global dicom_file
-            dicom_file = pydicom.dcmread(file_path)
-            update_fields(dicom_file)
-            display_image(dicom_file)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to read DICOM file: {e}")
-    else:
-        messagebox.showwarning("No file selected", "Please select a DICOM file.")
+# The DICOM file being edited
+dicom_file = None
 
 def ybr_to_rgb(ybr_image):
     ybr_image = ybr_image.astype(np.float32)
@@ -38,134 +34,196 @@ def ybr_to_rgb(ybr_image):
     rgb_image = np.clip(rgb_image, 0, 255).astype(np.uint8)
     return rgb_image
 
-def update_fields(dicom):
-    entry_patient_name.delete(0, tk.END)
-    entry_patient_name.insert(0, str(dicom.get('PatientName', '')))
+################################################################################
+# GUI
+################################################################################
 
-    entry_patient_id.delete(0, tk.END)
-    entry_patient_id.insert(0, str(dicom.get('PatientID', '')))
+def open_gui():
+    # Only the GUI needs tkinter
+    import tkinter as tk
+    from tkinter import filedialog, messagebox
+    from tkinter import ttk
+    from PIL import Image, ImageTk
+
+    def select_dicom_file():
+        file_path = filedialog.askopenfilename()
+        if file_path:
+            try:
+                global dicom_file
+                dicom_file = pydicom.dcmread(file_path)
+                update_fields(dicom_file)
+                display_image(dicom_file)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to read DICOM file: {e}")
+        else:
+            messagebox.showwarning("No file selected", "Please select a DICOM file.")
 
-    entry_patient_birthdate.delete(0, tk.END)
-    entry_patient_birthdate.insert(0, str(dicom.get('PatientBirthDate', '')))
+    def update_fields(dicom):
+        entry_patient_name.delete(0, tk.END)
+        entry_patient_name.insert(0, str(dicom.get('PatientName', '')))
 
-    entry_patient_sex.delete(0, tk.END)
-    entry_patient_sex.insert(0, str(dicom.get('PatientSex', '')))
+        entry_patient_id.delete(0, tk.END)
+        entry_patient_id.insert(0, str(dicom.get('PatientID', '')))
 
-    entry_modality.delete(0, tk.END)
-    entry_modality.insert(0, str(dicom.get('Modality', '')))
+        entry_patient_birthdate.delete(0, tk.END)
+        entry_patient_birthdate.insert(0, str(dicom.get('PatientBirthDate', '')))
 
-    entry_accession_number.delete(0, tk.END)
-    entry_accession_number.insert(0, str(dicom.get('AccessionNumber', '')))
+        entry_patient_sex.delete(0, tk.END)
+        entry_patient_sex.insert(0, str(dicom.get('PatientSex', '')))
 
-def display_image(dicom):
-    try:
-        if "NumberOfFrames" in dicom:
-            image_data = dicom.pixel_array[0]
-        else:
-            image_data = dicom.pixel_array
+        entry_modality.delete(0, tk.END)
+        entry_modality.insert(0, str(dicom.get('Modality', '')))
 
-        # Check the Photometric Interpretation
-        if dicom.PhotometricInterpretation == "YBR_FULL":
-            image = ybr_to_rgb(image_data)
-        elif dicom.PhotometricInterpretation in ["RGB", "MONOCHROME2", "MONOCHROME1"]:
-            image = Image.fromarray(image_data)
-        else:
-            raise ValueError(f"Unsupported Photometric Interpretation: {dicom.PhotometricInterpretation}")
-
-        # Resize the image to fit the GUI window, keeping aspect ratio
-        base_width = 500
-        w_percent = (base_width / float(image.size[0]))
-        h_size = int((float(image.size[1]) * float(w_percent)))
-        image = image.resize((base_width, h_size), Image.Resampling.LANCZOS)
-        photo = ImageTk.PhotoImage(image)
-
-        lbl_image.configure(image=photo)
-        lbl_image.image = photo
-    except Exception as e:
-        lbl_image.configure(text="Cannot load image")
-        messagebox.showerror("Error", f"Failed to display image: {e}")
-
-def save_dicom_file():
-    if dicom_file:
+        entry_accession_number.delete(0, tk.END)
+        entry_accession_number.insert(0, str(dicom.get('AccessionNumber', '')))
+
+    def display_image(dicom):
         try:
-            dicom_file.PatientName = entry_patient_name.get()
-            dicom_file.PatientID = entry_patient_id.get()
-            dicom_file.PatientBirthDate = entry_patient_birthdate.get()
-            dicom_file.PatientSex = entry_patient_sex.get()
-            dicom_file.Modality = entry_modality.get()
-            dicom_file.AccessionNumber = entry_accession_number.get()
-
-            save_path = filedialog.asksaveasfilename(defaultextension=".dcm")
-            if save_path:
-                dicom_file.save_as(save_path)
-                messagebox.showinfo("File Saved", f"File saved successfully as {save_path}")
+            if "NumberOfFrames" in dicom:
+                image_data = dicom.pixel_array[0]
             else:
-                messagebox.showwarning("Save cancelled", "Save operation cancelled.")
+                image_data = dicom.pixel_array
+
+            # Check the Photometric Interpretation
+            if dicom.PhotometricInterpretation == "YBR_FULL":
+                image = ybr_to_rgb(image_data)
+            elif dicom.PhotometricInterpretation in ["RGB", "MONOCHROME2", "MONOCHROME1"]:
+                image = Image.fromarray(image_data)
+            else:
+                raise ValueError(f"Unsupported Photometric Interpretation: {dicom.PhotometricInterpretation}")
+
+            # Resize the image to fit the GUI window, keeping aspect ratio
+            base_width = 500
+            w_percent = (base_width / float(image.size[0]))
+            h_size = int((float(image.size[1]) * float(w_percent)))
+            image = image.resize((base_width, h_size), Image.Resampling.LANCZOS)
+            photo = ImageTk.PhotoImage(image)
+
+            lbl_image.configure(image=photo)
+            lbl_image.image = photo
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to save DICOM file: {e}")
-    else:
-        messagebox.showwarning("No file loaded", "Please load a DICOM file first.")
+            lbl_image.configure(text="Cannot load image")
+            messagebox.showerror("Error", f"Failed to display image: {e}")
+
+    def save_dicom_file():
+        if dicom_file:
+            try:
+                # Only the header is written again, the pixel data is copied
+                # from the file as it is
+                header, pixel_offset = dicom_edit.open_for_edit(dicom_file.filename)
+                header.PatientName = entry_patient_name.get()
+                header.PatientID = entry_patient_id.get()
+                header.PatientBirthDate = entry_patient_birthdate.get()
+                header.PatientSex = entry_patient_sex.get()
+                header.Modality = entry_modality.get()
+                header.AccessionNumber = entry_accession_number.get()
+
+                save_path = filedialog.asksaveasfilename(defaultextension=".dcm")
+                if save_path:
+                    dicom_edit.write_edited(header, dicom_file.filename, save_path, pixel_offset)
+                    messagebox.showinfo("File Saved", f"File saved successfully as {save_path}")
+                else:
+                    messagebox.showwarning("Save cancelled", "Save operation cancelled.")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to save DICOM file: {e}")
+        else:
+            messagebox.showwarning("No file loaded", "Please load a DICOM file first.")
 
-def exit_application():
-    app.destroy()
+    def exit_application():
+        app.destroy()
 
-app = tk.Tk()
-app.title("DICOM Editor " + VERSION)
+    app = tk.Tk()
+    app.title("DICOM Editor " + VERSION)
 
-frame_image = ttk.Frame(app, padding="10")
-frame_image.grid(row=0, column=0, rowspan=7, padx=10, pady=5, sticky="nsew")
+    frame_image = ttk.Frame(app, padding="10")
+    frame_image.grid(row=0, column=0, rowspan=7, padx=10, pady=5, sticky="nsew")
 
-lbl_image = ttk.Label(frame_image, text="No Image Loaded")
-lbl_image.pack(expand=True)
+    lbl_image = ttk.Label(frame_image, text="No Image Loaded")
+    lbl_image.pack(expand=True)
 
-frame_info = ttk.Frame(app, padding="10")
-frame_info.grid(row=0, column=1, columnspan=2, padx=10, pady=5, sticky="nsew")
+    frame_info = ttk.Frame(app, padding="10")
+    frame_info.grid(row=0, column=1, columnspan=2, padx=10, pady=5, sticky="nsew")
 
-ttk.Label(frame_info, text="Patient Name:").grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
-entry_patient_name = ttk.Entry(frame_info)
-entry_patient_name.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+    ttk.Label(frame_info, text="Patient Name:").grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_patient_name = ttk.Entry(frame_info)
+    entry_patient_name.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
 
-ttk.Label(frame_info, text="Patient ID:").grid(row=1, column=0, padx=5, pady=5, sticky=tk.W)
-entry_patient_id = ttk.Entry(frame_info)
-entry_patient_id.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
+    ttk.Label(frame_info, text="Patient ID:").grid(row=1, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_patient_id = ttk.Entry(frame_info)
+    entry_patient_id.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
 
-ttk.Label(frame_info, text="Patient Birth Date (YYYYMMDD):").grid(row=2, column=0, padx=5, pady=5, sticky=tk.W)
-entry_patient_birthdate = ttk.Entry(frame_info)
-entry_patient_birthdate.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
+    ttk.Label(frame_info, text="Patient Birth Date (YYYYMMDD):").grid(row=2, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_patient_birthdate = ttk.Entry(frame_info)
+    entry_patient_birthdate.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
 
-ttk.Label(frame_info, text="Patient Sex (M/F):").grid(row=3, column=0, padx=5, pady=5, sticky=tk.W)
-entry_patient_sex = ttk.Entry(frame_info)
-entry_patient_sex.grid(row=3, column=1, padx=5, pady=5, sticky="ew")
+    ttk.Label(frame_info, text="Patient Sex (M/F):").grid(row=3, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_patient_sex = ttk.Entry(frame_info)
+    entry_patient_sex.grid(row=3, column=1, padx=5, pady=5, sticky="ew")
 
-ttk.Label(frame_info, text="Modality:").grid(row=4, column=0, padx=5, pady=5, sticky=tk.W)
-entry_modality = ttk.Entry(frame_info)
-entry_modality.grid(row=4, column=1, padx=5, pady=5, sticky="ew")
+    ttk.Label(frame_info, text="Modality:").grid(row=4, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_modality = ttk.Entry(frame_info)
+    entry_modality.grid(row=4, column=1, padx=5, pady=5, sticky="ew")
 
-ttk.Label(frame_info, text="Accession Number:").grid(row=5, column=0, padx=5, pady=5, sticky=tk.W)
-entry_accession_number = ttk.Entry(frame_info)
-entry_accession_number.grid(row=5, column=1, padx=5, pady=5, sticky="ew")
+    ttk.Label(frame_info, text="Accession Number:").grid(row=5, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_accession_number = ttk.Entry(frame_info)
+    entry_accession_number.grid(row=5, column=1, padx=5, pady=5, sticky="ew")
 
-frame_buttons = ttk.Frame(app, padding="10")
-frame_buttons.grid(row=6, column=1, columnspan=2, padx=10, pady=5, sticky="ew")
+    frame_buttons = ttk.Frame(app, padding="10")
+    frame_buttons.grid(row=6, column=1, columnspan=2, padx=10, pady=5, sticky="ew")
 
-style = ttk.Style()
-style.configure('TButton', font=('Helvetica', 12), padding=10)
-style.map('TButton', foreground=[('!active', 'black'), ('active', 'gray')],
-        background=[('!active', 'lightgray'), ('active', 'gray')],
-        relief=[('pressed', 'sunken'), ('!pressed', 'raised')])
+    style = ttk.Style()
+    style.configure('TButton', font=('Helvetica', 12), padding=10)
+    style.map('TButton', foreground=[('!active', 'black'), ('active', 'gray')],
+            background=[('!active', 'lightgray'), ('active', 'gray')],
+            relief=[('pressed', 'sunken'), ('!pressed', 'raised')])
 
-btn_select = ttk.Button(frame_buttons, text="Select DICOM File", command=select_dicom_file)
-btn_select.pack(side=tk.LEFT, padx=10, pady=20)
+    btn_select = ttk.Button(frame_buttons, text="Select DICOM File", command=select_dicom_file)
+    btn_select.pack(side=tk.LEFT, padx=10, pady=20)
 
-btn_save = ttk.Button(frame_buttons, text="Save DICOM File", command=save_dicom_file)
-btn_save.pack(side=tk.LEFT, padx=10, pady=20)
+    btn_save = ttk.Button(frame_buttons, text="Save DICOM File", command=save_dicom_file)
+    btn_save.pack(side=tk.LEFT, padx=10, pady=20)
 
-btn_exit = ttk.Button(frame_buttons, text="Exit", command=exit_application)
-btn_exit.pack(side=tk.LEFT, padx=10, pady=20)
+    btn_exit = ttk.Button(frame_buttons, text="Exit", command=exit_application)
+    btn_exit.pack(side=tk.LEFT, padx=10, pady=20)
 
-dicom_file = None
+    app.columnconfigure(1, weight=1)
+    frame_info.columnconfigure(1, weight=1)
+
+    app.mainloop()
 
-app.columnconfigure(1, weight=1)
-frame_info.columnconfigure(1, weight=1)
+def edit_folder(args):
+    """Apply a rules file to a folder from the command line."""
+    try:
+        rules = dicom_edit.load_rules(args.rules)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Unable to load {args.rules}: {e}')
+
+    start = time.perf_counter()
+    counts = dicom_edit.edit_folder(rules, args.folder, args.output_dir, args.processes, args.dry_run, args.report)
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items()))
+    print(f"{'Checked' if args.dry_run else 'Processed'} {total} files in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-6):.0f} files/s): {summary or 'no files'}")
+    if counts.get('failed'):
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Edit DICOM tags, in a GUI or with a rules file.")
+    parser.add_argument("folder", nargs='?', help="Folder of DICOM files to apply the rules to")
+    parser.add_argument("--rules", help="JSON file of rules, see dicom_edit.py")
+    parser.add_argument("--output-dir", help="Write the files here instead of editing them in place")
+    parser.add_argument("--processes", type=int, help="Number of processes, defaults to the CPU count")
+    parser.add_argument("--report", help="CSV file with the result of every file")
+    parser.add_argument("--dry-run", action="store_true", help="Report the changes without writing any files")
+    args = parser.parse_args()
+
+    if args.rules or args.folder:
+        if not (args.rules and args.folder):
+            parser.error('give both --rules and a folder')
+        edit_folder(args)
+    else:
+        open_gui()
 
-app.mainloop()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+################################################################################
+# asyncio interface to the query/retrieve client and a Storage SCP
+#
+# pynetdicom is blocking, so every request runs on a thread of an executor
+# owned by AsyncRemoteAE and its results are handed back to the event loop.
+# Any number of coroutines can make requests at the same time, they queue for
+# the executor's threads and then for the associations of the RemoteAE's pool.
+# Each call takes a timeout in seconds and can be cancelled, either way the
+# request's association is aborted the next time the PACS answers rather
+# than being put back in the pool:
+#
+#   async with AsyncRemoteAE(RemoteAE('PACS', '10.0.0.5', 104, pool)) as pacs:
+#       studies = await pacs.find(query, model='study', timeout=30)
+#       async for identifier in pacs.iter_find(query, model='study'):
+#           print(identifier.StudyInstanceUID)
+#       async for status in pacs.iter_get(query, store, model='study'):
+#           print(status.get('NumberOfRemainingSuboperations'))
+#
+#   async with AsyncStoreSCP('MY_SCP', 11112, make_layout('patient', 'store')) as scp:
+#       async for stored in scp.events():
+#           print(stored.sop_instance_uid, stored.path)
+################################################################################
+
+import os
+import asyncio
+import tempfile
+import threading
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pynetdicom import AE, evt, _config, StoragePresentationContexts
+from dicom_storage import read_header, move_into_place
+
+LOGGER = logging.getLogger('dicom_async')
+
+_DONE = object()
+
+# What AsyncStoreSCP.events() yields for every instance stored
+StoredInstance = collections.namedtuple(
+    'StoredInstance', ['path', 'sop_class_uid', 'sop_instance_uid', 'calling_ae', 'size']
+)
+
+
+class _Deadline:
+    """Seconds left of an optional timeout."""
+
+    def __init__(self, loop, timeout):
+        self.loop = loop
+        self.end = None if timeout is None else loop.time() + timeout
+
+    def remaining(self):
+        if self.end is None:
+            return None
+        remaining = self.end - self.loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        return remaining
+
+
+def _call_soon(loop, callback, *args):
+    """Run callback on loop from another thread, unless loop has been closed."""
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass
+
+
+class AsyncRemoteAE:
+    """Awaitable echo, find, get and move on a dicom_query RemoteAE.
+
+    The requests run on up to max_workers threads, by default twice the
+    size of the RemoteAE's association pool.
+    """
+
+    def __init__(self, remote, max_workers=None):
+        self.remote = remote
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or 2 * remote.pool.max_size,
+            thread_name_prefix='dicom_async',
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the executor, requests still running are left to finish."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def echo(self, timeout=None):
+        """Send a C-ECHO and return the status."""
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self.executor, self.remote.echo), timeout)
+
+    async def find(self, identifier, model='patient', use_cache=True, timeout=None):
+        """Return the list of identifiers matching a C-FIND identifier."""
+        return [match async for match in self.iter_find(identifier, model, use_cache, timeout)]
+
+    def iter_find(self, identifier, model='patient', use_cache=True, timeout=None):
+        """Yield the identifiers matching a C-FIND identifier as they arrive."""
+        def run(put, cancelled):
+            matches = self.remote.find(identifier, model=model, use_cache=use_cache)
+            try:
+                for match in matches:
+                    put(match)
+            finally:
+                # Aborts the association if the matches weren't all read
+                matches.close()
+        return self._iterate(run, timeout)
+
+    async def get(self, identifier, store, model='patient', timeout=None):
+        """Retrieve with C-GET and return the final status.
+
+        store is called on the association's thread with every EVT_C_STORE
+        event and returns the C-STORE status, so it must not block for long.
+        """
+        status = None
+        async for status in self.iter_get(identifier, store, model, timeout):
+            pass
+        return status
+
+    def iter_get(self, identifier, store, model='patient', timeout=None):
+        """Yield the pending C-GET statuses as they arrive, then the final one."""
+        def run(put, cancelled):
+            def store_unless_cancelled(event):
+                if cancelled.is_set():
+                    event.assoc.abort()
+                    return 0xA700  # Out of resources
+                return store(event)
+            put(self.remote.get(identifier, store_unless_cancelled, model=model, progress=put))
+        return self._iterate(run, timeout)
+
+    async def move(self, identifier, destination, model='patient', timeout=None):
+        """Ask the remote AE to send to destination and return the final status."""
+        status = None
+        async for status in self.iter_move(identifier, destination, model, timeout):
+            pass
+        return status
+
+    def iter_move(self, identifier, destination, model='patient', timeout=None):
+        """Yield the pending C-MOVE statuses as they arrive, then the final one."""
+        def run(put, cancelled):
+            put(self.remote.move(identifier, destination, model=model, progress=put))
+        return self._iterate(run, timeout)
+
+    async def _iterate(self, run, timeout):
+        """Yield the items run(put, cancelled) puts on an executor thread.
+
+        cancelled is a threading.Event set once the caller stops iterating,
+        is cancelled or times out, after which put() raises to stop run().
+        """
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def put(item):
+            if cancelled.is_set():
+                raise _Cancelled()
+            _call_soon(loop, items.put_nowait, (item, None))
+
+        def produce():
+            if cancelled.is_set():
+                # Cancelled or timed out while waiting for a thread
+                return
+            try:
+                run(put, cancelled)
+            except _Cancelled:
+                pass
+            except BaseException as e:
+                _call_soon(loop, items.put_nowait, (_DONE, e))
+                return
+            _call_soon(loop, items.put_nowait, (_DONE, None))
+
+        deadline = _Deadline(loop, timeout)
+        loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                item, error = await asyncio.wait_for(items.get(), deadline.remaining())
+                if item is _DONE:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            cancelled.set()
+
+
+class _Cancelled(Exception):
+    """Raised on the producer thread to stop a request no one is waiting for."""
+
+
+class AsyncStoreSCP:
+    """A Storage SCP whose stored instances can be awaited.
+
+    Every instance received is written to a spool file in the .incoming
+    folder of layout's root and renamed into place on the association's
+    thread, then a StoredInstance is passed to each events() iterator.
+    No process wide settings are changed. If the caller turns on pynetdicom's
+    STORE_RECV_CHUNKED_DATASET data sets go straight to disk as they arrive,
+    so large instances aren't held in memory, but pynetdicom then writes them
+    to tempfile's folder, which should be on the same disk as layout's root.
+    """
+
+    def __init__(self, ae_title, port, layout, address=''):
+        self.ae_title = ae_title
+        self.port = int(port)
+        self.address = address
+        self.layout = layout
+        self.spool = os.path.join(layout.root, '.incoming')
+        self.server = None
+        self._loop = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def start(self):
+        """Start listening for associations."""
+        self._loop = asyncio.get_running_loop()
+        os.makedirs(self.spool, exist_ok=True)
+
+        ae = AE(ae_title=self.ae_title)
+        for context in StoragePresentationContexts:
+            ae.add_supported_context(context.abstract_syntax)
+        self.server = await self._loop.run_in_executor(
+            None,
+            lambda: ae.start_server(
+                (self.address, self.port), block=False, evt_handlers=[(evt.EVT_C_STORE, self._store)]
+            ),
+        )
+
+    async def stop(self):
+        """Stop listening and end every events() iterator."""
+        if self.server is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.server.shutdown)
+            self.server = None
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for queue in subscribers:
+            queue.put_nowait(_DONE)
+
+    async def events(self):
+        """Yield a StoredInstance for every instance stored from now on."""
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers.add(queue)
+        try:
+            while True:
+                stored = await queue.get()
+                if stored is _DONE:
+                    return
+                yield stored
+        finally:
+            with self._lock:
+                self._subscribers.discard(queue)
+
+    def _received_file(self, event):
+        """Return the path of a file holding the data set as it was received."""
+        if _config.STORE_RECV_CHUNKED_DATASET:
+            # Already written by pynetdicom
+            return event.dataset_path
+        fd, path = tempfile.mkstemp(suffix='.dcm', dir=self.spool)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(event.encoded_dataset())
+        return path
+
+    def _store(self, event):
+        """Handle a C-STORE request on the association's thread."""
+        path = None
+        try:
+            path = self._received_file(event)
+            ds = read_header(path, self.layout.tags)
+            filename = self.layout.path_for(ds)
+            size = os.path.getsize(path)
+            move_into_place(path, filename)
+        except Exception:
+            LOGGER.exception(f'Unable to store {event.request.AffectedSOPInstanceUID}')
+            if path and not _config.STORE_RECV_CHUNKED_DATASET:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return 0xA700  # Out of resources
+
+        stored = StoredInstance(
+            filename,
+            event.request.AffectedSOPClassUID,
+            event.request.AffectedSOPInstanceUID,
+            event.assoc.requestor.ae_title,
+            size,
+        )
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for queue in subscribers:
+            _call_soon(self._loop, queue.put_nowait, stored)
+        return 0x0000  # Success status
@@ -0,0 +1,415 @@
+################################################################################
+# Rules based tag editing of DICOM files
+#
+# The engine behind "EditDICOMtags v2_0.py" when it is given a rules file. The
+# rules are a JSON list applied in order to every file below a folder, each
+# rule with optional conditions on other tags and the edits to make when they
+# hold:
+#   [
+#     {"where": {"StudyInstanceUID": "1.2.3.4"},
+#      "set": {"PatientID": "H000123", "PatientName": "Smith^John"}},
+#     {"where_match": {"InstitutionName": "(?i)old.*"},
+#      "replace": {"InstitutionName": ["Old", "New"]}},
+#     {"regex": {"AccessionNumber": ["^ACC0*", "A"]}},
+#     {"delete": ["OtherPatientIDs", "(0010,1000)"]}
+#   ]
+# Tags are keywords, "(gggg,eeee)" or "ggggeeee". A where value is compared
+# with the tag's value as text, a list of values matches any of them and null
+# matches a tag that isn't there. where_match takes a regular expression that
+# has to match the whole value. set creates or overwrites a tag, replace
+# replaces text within a value, regex substitutes with re.sub and delete
+# removes tags. Only the top level data set is edited, not the file meta
+# information, sequences or the pixel data, though setting SOPInstanceUID or
+# SOPClassUID updates the file meta to match.
+# Each file is read up to its pixel data and only that header is written
+# again, in the file's own transfer syntax, the pixel data and anything after
+# it being copied from the original file byte for byte with
+# copy_file_range() or sendfile() where the platform has them. Only files
+# with the deflated transfer syntax, which can't be split, are read and
+# written in full. Edited files are written under a temporary name, then
+# renamed over the original or into the output folder. Files the rules
+# don't change aren't written. edit_folder() runs over the files on a pool of processes and
+# reports the result of every file.
+################################################################################
+
+import os
+import re
+import csv
+import json
+import shutil
+import struct
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pydicom import dcmread
+from pydicom.datadict import dictionary_VR, keyword_for_tag
+from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+LOGGER = logging.getLogger('dicom_edit')
+
+ACTIONS = ('set', 'replace', 'regex', 'delete')
+CONDITIONS = ('where', 'where_match')
+
+REPORT_COLUMNS = ['Path', 'Output', 'Status', 'Changes']
+
+# Values larger than this are left in the file until the file is written
+DEFER_SIZE = 1024
+
+# Elements of Float, Double Float and plain Pixel Data in group 7FE0
+_PIXEL_ELEMENTS = (0x0008, 0x0009, 0x0010)
+
+# Bytes read at a time by the buffered copy and copied by each system call
+_COPY_SIZE = 1024 * 1024
+_CHUNK_SIZE = 1024 * 1024 * 1024
+
+# Value representations held as numbers rather than text
+_INT_VRS = ('US', 'SS', 'UL', 'SL', 'UV', 'SV')
+_FLOAT_VRS = ('FL', 'FD')
+_BINARY_VRS = ('OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN', 'SQ', 'AT')
+
+# File meta information kept the same as the data set
+_META_TAGS = {
+    Tag('SOPInstanceUID'): 'MediaStorageSOPInstanceUID',
+    Tag('SOPClassUID'): 'MediaStorageSOPClassUID',
+}
+
+
+def parse_tag(name):
+    """Return the Tag for a keyword, "(gggg,eeee)" or "ggggeeee"."""
+    text = name.strip()
+    match = re.fullmatch(r'\(?([0-9A-Fa-f]{4}),?([0-9A-Fa-f]{4})\)?', text)
+    try:
+        tag = Tag(int(match.group(1), 16), int(match.group(2), 16)) if match else Tag(text)
+    except ValueError:
+        raise ValueError(f"Unknown tag '{name}'")
+    if tag.group == 0x0002 or tag >= 0x7FE00000:
+        raise ValueError(f"{name} can't be edited, only tags of the data set in front of the pixel data")
+    return tag
+
+
+def _text(elem):
+    """Return the value of a data element as text, multiple values joined by \\."""
+    if elem is None:
+        return None
+    value = elem.value
+    if value is None:
+        return ''
+    if isinstance(value, MultiValue):
+        return '\\'.join(str(item) for item in value)
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return str(value)
+
+
+class Rule:
+    """Conditions on a data set and the edits made when they hold."""
+
+    def __init__(self, number, spec):
+        self.number = number
+        if not isinstance(spec, dict):
+            raise ValueError(f'Rule {number} is not an object')
+        unknown = set(spec) - set(ACTIONS) - set(CONDITIONS)
+        if unknown:
+            raise ValueError(f"Rule {number} has unknown keys {', '.join(sorted(unknown))}, "
+                             f"use {', '.join(CONDITIONS + ACTIONS)}")
+
+        self.where = []
+        for name, value in spec.get('where', {}).items():
+            values = value if isinstance(value, list) else [value]
+            self.where.append((parse_tag(name), [None if item is None else str(item) for item in values]))
+        self.where_match = [(parse_tag(name), re.compile(pattern))
+                            for name, pattern in spec.get('where_match', {}).items()]
+
+        # (action, tag, arguments) in the order they appear in the rule
+        self.actions = []
+        for action in [key for key in spec if key in ACTIONS]:
+            if action == 'delete':
+                names = spec[action] if isinstance(spec[action], list) else [spec[action]]
+                self.actions += [(action, parse_tag(name), None) for name in names]
+                continue
+            for name, value in spec[action].items():
+                tag = parse_tag(name)
+                if action == 'set':
+                    if value is None:
+                        raise ValueError(f'Rule {number}: set {name} to null, use delete to remove it')
+                    self.actions.append((action, tag, str(value)))
+                    continue
+                if not isinstance(value, list) or len(value) != 2:
+                    raise ValueError(f'Rule {number}: {action} of {name} needs [old, new]')
+                old, new = str(value[0]), str(value[1])
+                self.actions.append((action, tag, (re.compile(old) if action == 'regex' else old, new)))
+        if not self.actions:
+            raise ValueError(f'Rule {number} has nothing to do, give one of {", ".join(ACTIONS)}')
+
+    def matches(self, ds):
+        """Return True if every condition of the rule holds for ds."""
+        for tag, values in self.where:
+            if _text(ds.get(tag)) not in values:
+                return False
+        for tag, pattern in self.where_match:
+            value = _text(ds.get(tag))
+            if value is None or not pattern.fullmatch(value):
+                return False
+        return True
+
+    def apply(self, ds):
+        """Edit ds if the rule matches and return [(tag, old, new)] of the changes."""
+        if not self.matches(ds):
+            return []
+        changes = []
+        for action, tag, arguments in self.actions:
+            old = _text(ds.get(tag))
+            if action == 'delete':
+                if old is None:
+                    continue
+                del ds[tag]
+                new = None
+            elif action == 'set':
+                new = arguments
+            elif old is None:
+                # Nothing to replace in a tag that isn't there
+                continue
+            elif action == 'replace':
+                new = old.replace(*arguments)
+            else:
+                pattern, replacement = arguments
+                new = pattern.sub(replacement, old)
+            if new == old:
+                continue
+            if new is not None:
+                _set_value(ds, tag, new)
+            changes.append((tag, old, new))
+        return changes
+
+
+def _set_value(ds, tag, text):
+    """Set tag of ds to text, adding the element if it isn't there."""
+    if tag in ds:
+        vr = ds[tag].VR
+    else:
+        try:
+            vr = dictionary_VR(tag)
+        except KeyError:
+            raise ValueError(f'{tag} is not in the DICOM dictionary, its VR is unknown')
+    if vr in _BINARY_VRS:
+        raise ValueError(f'{_keyword(tag)} has VR {vr}, which can\'t be set from text')
+
+    value = text
+    if vr in _INT_VRS + _FLOAT_VRS:
+        convert = int if vr in _INT_VRS else float
+        values = [convert(item) for item in text.split('\\')] if text else []
+        value = values[0] if len(values) == 1 else values
+    if tag in ds:
+        ds[tag].value = value
+    else:
+        ds.add_new(tag, vr, value)
+    if tag in _META_TAGS and getattr(ds, 'file_meta', None) is not None:
+        setattr(ds.file_meta, _META_TAGS[tag], text)
+
+
+def load_rules(filename):
+    """Return the Rules in a JSON rules file."""
+    with open(filename, encoding='utf-8') as f:
+        specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = [specs]
+    return [Rule(number, spec) for number, spec in enumerate(specs, 1)]
+
+
+def describe(changes):
+    """Return changes as one line of text."""
+    parts = []
+    for tag, old, new in changes:
+        name = _keyword(tag)
+        if new is None:
+            parts.append(f'{name} deleted')
+        elif old is None:
+            parts.append(f'{name} = {new!r}')
+        else:
+            parts.append(f'{name} {old!r} -> {new!r}')
+    return '; '.join(parts)
+
+
+def _keyword(tag):
+    return keyword_for_tag(tag) or str(tag)
+
+
+def open_for_edit(path):
+    """Read path for editing and return (data set, offset of the pixel data).
+
+    The data set holds the elements in front of the pixel data, which stay
+    in the file, and the offset is where the Pixel Data element starts. If
+    the file has no pixel data the offset is the file's size. The offset is
+    None when the header can't be rewritten on its own, for the deflated
+    transfer syntax, and the data set then holds every element with the
+    large values left in the file until it is written.
+    """
+    with open(path, 'rb') as f:
+        ds = dcmread(f, defer_size=DEFER_SIZE, stop_before_pixels=True)
+        offset = f.tell()
+        if ds.file_meta.get('TransferSyntaxUID') != DeflatedExplicitVRLittleEndian:
+            f.seek(offset)
+            tag = f.read(4)
+            if not tag:
+                return ds, offset
+            group, element = struct.unpack('<HH' if ds.original_encoding[1] else '>HH', tag)
+            if group == 0x7FE0 and element in _PIXEL_ELEMENTS:
+                return ds, offset
+    LOGGER.debug(f'Rewriting the whole of {path}')
+    return dcmread(path, defer_size=DEFER_SIZE), None
+
+
+def write_edited(ds, path, output_path, pixel_offset):
+    """Write the edited ds from open_for_edit() to output_path.
+
+    The header is written from ds and the rest of path, from pixel_offset
+    on, is copied after it as it is, so the pixel data is never decoded or
+    re-encoded. With no pixel_offset the whole data set is written. Either
+    way the file is written under a temporary name and renamed once done.
+    """
+    partial = f'{output_path}.{os.getpid()}.part'
+    try:
+        with open(partial, 'wb') as target:
+            ds.save_as(target, enforce_file_format=False)
+            if pixel_offset is not None:
+                with open(path, 'rb') as source:
+                    copy_range(source, target, pixel_offset)
+        os.replace(partial, output_path)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+def copy_range(source, target, offset):
+    """Append the bytes of source from offset to its end to target.
+
+    Uses copy_file_range(), which some file systems turn into a reflink or a
+    server side copy, then sendfile() and then a buffered copy, whichever
+    the platform and file systems support.
+    """
+    target.flush()
+    source_fd, target_fd = source.fileno(), target.fileno()
+    end = os.fstat(source_fd).st_size
+    # Position in target of the byte at offset 0 in source
+    shift = os.lseek(target_fd, 0, os.SEEK_CUR) - offset
+    for copy in _COPIES:
+        position = os.lseek(target_fd, 0, os.SEEK_CUR) - shift
+        try:
+            while position < end:
+                copied = copy(source_fd, target_fd, position, min(end - position, _CHUNK_SIZE))
+                if copied == 0:
+                    break
+                position += copied
+        except OSError as e:
+            # Not supported by this file system, go on from where it stopped
+            LOGGER.debug(f'{copy.__name__} failed: {e}')
+            continue
+        if position >= end:
+            return
+    source.seek(os.lseek(target_fd, 0, os.SEEK_CUR) - shift)
+    target.seek(0, os.SEEK_END)
+    shutil.copyfileobj(source, target, _COPY_SIZE)
+
+
+def _copy_file_range(source_fd, target_fd, offset, count):
+    return os.copy_file_range(source_fd, target_fd, count, offset)
+
+
+def _sendfile(source_fd, target_fd, offset, count):
+    return os.sendfile(target_fd, source_fd, offset, count)
+
+
+# The copies copy_range() tries before a buffered copy
+_COPIES = [copy for name, copy in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile))
+           if hasattr(os, name)]
+
+
+def edit_file(path, rules, output_path=None, dry_run=False):
+    """Apply rules to the file at path and return (status, changes).
+
+    The edited file is written to output_path, or over path if not given.
+    An unchanged file is copied to output_path. With dry_run nothing is
+    written.
+    """
+    output_path = output_path or path
+    try:
+        ds, pixel_offset = open_for_edit(path)
+    except InvalidDicomError:
+        return 'skipped: not a DICOM file', []
+
+    changes = []
+    for rule in rules:
+        changes += rule.apply(ds)
+
+    if not dry_run:
+        if output_path != path:
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        if changes:
+            write_edited(ds, path, output_path, pixel_offset)
+        elif output_path != path:
+            shutil.copy2(path, output_path)
+    return ('edited' if changes else 'unchanged'), changes
+
+
+def find_files(folder):
+    """Yield the paths of the files below folder."""
+    for directory, subdirs, filenames in os.walk(folder):
+        subdirs.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith('.part'):
+                yield os.path.join(directory, filename)
+
+
+# The rules of a pool process, set by _init_worker()
+_rules = None
+
+
+def _init_worker(rules):
+    global _rules
+    _rules = rules
+
+
+def _edit(job):
+    """Edit one file in a pool process and return (path, output, status, changes)."""
+    path, output_path, dry_run = job
+    try:
+        status, changes = edit_file(path, _rules, output_path, dry_run)
+    except Exception as e:
+        return path, output_path, f'failed: {type(e).__name__}: {e}', ''
+    return path, output_path, status, describe(changes)
+
+
+def edit_folder(rules, folder, output_dir=None, processes=None, dry_run=False, report=None):
+    """Apply rules to every file below folder and return the count of each status.
+
+    Files are edited in place unless output_dir is given, which gets the
+    folder's tree with every DICOM file in it. report is a CSV file name for
+    a line per file.
+    """
+    jobs = []
+    for path in find_files(folder):
+        output_path = os.path.join(output_dir, os.path.relpath(path, folder)) if output_dir else path
+        jobs.append((path, output_path, dry_run))
+
+    counts = {}
+    report_file = open(report, 'w', newline='', encoding='utf-8') if report else None
+    try:
+        writer = csv.writer(report_file) if report_file else None
+        if writer:
+            writer.writerow(REPORT_COLUMNS)
+        chunksize = max(1, min(32, len(jobs) // (8 * (processes or os.cpu_count() or 1))))
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(rules,)) as pool:
+            for path, output_path, status, changes in pool.map(_edit, jobs, chunksize=chunksize):
+                kind = status.split(':')[0]
+                counts[kind] = counts.get(kind, 0) + 1
+                if kind == 'failed':
+                    LOGGER.error(f'{path}: {status}')
+                if writer:
+                    writer.writerow([path, output_path, status, changes])
+    finally:
+        if report_file:
+            report_file.close()
+    return counts
@@ -0,0 +1,632 @@
+################################################################################
+# SQLite index of stored DICOM instances
+#
+# The Store SCP adds every instance it writes to the index so questions like
+# "what do we have for patient X" are an indexed query rather than a walk over
+# the storage folder. The index holds patient, study, series and instance
+# tables with the file path, size, transfer syntax, time received and a hash
+# of the data set as it was received.
+# find() answers C-FIND identifiers from the index so the SCP can act as a
+# Query SCP without opening any files, find_instances() returns the files to
+# send for a C-GET or C-MOVE.
+#
+# Run from the command line to rebuild the index from an existing folder:
+#   python dicom_index.py dicom_storage
+#   python dicom_index.py dicom_storage --database index.sqlite --processes 8
+################################################################################
+
+import os
+import sys
+import time
+import queue
+import sqlite3
+import argparse
+import datetime
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
+
+LOGGER = logging.getLogger('dicom_index')
+
+DEFAULT_DATABASE = 'index.sqlite'
+
+# (column, DICOM keyword) for each table, the first column is the key
+PATIENT_COLUMNS = [
+    ('patient_id', 'PatientID'),
+    ('patient_name', 'PatientName'),
+    ('patient_birth_date', 'PatientBirthDate'),
+    ('patient_sex', 'PatientSex'),
+]
+STUDY_COLUMNS = [
+    ('study_uid', 'StudyInstanceUID'),
+    ('patient_id', 'PatientID'),
+    ('study_date', 'StudyDate'),
+    ('study_time', 'StudyTime'),
+    ('accession_number', 'AccessionNumber'),
+    ('study_id', 'StudyID'),
+    ('study_description', 'StudyDescription'),
+    ('referring_physician_name', 'ReferringPhysicianName'),
+]
+SERIES_COLUMNS = [
+    ('series_uid', 'SeriesInstanceUID'),
+    ('study_uid', 'StudyInstanceUID'),
+    ('modality', 'Modality'),
+    ('series_number', 'SeriesNumber'),
+    ('series_description', 'SeriesDescription'),
+    ('series_date', 'SeriesDate'),
+]
+INSTANCE_COLUMNS = [
+    ('sop_instance_uid', 'SOPInstanceUID'),
+    ('series_uid', 'SeriesInstanceUID'),
+    ('sop_class_uid', 'SOPClassUID'),
+    ('instance_number', 'InstanceNumber'),
+]
+# Instance columns that don't come from a DICOM element
+FILE_COLUMNS = ['transfer_syntax_uid', 'path', 'size', 'received', 'content_hash']
+# Columns left as they are when a record updating an instance doesn't know them
+_KEEP_IF_NULL = {'content_hash'}
+
+TABLES = {
+    'patient': PATIENT_COLUMNS,
+    'study': STUDY_COLUMNS,
+    'series': SERIES_COLUMNS,
+    'instance': INSTANCE_COLUMNS,
+}
+
+# Every tag that has to be read from a file to index it
+INDEX_TAGS = sorted({
+    keyword for columns in TABLES.values() for _, keyword in columns
+})
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patient (
+    patient_id TEXT PRIMARY KEY,
+    patient_name TEXT,
+    patient_birth_date TEXT,
+    patient_sex TEXT
+);
+CREATE TABLE IF NOT EXISTS study (
+    study_uid TEXT PRIMARY KEY,
+    patient_id TEXT,
+    study_date TEXT,
+    study_time TEXT,
+    accession_number TEXT,
+    study_id TEXT,
+    study_description TEXT,
+    referring_physician_name TEXT
+);
+CREATE TABLE IF NOT EXISTS series (
+    series_uid TEXT PRIMARY KEY,
+    study_uid TEXT,
+    modality TEXT,
+    series_number INTEGER,
+    series_description TEXT,
+    series_date TEXT
+);
+CREATE TABLE IF NOT EXISTS instance (
+    sop_instance_uid TEXT PRIMARY KEY,
+    series_uid TEXT,
+    sop_class_uid TEXT,
+    instance_number INTEGER,
+    transfer_syntax_uid TEXT,
+    path TEXT,
+    size INTEGER,
+    received TEXT,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS study_patient ON study (patient_id);
+CREATE INDEX IF NOT EXISTS study_date ON study (study_date);
+CREATE INDEX IF NOT EXISTS study_accession ON study (accession_number);
+CREATE INDEX IF NOT EXISTS series_study ON series (study_uid);
+CREATE INDEX IF NOT EXISTS instance_series ON instance (series_uid);
+"""
+
+_STOP = object()
+
+
+def connect(database):
+    """Open the index at database, creating the tables if needed."""
+    conn = sqlite3.connect(database, timeout=30)
+    # WAL lets readers carry on while the SCP is writing
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+
+    # Indexes created before content_hash was added
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(instance)')]
+    if 'content_hash' not in columns:
+        try:
+            conn.execute('ALTER TABLE instance ADD COLUMN content_hash TEXT')
+        except sqlite3.OperationalError:
+            # Another process added it first
+            pass
+    return conn
+
+
+def _value(ds, keyword):
+    value = ds.get(keyword)
+    if value is None or value == '':
+        return None
+    if keyword in ('SeriesNumber', 'InstanceNumber'):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    return str(value)
+
+
+def record_from_dataset(ds, path, received=None, content_hash=None):
+    """Return the index record for the instance ds stored at path.
+
+    ds only needs to hold INDEX_TAGS and the file meta, pixel data is never
+    touched. content_hash is the dicom_storage.dataset_hash() of the data set
+    as received, if known.
+    """
+    if received is None:
+        received = datetime.datetime.now()
+
+    record = {keyword: _value(ds, keyword) for keyword in INDEX_TAGS}
+    file_meta = getattr(ds, 'file_meta', None)
+    record['transfer_syntax_uid'] = str(file_meta.get('TransferSyntaxUID', '')) if file_meta else None
+    record['path'] = os.path.abspath(path)
+    record['size'] = os.path.getsize(path)
+    record['received'] = received.isoformat(timespec='seconds')
+    record['content_hash'] = content_hash
+    return record
+
+
+def _upsert_sql(table, columns):
+    names = ', '.join(columns)
+    marks = ', '.join('?' * len(columns))
+    updates = ', '.join(
+        f'{column} = COALESCE(excluded.{column}, {table}.{column})' if column in _KEEP_IF_NULL
+        else f'{column} = excluded.{column}'
+        for column in columns[1:]
+    )
+    return (f'INSERT INTO {table} ({names}) VALUES ({marks}) '
+            f'ON CONFLICT ({columns[0]}) DO UPDATE SET {updates}')
+
+
+_UPSERTS = {
+    table: _upsert_sql(
+        table,
+        [column for column, _ in columns] + (FILE_COLUMNS if table == 'instance' else []),
+    )
+    for table, columns in TABLES.items()
+}
+
+
+def write_records(conn, records):
+    """Add or update records in a single transaction."""
+    rows = {table: [] for table in TABLES}
+    for record in records:
+        for table, columns in TABLES.items():
+            row = [record.get(keyword) for _, keyword in columns]
+            if table == 'instance':
+                row += [record.get(column) for column in FILE_COLUMNS]
+            rows[table].append(row)
+
+    with conn:
+        for table, table_rows in rows.items():
+            conn.executemany(_UPSERTS[table], table_rows)
+
+
+class InstanceIndex:
+    """Index kept up to date by a background thread.
+
+    add() only queues the record, the thread writes queued records to the
+    database in transactions of up to batch_size records, waiting no longer
+    than batch_latency seconds before committing a partial batch.
+    """
+
+    def __init__(self, database, batch_size=200, batch_latency=0.5):
+        self.database = database
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+
+        connect(database).close()
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='index-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, record):
+        self._queue.put(record)
+
+    def depth(self):
+        """Return the number of records waiting to be written."""
+        return self._queue.qsize()
+
+    def lookup(self, sop_instance_uid):
+        """Return (content hash, path) of a stored instance or None.
+
+        Records still waiting in the queue are not seen. Each calling thread
+        gets its own read connection.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = connect(self.database)
+        return conn.execute(
+            'SELECT content_hash, path FROM instance WHERE sop_instance_uid = ?',
+            (sop_instance_uid,),
+        ).fetchone()
+
+    def close(self):
+        """Write everything still queued and stop the background thread."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        conn = connect(self.database)
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_latency
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            if _STOP in batch:
+                batch.remove(_STOP)
+                stopping = True
+
+            try:
+                write_records(conn, batch)
+            except sqlite3.Error:
+                LOGGER.exception(f'Failed to add {len(batch)} instances to the index')
+        conn.close()
+
+
+################################################################################
+# C-FIND matching
+################################################################################
+
+QUERY_LEVELS = ['PATIENT', 'STUDY', 'SERIES', 'IMAGE']
+
+# Unique key of each level
+_UNIQUE_KEYS = {
+    'PATIENT': 'PatientID',
+    'STUDY': 'StudyInstanceUID',
+    'SERIES': 'SeriesInstanceUID',
+    'IMAGE': 'SOPInstanceUID',
+}
+
+_LEVEL_TABLES = {
+    'PATIENT': 'patient',
+    'STUDY': 'study',
+    'SERIES': 'series',
+    'IMAGE': 'instance',
+}
+
+# Each level is joined to the levels above it so higher level attributes can
+# be matched and returned
+_FROM = {
+    'PATIENT': 'FROM patient',
+    'STUDY': (
+        'FROM study '
+        'LEFT JOIN patient ON patient.patient_id = study.patient_id'
+    ),
+    'SERIES': (
+        'FROM series '
+        'LEFT JOIN study ON study.study_uid = series.study_uid '
+        'LEFT JOIN patient ON patient.patient_id = study.patient_id'
+    ),
+    'IMAGE': (
+        'FROM instance '
+        'LEFT JOIN series ON series.series_uid = instance.series_uid '
+        'LEFT JOIN study ON study.study_uid = series.study_uid '
+        'LEFT JOIN patient ON patient.patient_id = study.patient_id'
+    ),
+}
+
+# DICOM keyword -> (level, column), keywords stored in more than one table
+# belong to the highest level they appear at
+_KEYWORD_COLUMNS = {}
+for _level, _table in _LEVEL_TABLES.items():
+    for _column, _keyword in TABLES[_table]:
+        _KEYWORD_COLUMNS.setdefault(_keyword, (_level, f'{_table}.{_column}'))
+
+# Attributes worked out from the lower levels, these can only be returned
+_COMPUTED_COLUMNS = {
+    'NumberOfPatientRelatedStudies': (
+        'PATIENT',
+        '(SELECT COUNT(*) FROM study AS s WHERE s.patient_id = patient.patient_id)',
+    ),
+    'ModalitiesInStudy': (
+        'STUDY',
+        '(SELECT GROUP_CONCAT(DISTINCT s.modality) FROM series AS s '
+        'WHERE s.study_uid = study.study_uid)',
+    ),
+    'NumberOfStudyRelatedSeries': (
+        'STUDY',
+        '(SELECT COUNT(*) FROM series AS s WHERE s.study_uid = study.study_uid)',
+    ),
+    'NumberOfStudyRelatedInstances': (
+        'STUDY',
+        '(SELECT COUNT(*) FROM instance AS i JOIN series AS s '
+        'ON s.series_uid = i.series_uid WHERE s.study_uid = study.study_uid)',
+    ),
+    'NumberOfSeriesRelatedInstances': (
+        'SERIES',
+        '(SELECT COUNT(*) FROM instance AS i WHERE i.series_uid = series.series_uid)',
+    ),
+}
+
+# Keys where 'from-to' is a range rather than a literal value
+_RANGE_KEYWORDS = {'PatientBirthDate', 'StudyDate', 'StudyTime', 'SeriesDate'}
+
+_INTEGER_KEYWORDS = {'SeriesNumber', 'InstanceNumber'}
+
+
+def _query_values(elem):
+    """Return the values of a query element as a list of strings."""
+    if elem.value is None:
+        return []
+    if isinstance(elem.value, (list, MultiValue)):
+        return [str(value) for value in elem.value]
+    value = str(elem.value)
+    return [value] if value else []
+
+
+def _like_pattern(value):
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%').replace('?', '_')
+
+
+def _match_condition(keyword, column, values):
+    """Return the SQL condition and parameters matching column to values.
+
+    Implements the single value, list of UID, wild card and range matching
+    of Part 4, C.2.2.2. Returns None for universal matching.
+    """
+    if not values:
+        return None
+
+    if len(values) > 1:
+        # List of UID matching
+        marks = ', '.join('?' * len(values))
+        return f'{column} IN ({marks})', values
+
+    value = values[0]
+    if keyword in _RANGE_KEYWORDS and '-' in value:
+        start, end = (part.strip() for part in value.split('-', 1))
+        conditions, params = [], []
+        if start:
+            conditions.append(f'{column} >= ?')
+            params.append(start)
+        if end:
+            # A range's end is inclusive, so '-1200' includes '120030.5'
+            conditions.append(f'{column} <= ?')
+            params.append(end + '\uffff' if keyword == 'StudyTime' else end)
+        if not conditions:
+            return None
+        return ' AND '.join(conditions), params
+
+    if '*' in value or '?' in value:
+        if not value.strip('*'):
+            return None
+        return f"{column} LIKE ? ESCAPE '\\'", [_like_pattern(value)]
+
+    if keyword in _INTEGER_KEYWORDS:
+        try:
+            return f'{column} = ?', [int(value)]
+        except ValueError:
+            return '0', []
+
+    return f'{column} = ?', [value]
+
+
+def _parse_identifier(identifier, model):
+    """Return the level, return keys, columns and SQL conditions for identifier.
+
+    Raises ValueError for an invalid identifier.
+    """
+    level = str(identifier.get('QueryRetrieveLevel', '')).upper()
+    if level not in QUERY_LEVELS:
+        raise ValueError(f"Invalid Query Retrieve Level '{level}'")
+    if model == 'STUDY' and level == 'PATIENT':
+        raise ValueError("The Study Root model has no PATIENT level")
+
+    depth = QUERY_LEVELS.index(level)
+
+    # Work out which keys can be matched and returned at this level
+    columns, conditions, params = [], [], []
+    return_keys = []
+    for elem in identifier:
+        keyword = elem.keyword
+        if keyword in _KEYWORD_COLUMNS:
+            key_level, column = _KEYWORD_COLUMNS[keyword]
+        elif keyword in _COMPUTED_COLUMNS:
+            key_level, column = _COMPUTED_COLUMNS[keyword]
+        else:
+            continue
+
+        if QUERY_LEVELS.index(key_level) > depth:
+            continue
+
+        return_keys.append(keyword)
+        columns.append(column)
+
+        values = _query_values(elem)
+        if keyword == 'ModalitiesInStudy':
+            if values:
+                marks = ', '.join('?' * len(values))
+                conditions.append(
+                    'EXISTS (SELECT 1 FROM series AS s WHERE s.study_uid = study.study_uid '
+                    f'AND s.modality IN ({marks}))'
+                )
+                params += values
+            continue
+        if keyword in _COMPUTED_COLUMNS:
+            continue
+
+        condition = _match_condition(keyword, column, values)
+        if condition:
+            conditions.append(f'({condition[0]})')
+            params += condition[1]
+
+    # The unique key of each level is always returned
+    for unique_keyword in [_UNIQUE_KEYS[key_level] for key_level in QUERY_LEVELS[:depth + 1]]:
+        if model == 'STUDY' and unique_keyword == 'PatientID':
+            continue
+        if unique_keyword not in return_keys:
+            return_keys.append(unique_keyword)
+            columns.append(_KEYWORD_COLUMNS[unique_keyword][1])
+
+    return level, return_keys, columns, conditions, params
+
+
+def find(conn, identifier, model='PATIENT'):
+    """Yield a Dataset for every record in the index matching identifier.
+
+    model is the information model the query was sent under, 'PATIENT' for
+    Patient Root and 'STUDY' for Study Root. All matching is done by SQLite,
+    no DICOM files are opened. Raises ValueError for an invalid identifier.
+    """
+    level, return_keys, columns, conditions, params = _parse_identifier(identifier, model)
+
+    sql = f"SELECT DISTINCT {', '.join(columns)} {_FROM[level]}"
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+
+    for row in conn.execute(sql, params):
+        ds = Dataset()
+        ds.QueryRetrieveLevel = level
+        for keyword, value in zip(return_keys, row):
+            if keyword == 'ModalitiesInStudy' and value:
+                value = value.split(',')
+            setattr(ds, keyword, value)
+        yield ds
+
+
+def check_retrieve_keys(identifier, model='PATIENT'):
+    """Raise ValueError unless identifier has the unique keys of a retrieve.
+
+    Part 4, C.4.2.2.1: a C-GET or C-MOVE identifier holds the unique key of
+    the Query Retrieve Level as a single value or a list of UIDs and the
+    unique key of every level above it as a single value, none of them
+    empty or with wild cards. Patient ID isn't needed with Study Root.
+    """
+    level = str(identifier.get('QueryRetrieveLevel', '')).upper()
+    if level not in QUERY_LEVELS:
+        raise ValueError(f"Invalid Query Retrieve Level '{level}'")
+    depth = QUERY_LEVELS.index(level)
+
+    for key_level in QUERY_LEVELS[:depth + 1]:
+        if model == 'STUDY' and key_level == 'PATIENT':
+            continue
+        keyword = _UNIQUE_KEYS[key_level]
+        values = _query_values(identifier[keyword]) if keyword in identifier else []
+        if not values or not all(value.strip() for value in values):
+            raise ValueError(f'{keyword} is needed to retrieve at the {level} level')
+        if len(values) > 1 and key_level != level:
+            raise ValueError(f'{keyword} must be a single value to retrieve at the {level} level')
+        if any('*' in value or '?' in value for value in values):
+            raise ValueError(f'{keyword} can not have wild cards in a retrieve')
+
+
+def find_instances(conn, identifier, model='PATIENT'):
+    """Return the instances matching identifier.
+
+    Used for C-GET and C-MOVE, where identifier selects patients, studies,
+    series or instances and every instance below them is retrieved. Each
+    instance is (SOP Instance UID, path, SOP Class UID, Transfer Syntax UID).
+    Raises ValueError if identifier fails check_retrieve_keys().
+    """
+    check_retrieve_keys(identifier, model)
+    _, _, _, conditions, params = _parse_identifier(identifier, model)
+
+    sql = (
+        'SELECT instance.sop_instance_uid, instance.path, '
+        f"instance.sop_class_uid, instance.transfer_syntax_uid {_FROM['IMAGE']}"
+    )
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY series.series_uid, instance.instance_number'
+    return conn.execute(sql, params).fetchall()
+
+
+################################################################################
+# Rebuilding the index from a folder
+################################################################################
+
+def find_files(folder):
+    """Yield every file below folder, skipping hidden and partial files."""
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if name.startswith('.') or name.endswith(('.part', '.queued', '.sqlite', '-wal', '-shm')):
+                continue
+            yield os.path.join(root, name)
+
+
+def read_record(path):
+    """Return the index record for the file at path or None if not DICOM."""
+    try:
+        ds = dcmread(path, stop_before_pixels=True, defer_size='1 KB',
+                     specific_tags=INDEX_TAGS)
+    except (InvalidDicomError, OSError, ValueError):
+        return None
+    if 'SOPInstanceUID' not in ds:
+        return None
+    received = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+    return record_from_dataset(ds, path, received)
+
+
+def rebuild(folder, database, processes=None, batch_size=500):
+    """Replace the contents of database with the DICOM files below folder.
+
+    Files are read in parallel by a pool of processes. Returns the number of
+    files indexed and skipped.
+    """
+    conn = connect(database)
+    with conn:
+        for table in TABLES:
+            conn.execute(f'DELETE FROM {table}')
+
+    indexed = skipped = 0
+    batch = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for record in pool.map(read_record, find_files(folder), chunksize=64):
+            if record is None:
+                skipped += 1
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                write_records(conn, batch)
+                indexed += len(batch)
+                batch = []
+    write_records(conn, batch)
+    indexed += len(batch)
+
+    conn.close()
+    return indexed, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the index of a folder of DICOM files.")
+    parser.add_argument("folder", help="Folder holding the DICOM files")
+    parser.add_argument("--database", help=f"Index to rebuild, defaults to {DEFAULT_DATABASE} in the folder")
+    parser.add_argument("--processes", type=int, default=None, help="Number of reader processes, defaults to the CPU count")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        print(f"{args.folder} is not a folder")
+        sys.exit(1)
+
+    database = args.database or os.path.join(args.folder, DEFAULT_DATABASE)
+    start = time.perf_counter()
+    indexed, skipped = rebuild(args.folder, database, args.processes)
+    elapsed = time.perf_counter() - start
+    print(f"Indexed {indexed} files ({skipped} skipped) into {database} "
+          f"in {elapsed:.1f}s ({indexed / max(elapsed, 1e-6):.0f} files/s)")
+
+
+if __name__ == "__main__":
+    main()
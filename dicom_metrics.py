@@ -0,0 +1,249 @@
+################################################################################
+# Throughput and latency metrics for the DICOM Store SCP
+#
+# Metrics keeps counters, latency histograms and per association totals.
+# serve_metrics() publishes them in the Prometheus text format over HTTP and
+# Metrics.start_log() prints a JSON summary line every few seconds.
+# Recording a value is a dictionary update under a lock, so it is cheap
+# enough for the C-STORE handler.
+################################################################################
+
+import json
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# name -> (type, help) for everything the SCP records
+METRICS = {
+    'instances_received_total': ('counter', 'Instances received by C-STORE'),
+    'bytes_received_total': ('counter', 'Bytes of data set received by C-STORE'),
+    'store_failures_total': ('counter', 'C-STORE requests that could not be stored'),
+    'write_failures_total': ('counter', 'Acknowledged instances the writer threads gave up on by stage'),
+    'duplicates_total': ('counter', 'Instances checked for duplicates by result'),
+    'associations_total': ('counter', 'Associations accepted'),
+    'associations_rejected_total': ('counter', 'Associations rejected'),
+    'rejected_contexts_total': ('counter', 'Presentation contexts rejected in accepted associations'),
+    'associations_active': ('gauge', 'Associations currently open'),
+    'store_stage_seconds': ('histogram', 'Time spent in each stage of storing an instance'),
+}
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the q quantile.
+
+        The value is capped at the last bucket bound, so a quantile that
+        falls above it is reported as that bound rather than as infinity,
+        which can't be written as JSON.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+class Metrics:
+    """Counters, gauges and histograms shared by all association threads."""
+
+    def __init__(self, prefix='dicom_scp', constant_labels=None):
+        self.prefix = prefix
+        self.constant_labels = _labels(constant_labels or {})
+        self.started = time.time()
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._associations = {}
+
+        self.gauge('associations_active', lambda: len(self._associations))
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, func, help=''):
+        """Report the value returned by func as the gauge name."""
+        self._gauges[name] = func
+        if name not in METRICS:
+            METRICS[name] = ('gauge', help)
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, _labels(labels)), 0)
+
+    # Per association totals
+    def association_started(self, assoc):
+        with self._lock:
+            self._associations[id(assoc)] = [time.monotonic(), 0, 0]
+        self.inc('associations_total')
+
+    def association_stored(self, assoc, nbytes):
+        with self._lock:
+            totals = self._associations.get(id(assoc))
+            if totals:
+                totals[1] += 1
+                totals[2] += nbytes
+        self.inc('instances_received_total')
+        self.inc('bytes_received_total', nbytes)
+
+    def association_ended(self, assoc):
+        """Stop tracking assoc and return its totals as a dict."""
+        with self._lock:
+            totals = self._associations.pop(id(assoc), None)
+        if totals is None:
+            return None
+
+        started, instances, nbytes = totals
+        elapsed = max(time.monotonic() - started, 1e-6)
+        return {
+            'duration': round(elapsed, 3),
+            'instances': instances,
+            'bytes': nbytes,
+            'instances_per_s': round(instances / elapsed, 1),
+            'mb_per_s': round(nbytes / elapsed / 1e6, 2),
+        }
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: (list(h.counts), h.sum, h.count, h.buckets)
+                for key, h in self._histograms.items()
+            }
+        gauges = {name: func() for name, func in self._gauges.items()}
+
+        lines = []
+        for name, (kind, help) in METRICS.items():
+            full_name = f'{self.prefix}_{name}'
+            lines.append(f'# HELP {full_name} {help}')
+            lines.append(f'# TYPE {full_name} {kind}')
+
+            if kind == 'gauge' and name in gauges:
+                lines.append(f'{full_name}{_format_labels(self.constant_labels)} {gauges[name]}')
+            elif kind == 'counter':
+                series = [(labels, value) for (n, labels), value in counters.items() if n == name]
+                for labels, value in series or [((), 0)]:
+                    lines.append(f'{full_name}{_format_labels(self.constant_labels + labels)} {value}')
+            elif kind == 'histogram':
+                for (n, labels), (counts, total, count, buckets) in histograms.items():
+                    if n != name:
+                        continue
+                    labels = self.constant_labels + labels
+                    cumulative = 0
+                    for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(
+                            f'{full_name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}'
+                        )
+                    lines.append(f'{full_name}_sum{_format_labels(labels)} {total}')
+                    lines.append(f'{full_name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Return the totals and stage latencies as a dict."""
+        with self._lock:
+            summary = {
+                'instances': self._counters.get(('instances_received_total', ()), 0),
+                'bytes': self._counters.get(('bytes_received_total', ()), 0),
+                'failures': self._counters.get(('store_failures_total', ()), 0),
+                'associations_active': len(self._associations),
+            }
+            for (name, labels), histogram in self._histograms.items():
+                stage = dict(labels).get('stage', name)
+                summary[f'{stage}_p50_ms'] = round(histogram.quantile(0.5) * 1000, 2)
+                summary[f'{stage}_p99_ms'] = round(histogram.quantile(0.99) * 1000, 2)
+        for name, func in self._gauges.items():
+            summary[name] = func()
+        return summary
+
+    def start_log(self, interval, write=print):
+        """Write a JSON summary line with the rates every interval seconds."""
+        def run():
+            last = self.summary()
+            last_time = time.monotonic()
+            while True:
+                time.sleep(interval)
+                now = time.monotonic()
+                current = self.summary()
+                elapsed = now - last_time
+                current['instances_per_s'] = round((current['instances'] - last['instances']) / elapsed, 1)
+                current['mb_per_s'] = round((current['bytes'] - last['bytes']) / elapsed / 1e6, 2)
+                current['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+                current.update(dict(self.constant_labels))
+                write(json.dumps(current))
+                last, last_time = current, now
+
+        thread = threading.Thread(target=run, name='metrics-log', daemon=True)
+        thread.start()
+        return thread
+
+
+def serve_metrics(metrics, address='127.0.0.1', port=9100):
+    """Serve metrics.render() at http://address:port/metrics in a thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,678 @@
+################################################################################
+# Query/retrieve client library with association pooling
+#
+# AssociationPool keeps associations open between requests, keyed by the
+# remote AE title, host, port and presentation contexts. Idle associations
+# are checked with a C-ECHO before they are reused and any that were aborted,
+# timed out or failed a check are replaced with a new one. RemoteAE wraps a
+# remote AE with echo(), find(), get() and move() that borrow an association
+# from a pool for each request. QueryCache keeps C-FIND results for a while
+# so repeated queries are answered without asking the remote AE again.
+# QueryTree walks the PATIENT, STUDY, SERIES and IMAGE levels, only querying
+# the levels below the nodes that are asked for:
+#
+#   pool = AssociationPool('MY_SCU', max_size=4)
+#   cache = QueryCache(ttl=300, database='query_cache.sqlite')
+#   pacs = RemoteAE('PACS', '10.0.0.5', 104, pool, cache)
+#   for identifier in pacs.find(query, model='study'):
+#       print(identifier.StudyInstanceUID)
+#   tree = QueryTree(pacs, model='study')
+#   for study in tree.roots(PatientID='12345', StudyDate='20240101-'):
+#       for series in study.children(Modality='CT'):
+#           print(series.SeriesDescription)
+#   pool.close()
+################################################################################
+
+import json
+import time
+import sqlite3
+import threading
+import contextlib
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.dataset import Dataset
+from pynetdicom import AE, evt, build_role, StoragePresentationContexts
+from pynetdicom.status import code_to_category
+from pynetdicom.sop_class import (
+    Verification,
+    PatientRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelGet,
+    PatientRootQueryRetrieveInformationModelMove,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+)
+from pynetdicom.sop_class import (
+    CTImageStorage,
+    EnhancedCTImageStorage,
+    MRImageStorage,
+    EnhancedMRImageStorage,
+    ComputedRadiographyImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    DigitalMammographyXRayImageStorageForPresentation,
+    BreastTomosynthesisImageStorage,
+    UltrasoundImageStorage,
+    UltrasoundMultiFrameImageStorage,
+    XRayAngiographicImageStorage,
+    XRayRadiofluoroscopicImageStorage,
+    NuclearMedicineImageStorage,
+    PositronEmissionTomographyImageStorage,
+    RTImageStorage,
+    SecondaryCaptureImageStorage,
+    MultiFrameTrueColorSecondaryCaptureImageStorage,
+    VLPhotographicImageStorage,
+    VLEndoscopicImageStorage,
+    VLWholeSlideMicroscopyImageStorage,
+)
+from pydicom.uid import (
+    JPEGBaseline8Bit,
+    JPEGExtended12Bit,
+    JPEGLossless,
+    JPEGLosslessSV1,
+    JPEGLSLossless,
+    JPEGLSNearLossless,
+    JPEG2000Lossless,
+    JPEG2000,
+    HTJ2KLossless,
+    HTJ2KLosslessRPCL,
+    HTJ2K,
+    RLELossless,
+)
+
+LOGGER = logging.getLogger('dicom_query')
+
+# model -> (C-FIND, C-GET, C-MOVE) SOP classes
+QUERY_MODELS = {
+    'patient': (
+        PatientRootQueryRetrieveInformationModelFind,
+        PatientRootQueryRetrieveInformationModelGet,
+        PatientRootQueryRetrieveInformationModelMove,
+    ),
+    'study': (
+        StudyRootQueryRetrieveInformationModelFind,
+        StudyRootQueryRetrieveInformationModelGet,
+        StudyRootQueryRetrieveInformationModelMove,
+    ),
+}
+
+# Storage SOP classes accepted during a C-GET in the uncompressed transfer
+# syntaxes. The retired classes are left out to make room in the 128
+# presentation contexts for the C-GET and Verification contexts and the
+# compressed contexts of GET_COMPRESSED_CLASSES
+GET_STORAGE_CLASSES = tuple(dict.fromkeys(
+    cx.abstract_syntax for cx in StoragePresentationContexts if not cx.abstract_syntax.is_retired
+))
+
+# Image classes also offered during a C-GET in a second presentation context
+# with the compressed transfer syntaxes, so instances the remote AE holds
+# compressed are sent as they are instead of being decoded first
+GET_COMPRESSED_CLASSES = (
+    CTImageStorage,
+    EnhancedCTImageStorage,
+    MRImageStorage,
+    EnhancedMRImageStorage,
+    ComputedRadiographyImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    DigitalMammographyXRayImageStorageForPresentation,
+    BreastTomosynthesisImageStorage,
+    UltrasoundImageStorage,
+    UltrasoundMultiFrameImageStorage,
+    XRayAngiographicImageStorage,
+    XRayRadiofluoroscopicImageStorage,
+    NuclearMedicineImageStorage,
+    PositronEmissionTomographyImageStorage,
+    RTImageStorage,
+    SecondaryCaptureImageStorage,
+    MultiFrameTrueColorSecondaryCaptureImageStorage,
+    VLPhotographicImageStorage,
+    VLEndoscopicImageStorage,
+    VLWholeSlideMicroscopyImageStorage,
+)
+
+GET_COMPRESSED_SYNTAXES = [
+    JPEGLosslessSV1,
+    JPEGLossless,
+    JPEGBaseline8Bit,
+    JPEGExtended12Bit,
+    JPEGLSLossless,
+    JPEGLSNearLossless,
+    JPEG2000Lossless,
+    JPEG2000,
+    HTJ2KLossless,
+    HTJ2KLosslessRPCL,
+    HTJ2K,
+    RLELossless,
+]
+
+_GET_CLASSES = {models[1] for models in QUERY_MODELS.values()}
+
+_PENDING = (0xFF00, 0xFF01)
+
+QUERY_LEVELS = ['PATIENT', 'STUDY', 'SERIES', 'IMAGE']
+
+# Unique key of each level
+LEVEL_KEYS = {
+    'PATIENT': 'PatientID',
+    'STUDY': 'StudyInstanceUID',
+    'SERIES': 'SeriesInstanceUID',
+    'IMAGE': 'SOPInstanceUID',
+}
+
+# Return keys requested by QueryTree unless told otherwise
+DEFAULT_RETURN_KEYS = {
+    'PATIENT': ['PatientName', 'PatientBirthDate', 'PatientSex'],
+    'STUDY': ['PatientID', 'PatientName', 'StudyDate', 'StudyDescription', 'AccessionNumber', 'ModalitiesInStudy'],
+    'SERIES': ['Modality', 'SeriesNumber', 'SeriesDescription'],
+    'IMAGE': ['SOPClassUID', 'InstanceNumber'],
+}
+
+
+class AssociationError(RuntimeError):
+    """An association could not be established or was lost."""
+
+
+class QueryError(RuntimeError):
+    """The remote AE answered a request with a failure status."""
+
+    def __init__(self, status):
+        self.status = status
+        super().__init__(f'Failed with status 0x{status.Status:04X}')
+
+
+class _Slot:
+    """The associations to one remote AE with one set of contexts."""
+
+    def __init__(self):
+        self.idle = []
+        self.count = 0
+        self.condition = threading.Condition()
+
+
+class AssociationPool:
+    """Keeps associations open so they can be reused by later requests.
+
+    At most max_size associations are open to each (AE title, host, port,
+    contexts), borrowers wait for one to be returned when they are all in
+    use. An association idle for more than echo_after seconds is checked
+    with a C-ECHO before it is handed out, one idle for more than max_idle
+    seconds or used max_uses times is released and replaced.
+    """
+
+    def __init__(self, ae_title='PYNETDICOM', max_size=4, echo_after=30.0,
+                 max_idle=300.0, max_uses=1000, timeout=30):
+        self.ae_title = ae_title
+        self.max_size = max_size
+        self.echo_after = echo_after
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._aes = {}
+        self._info = {}
+        self._closed = False
+
+    @contextlib.contextmanager
+    def association(self, ae_title, host, port, contexts):
+        """Borrow an established association for the duration of a with block.
+
+        contexts is a sequence of SOP Class UIDs to request, Verification is
+        always added. If the block raises anything but QueryError the
+        association is aborted rather than returned to the pool.
+        """
+        key = (ae_title, host, int(port), tuple(contexts))
+        assoc = self._acquire(key)
+        ok = False
+        try:
+            yield assoc
+            ok = True
+        except QueryError:
+            # The remote AE answered, the association is still good
+            ok = True
+            raise
+        finally:
+            self._release(key, assoc, ok)
+
+    def close(self):
+        """Release every idle association, borrowed ones are released when returned."""
+        with self._lock:
+            self._closed = True
+            slots = list(self._slots.values())
+        for slot in slots:
+            with slot.condition:
+                idle, slot.idle = slot.idle, []
+                slot.count -= len(idle)
+                slot.condition.notify_all()
+            for assoc, _ in idle:
+                self._discard(assoc, release=True)
+
+    def _slot(self, key):
+        with self._lock:
+            if self._closed:
+                raise AssociationError('The association pool has been closed')
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = _Slot()
+            return slot
+
+    def _ae(self, key):
+        with self._lock:
+            ae = self._aes.get(key)
+            if ae is None:
+                ae = AE(ae_title=self.ae_title)
+                ae.acse_timeout = self.timeout
+                ae.dimse_timeout = self.timeout
+                ae.network_timeout = self.timeout
+                for sop_class in key[3]:
+                    ae.add_requested_context(sop_class)
+                if Verification not in key[3]:
+                    ae.add_requested_context(Verification)
+                if _GET_CLASSES & set(key[3]):
+                    for sop_class in GET_COMPRESSED_CLASSES:
+                        if sop_class in key[3] and len(ae.requested_contexts) < 128:
+                            ae.add_requested_context(sop_class, GET_COMPRESSED_SYNTAXES)
+                self._aes[key] = ae
+            return ae
+
+    def _acquire(self, key):
+        slot = self._slot(key)
+        with slot.condition:
+            while not slot.idle and slot.count >= self.max_size:
+                slot.condition.wait()
+            if slot.idle:
+                assoc, last_used = slot.idle.pop()
+            else:
+                slot.count += 1
+                assoc = None
+
+        # This borrower now owns one of the slot's places, check or connect
+        # outside the lock so other borrowers aren't held up
+        if assoc is not None:
+            if self._healthy(assoc, last_used):
+                return assoc
+            LOGGER.info(f'Replacing pooled association with {key[0]} at {key[1]}:{key[2]}')
+            self._discard(assoc)
+
+        try:
+            return self._connect(key)
+        except Exception:
+            with slot.condition:
+                slot.count -= 1
+                slot.condition.notify()
+            raise
+
+    def _connect(self, key):
+        ae_title, host, port, contexts = key
+        ext_neg = []
+        if _GET_CLASSES & set(contexts):
+            # Let the remote AE send the C-GET results back over the association
+            ext_neg = [build_role(uid, scp_role=True) for uid in contexts if uid not in _GET_CLASSES]
+
+        assoc = self._ae(key).associate(host, port, ae_title=ae_title, ext_neg=ext_neg)
+        if not assoc.is_established:
+            raise AssociationError(f'Association with {ae_title} at {host}:{port} rejected, aborted or never connected')
+        self._info[id(assoc)] = [0]
+        return assoc
+
+    def _healthy(self, assoc, last_used):
+        if not assoc.is_established:
+            return False
+        idle = time.monotonic() - last_used
+        if idle > self.max_idle or self._info.get(id(assoc), [0])[0] >= self.max_uses:
+            return False
+        if idle > self.echo_after:
+            status = assoc.send_c_echo()
+            return bool(status) and status.Status == 0x0000 and assoc.is_established
+        return True
+
+    def _release(self, key, assoc, ok):
+        slot = self._slot_or_none(key)
+        if ok and assoc.is_established and slot is not None and not self._closed:
+            self._info[id(assoc)][0] += 1
+            with slot.condition:
+                slot.idle.append((assoc, time.monotonic()))
+                slot.condition.notify()
+            return
+
+        # Aborted, timed out or failed while borrowed, don't reuse it
+        self._discard(assoc, release=ok)
+        if slot is not None:
+            with slot.condition:
+                slot.count -= 1
+                slot.condition.notify()
+
+    def _slot_or_none(self, key):
+        with self._lock:
+            return self._slots.get(key)
+
+    def _discard(self, assoc, release=False):
+        self._info.pop(id(assoc), None)
+        if assoc.is_established:
+            if release:
+                assoc.release()
+            else:
+                assoc.abort()
+
+
+class QueryCache:
+    """C-FIND results kept for ttl seconds.
+
+    Up to max_entries results are held in memory, the least recently used
+    are dropped first. If database is given results are also kept in that
+    SQLite file so they survive between runs. The cached data sets are
+    shared, don't modify them.
+    """
+
+    def __init__(self, ttl=300.0, max_entries=10000, database=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if database:
+            self._conn = sqlite3.connect(database, timeout=30, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            with self._conn:
+                self._conn.execute(
+                    'CREATE TABLE IF NOT EXISTS query_cache '
+                    '(key TEXT PRIMARY KEY, expires REAL, matches TEXT)'
+                )
+                self._conn.execute('DELETE FROM query_cache WHERE expires < ?', (time.time(),))
+
+    @staticmethod
+    def key(identifier, model, remote):
+        """Return the cache key for a query to remote, (AE title, host, port)."""
+        elements = identifier.to_json_dict()
+        for element in elements.values():
+            values = element.get('Value')
+            if values:
+                element['Value'] = [value.strip() if isinstance(value, str) else value for value in values]
+        ae_title, host, port = remote
+        return f'{ae_title.strip()}@{host}:{port}/{model}/' + json.dumps(elements, sort_keys=True)
+
+    def get(self, key):
+        """Return the cached matches for key or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    'SELECT expires, matches FROM query_cache WHERE key = ?', (key,)
+                ).fetchone()
+                if row and row[0] > now:
+                    matches = [Dataset.from_json(match) for match in json.loads(row[1])]
+                    self._remember(key, row[0], matches)
+                    self.hits += 1
+                    return matches
+
+            self.misses += 1
+            return None
+
+    def put(self, key, matches):
+        """Cache the complete list of matches for key."""
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires, matches)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?)',
+                        (key, expires, json.dumps([match.to_json_dict() for match in matches])),
+                    )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute('DELETE FROM query_cache')
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _remember(self, key, expires, matches):
+        self._entries[key] = (expires, matches)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def _check(status):
+    """Raise for a missing or failed final status and return it otherwise."""
+    if not status:
+        raise AssociationError('Connection timed out, was aborted or received invalid response')
+    if code_to_category(status.Status) == 'Failure':
+        raise QueryError(status)
+    return status
+
+
+class RemoteAE:
+    """A remote AE that is queried over associations borrowed from pool.
+
+    C-FIND results are kept in cache if one is given.
+    """
+
+    def __init__(self, ae_title, host, port, pool=None, cache=None):
+        self.ae_title = ae_title
+        self.host = host
+        self.port = int(port)
+        self.pool = pool or AssociationPool()
+        self.cache = cache
+
+    def _association(self, contexts):
+        return self.pool.association(self.ae_title, self.host, self.port, contexts)
+
+    def echo(self):
+        """Send a C-ECHO and return the status."""
+        with self._association([Verification]) as assoc:
+            return _check(assoc.send_c_echo())
+
+    def find(self, identifier, model='patient', use_cache=True):
+        """Yield the identifiers matching a C-FIND identifier.
+
+        Raises QueryError if the remote AE reports a failure. Stopping
+        iteration early aborts the association rather than reusing it.
+        Cached results are used unless use_cache is False, the remote AE's
+        answer replaces the cached one either way.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(identifier, model, (self.ae_title, self.host, self.port))
+            matches = self.cache.get(key) if use_cache else None
+            if matches is not None:
+                yield from matches
+                return
+
+        matches = []
+        sop_class = QUERY_MODELS[model][0]
+        with self._association([sop_class]) as assoc:
+            for status, match in assoc.send_c_find(identifier, sop_class):
+                if status and status.Status in _PENDING:
+                    if match is not None:
+                        matches.append(match)
+                        yield match
+                    continue
+                _check(status)
+                if key is not None and status.Status == 0x0000:
+                    self.cache.put(key, matches)
+
+    def get(self, identifier, store, model='patient', progress=None, sop_classes=GET_STORAGE_CLASSES):
+        """Retrieve the instances matching identifier with C-GET.
+
+        store is called with each EVT_C_STORE event as the instances arrive
+        and returns the C-STORE status, as a pynetdicom handler would. Returns
+        the final C-GET status, pending statuses are passed to progress if it
+        is given. sop_classes are the storage SOP classes offered.
+        """
+        sop_class = QUERY_MODELS[model][1]
+        with self._association([sop_class, *sop_classes]) as assoc:
+            assoc.bind(evt.EVT_C_STORE, store)
+            try:
+                final = None
+                for status, _ in assoc.send_c_get(identifier, sop_class):
+                    if status and status.Status in _PENDING:
+                        if progress:
+                            progress(status)
+                        continue
+                    final = status
+                return _check(final)
+            finally:
+                assoc.unbind(evt.EVT_C_STORE, store)
+
+    def move(self, identifier, destination, model='patient', progress=None):
+        """Ask the remote AE to send the matching instances to destination.
+
+        Returns the final C-MOVE status, pending statuses are passed to
+        progress if it is given.
+        """
+        sop_class = QUERY_MODELS[model][2]
+        with self._association([sop_class]) as assoc:
+            final = None
+            for status, _ in assoc.send_c_move(identifier, destination, sop_class):
+                if status and status.Status in _PENDING:
+                    if progress:
+                        progress(status)
+                    continue
+                final = status
+            return _check(final)
+
+
+class QueryNode:
+    """A patient, study, series or image found by a QueryTree.
+
+    The attributes returned by the remote AE can be read from the node,
+    node.StudyDescription, or from node.identifier. children() queries the
+    level below the first time it is called with a given filter.
+    """
+
+    def __init__(self, tree, level, identifier, parent=None):
+        self.tree = tree
+        self.level = level
+        self.identifier = identifier
+        self.parent = parent
+        self._children = {}
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        """The value of this level's unique key."""
+        return self.identifier.get(LEVEL_KEYS[self.level])
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name[0].islower():
+            raise AttributeError(name)
+        return self.identifier.get(name)
+
+    def __repr__(self):
+        return f'<QueryNode {self.level} {self.key}>'
+
+    def unique_keys(self):
+        """Return {keyword: value} of the unique keys of this node and its parents."""
+        keys = self.parent.unique_keys() if self.parent else {}
+        if not (self.tree.model == 'study' and self.level == 'PATIENT'):
+            keys[LEVEL_KEYS[self.level]] = self.key
+        return keys
+
+    def children(self, **filters):
+        """Return the nodes one level down that match filters, {keyword: value}."""
+        level = self.tree.level_below(self.level)
+        cache_key = tuple(sorted(filters.items()))
+        with self._lock:
+            if cache_key in self._children:
+                return self._children[cache_key]
+        children = self.tree.query(level, {**self.unique_keys(), **filters}, parent=self)
+        with self._lock:
+            self._children[cache_key] = children
+        return children
+
+
+class QueryTree:
+    """Drill down through the query levels of a RemoteAE.
+
+    model is 'patient' (Patient Root, starting at PATIENT) or 'study' (Study
+    Root, starting at STUDY). return_keys maps each level to the keywords
+    to ask for, the unique keys are always included. Sibling queries started
+    by expand() and walk() run on up to max_workers threads, so give the
+    remote AE's pool at least that many associations.
+    """
+
+    def __init__(self, remote, model='patient', return_keys=None, max_workers=4, use_cache=True):
+        if model not in QUERY_MODELS:
+            raise ValueError(f"Unknown query model '{model}', use one of {', '.join(QUERY_MODELS)}")
+        self.remote = remote
+        self.model = model
+        self.return_keys = {**DEFAULT_RETURN_KEYS, **(return_keys or {})}
+        self.max_workers = max_workers
+        self.use_cache = use_cache
+        self.levels = QUERY_LEVELS if model == 'patient' else QUERY_LEVELS[1:]
+
+    def level_below(self, level):
+        index = self.levels.index(level) + 1
+        if index >= len(self.levels):
+            raise ValueError(f'There is no level below {level}')
+        return self.levels[index]
+
+    def identifier(self, level, matching):
+        """Return the C-FIND identifier for level with matching keys and the return keys."""
+        ds = Dataset()
+        ds.QueryRetrieveLevel = level
+        for keyword in [LEVEL_KEYS[level], *self.return_keys.get(level, [])]:
+            setattr(ds, keyword, '')
+        for keyword, value in matching.items():
+            setattr(ds, keyword, value)
+        return ds
+
+    def query(self, level, matching, parent=None):
+        """Return the nodes at level matching {keyword: value}."""
+        identifier = self.identifier(level, matching)
+        return [
+            QueryNode(self, level, match, parent)
+            for match in self.remote.find(identifier, model=self.model, use_cache=self.use_cache)
+        ]
+
+    def roots(self, **filters):
+        """Return the patients (Patient Root) or studies (Study Root) matching filters."""
+        return self.query(self.levels[0], filters)
+
+    def expand(self, nodes, **filters):
+        """Return {node: children} querying the children of nodes concurrently."""
+        nodes = list(nodes)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(lambda node: node.children(**filters), nodes)
+            return dict(zip(nodes, results))
+
+    def walk(self, nodes, level, filters=None, keep=None):
+        """Yield the nodes at level below nodes, one level at a time.
+
+        filters maps a level to the matching keys used when querying it and
+        keep, if given, is called with every node found, a node is only
+        expanded or yielded if it returns True.
+        """
+        filters = filters or {}
+        nodes = list(nodes)
+        while nodes:
+            if keep:
+                nodes = [node for node in nodes if keep(node)]
+                if not nodes:
+                    return
+            current = nodes[0].level
+            if current == level:
+                yield from nodes
+                return
+            below = self.level_below(current)
+            expanded = self.expand(nodes, **filters.get(below, {}))
+            nodes = [child for children in expanded.values() for child in children]
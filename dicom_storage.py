@@ -0,0 +1,729 @@
+################################################################################
+# Storage helpers shared by the DICOM tools
+#
+# move_into_place() atomically renames a received file into the storage folder,
+# the StorageLayout classes decide where below that folder each instance goes
+# and WriteBehindQueue lets the Store SCP hand received instances to a pool of
+# writer threads so slow storage does not hold up the association.
+# iter_stored_datasets() opens stored files for sending without reading their
+# pixel data up front, decompressing those the peer can't accept, and
+# Compressor transcodes stored files to a lossless transfer syntax in a pool
+# of worker processes. DuplicateDetector spots instances that are received
+# again.
+################################################################################
+
+import os
+import re
+import queue
+import struct
+import collections
+import shutil
+import hashlib
+import datetime
+import threading
+import time
+import logging
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+from pydicom.uid import (
+    UID,
+    DeflatedExplicitVRLittleEndian,
+    RLELossless,
+    JPEGLSLossless,
+    JPEG2000Lossless,
+)
+from pydicom.pixels import get_decoder
+from pydicom.pixels.encoders import (
+    RLELosslessEncoder,
+    JPEGLSLosslessEncoder,
+    JPEG2000LosslessEncoder,
+)
+
+LOGGER = logging.getLogger('dicom_storage')
+
+FSYNC_POLICIES = ('none', 'file', 'batch')
+
+# What to do with an instance that was stored before with different content
+DUPLICATE_POLICIES = ('none', 'keep', 'overwrite', 'version')
+
+_STOP = object()
+
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9._^-]')
+
+# Transfer syntaxes that can be selected in an ini file. 'auto' picks the
+# best installed lossless encoder for images and deflate for everything else
+COMPRESSION_SYNTAXES = {
+    'none': None,
+    'auto': None,
+    'deflate': DeflatedExplicitVRLittleEndian,
+    'rle': RLELossless,
+    'jpegls': JPEGLSLossless,
+    'j2k': JPEG2000Lossless,
+}
+
+_ENCODERS = {
+    'rle': RLELosslessEncoder,
+    'jpegls': JPEGLSLosslessEncoder,
+    'j2k': JPEG2000LosslessEncoder,
+}
+
+
+def move_into_place(src, filename):
+    """Atomically move the file at src to filename."""
+    try:
+        os.replace(src, filename)
+    except OSError:
+        # The source is on another disk or still open (Windows) so copy it
+        # next to the destination and rename the copy instead
+        partial = f'{filename}.{os.getpid()}.{threading.get_ident()}.part'
+        shutil.copyfile(src, partial)
+        os.replace(partial, filename)
+        try:
+            os.remove(src)
+        except OSError:
+            pass
+
+
+def read_header(path, tags):
+    """Read only the given tags from the DICOM file at path.
+
+    Reading stops before the pixel data and any other large values are left
+    on disk, so this is cheap even for multi-GB instances.
+    """
+    ds = dcmread(path, stop_before_pixels=True, defer_size='1 KB',
+                 specific_tags=list(tags))
+    if 'SOPInstanceUID' not in ds:
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    return ds
+
+
+def open_for_sending(path, sop_instance_uid=None, transfer_syntaxes=None):
+    """Open a stored instance so it can be sent by pynetdicom.
+
+    Values larger than a few KB, such as the pixel data, are left on disk
+    and copied as-is from the file when the data set is encoded, nothing is
+    decoded. transfer_syntaxes, if given, maps SOP Class UIDs to the
+    transfer syntaxes the peer accepted for them and a compressed instance
+    is decompressed when its own transfer syntax isn't one of them. If the
+    file can't be read a data set holding only the SOP Instance UID is
+    returned so the send is counted as a failure.
+    """
+    try:
+        ds = dcmread(path, defer_size='4 KB')
+        if transfer_syntaxes is not None:
+            ds = decompress_for(ds, transfer_syntaxes.get(ds.SOPClassUID, ()))
+        return ds
+    except Exception:
+        LOGGER.exception(f'Unable to read {path}')
+        ds = Dataset()
+        ds.SOPInstanceUID = sop_instance_uid or ''
+        return ds
+
+
+def iter_stored_datasets(instances, prefetch=4, transfer_syntaxes=None):
+    """Yield open_for_sending() for each instance in instances.
+
+    instances holds (SOP Instance UID, path, ...) tuples. The next prefetch
+    files are opened by a thread pool while the current one is being sent.
+    """
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        pending = collections.deque()
+        for sop_instance_uid, path, *_ in instances:
+            pending.append(pool.submit(open_for_sending, path, sop_instance_uid, transfer_syntaxes))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def can_decompress(transfer_syntax):
+    """Return True if pixel data in transfer_syntax can be decoded here."""
+    transfer_syntax = UID(transfer_syntax)
+    if not transfer_syntax.is_compressed:
+        return True
+    try:
+        return get_decoder(transfer_syntax).is_available
+    except NotImplementedError:
+        return False
+
+
+def decompress_for(ds, transfer_syntaxes):
+    """Return ds decompressed unless it can be sent in transfer_syntaxes.
+
+    A compressed data set is only decompressed when its own transfer syntax
+    isn't in transfer_syntaxes and one of them is uncompressed, otherwise
+    it is returned as it is.
+    """
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if not transfer_syntax.is_compressed or transfer_syntax in transfer_syntaxes:
+        return ds
+    if all(UID(uid).is_compressed for uid in transfer_syntaxes):
+        return ds
+    # Lossless, so the instance keeps its SOP Instance UID
+    ds.decompress(generate_instance_uid=False)
+    return ds
+
+
+def compression_available(name):
+    """Return True if files can be compressed with the syntax called name."""
+    if name not in COMPRESSION_SYNTAXES:
+        raise ValueError(f"Unknown compression '{name}', use one of {', '.join(COMPRESSION_SYNTAXES)}")
+    encoder = _ENCODERS.get(name)
+    return encoder is None or encoder.is_available
+
+
+@functools.lru_cache()
+def best_lossless_syntax():
+    """Return the name of the best installed lossless image encoder."""
+    for name in ('jpegls', 'j2k', 'rle'):
+        if _ENCODERS[name].is_available:
+            return name
+    return None
+
+
+def compress_file(filename, name, fsync=False):
+    """Transcode the file at filename to the syntax called name in place.
+
+    Files that are already compressed are left alone. The file is only
+    replaced once the compressed copy has been written (and flushed to disk
+    if fsync is True) and not if the file was replaced by another one in the
+    meantime. Returns the new transfer syntax UID or None if the file was
+    not changed.
+    """
+    before = os.stat(filename)
+    ds = dcmread(filename)
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if transfer_syntax.is_compressed or transfer_syntax.is_deflated:
+        return None
+
+    if name == 'auto':
+        name = best_lossless_syntax() if 'PixelData' in ds else 'deflate'
+    if name in (None, 'none'):
+        return None
+
+    uid = COMPRESSION_SYNTAXES[name]
+    if name == 'deflate':
+        ds.file_meta.TransferSyntaxUID = uid
+    elif 'PixelData' in ds:
+        # Lossless, so the instance keeps its SOP Instance UID
+        ds.compress(uid, generate_instance_uid=False)
+    else:
+        return None
+
+    partial = f'{filename}.{os.getpid()}.compress.part'
+    try:
+        ds.save_as(partial, enforce_file_format=True)
+        if fsync:
+            with open(partial, 'rb') as f:
+                os.fsync(f.fileno())
+        if replaced_since(filename, before):
+            # Another instance was stored at filename while this one was
+            # being compressed, it is compressed by its own job
+            LOGGER.info(f'{filename} was replaced while being compressed, skipping it')
+            return None
+        os.replace(partial, filename)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return uid
+
+
+def replaced_since(filename, before):
+    """Return True if filename is no longer the file os.stat() saw as before."""
+    try:
+        after = os.stat(filename)
+    except FileNotFoundError:
+        return True
+    return (after.st_ino, after.st_size, after.st_mtime_ns) != (
+        before.st_ino, before.st_size, before.st_mtime_ns)
+
+
+def dataset_hash(path):
+    """Return the SHA-256 of the data set in the DICOM file at path.
+
+    The preamble and file meta information are skipped, so the hash of a
+    file written by the SCP matches the hash of the data set as it came off
+    the network.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        f.seek(128)
+        if f.read(4) == b'DICM':
+            # (0002,0000) UL File Meta Information Group Length
+            element = f.read(12)
+            if element[:6] == b'\x02\x00\x00\x00UL':
+                f.seek(132 + 12 + struct.unpack('<I', element[8:])[0])
+            else:
+                f.seek(132)
+        else:
+            f.seek(0)
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def versioned_name(filename):
+    """Reserve and return the first free versioned filename, name.v1.dcm etc.
+
+    The 'v' keeps versions apart from instances whose SOP Instance UID ends
+    in .1, .2 and so on, a UID is only digits and dots. The name is reserved
+    by creating an empty file, so no other writer, in this process or
+    another, gets the same one. The caller replaces it with the instance.
+    """
+    stem, extension = os.path.splitext(filename)
+    version = 1
+    while True:
+        name = f'{stem}.v{version}{extension}'
+        try:
+            os.close(os.open(name, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return name
+        except FileExistsError:
+            version += 1
+
+
+def fsync_file(filename):
+    """Flush filename and the directory entry pointing at it to disk."""
+    with open(filename, 'rb') as f:
+        os.fsync(f.fileno())
+
+    # Directories can't be opened on Windows, the rename is durable there
+    # once the file itself has been flushed
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def safe_name(value):
+    """Return value as something that can be used as a folder or file name."""
+    name = _UNSAFE_CHARS.sub('_', str(value or '').strip()).strip('.')
+    return name or 'UNKNOWN'
+
+
+class StorageLayout:
+    """Decides where below root a received instance is stored.
+
+    Subclasses list the tags they need in tags and implement parts(), which
+    returns the folder names and file name for a data set holding those tags.
+    Folders that have already been created are remembered so os.makedirs()
+    is only called the first time a folder is used.
+    """
+
+    tags = ('SOPInstanceUID',)
+    max_cached_dirs = 100000
+
+    def __init__(self, root):
+        self.root = root
+        self._made_dirs = set()
+
+    def parts(self, ds):
+        raise NotImplementedError
+
+    def path_for(self, ds):
+        """Return the path to store ds at, creating its folder if needed."""
+        filename = os.path.join(self.root, *self.parts(ds))
+        self.make_dirs(os.path.dirname(filename))
+        return filename
+
+    def make_dirs(self, directory):
+        if directory in self._made_dirs:
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        if len(self._made_dirs) >= self.max_cached_dirs:
+            self._made_dirs.clear()
+        self._made_dirs.add(directory)
+
+
+class FlatLayout(StorageLayout):
+    """Every instance in root as {SOPInstanceUID}.dcm."""
+
+    def parts(self, ds):
+        return [f'{safe_name(ds.SOPInstanceUID)}.dcm']
+
+
+class PatientLayout(StorageLayout):
+    """root/PatientID/StudyInstanceUID/SeriesInstanceUID/{SOPInstanceUID}.dcm"""
+
+    tags = ('SOPInstanceUID', 'PatientID', 'StudyInstanceUID', 'SeriesInstanceUID')
+
+    def parts(self, ds):
+        return [
+            safe_name(ds.get('PatientID')),
+            safe_name(ds.get('StudyInstanceUID')),
+            safe_name(ds.get('SeriesInstanceUID')),
+            f'{safe_name(ds.SOPInstanceUID)}.dcm',
+        ]
+
+
+class HashLayout(StorageLayout):
+    """root/ab/cd/{SOPInstanceUID}.dcm using the SHA-1 of the SOP Instance UID.
+
+    Spreads instances evenly over levels folders of width hex digits each,
+    2 x 2 gives 65536 folders.
+    """
+
+    def __init__(self, root, levels=2, width=2):
+        super().__init__(root)
+        self.levels = levels
+        self.width = width
+
+    def parts(self, ds):
+        sop_instance_uid = str(ds.SOPInstanceUID)
+        digest = hashlib.sha1(sop_instance_uid.encode('ascii', 'replace')).hexdigest()
+        folders = [
+            digest[ii * self.width:(ii + 1) * self.width] for ii in range(self.levels)
+        ]
+        return folders + [f'{safe_name(sop_instance_uid)}.dcm']
+
+
+class DateLayout(StorageLayout):
+    """root/YYYY/MM/DD/{SOPInstanceUID}.dcm using the Study Date.
+
+    Instances without a valid Study Date are filed under the date they were
+    received.
+    """
+
+    tags = ('SOPInstanceUID', 'StudyDate')
+
+    def parts(self, ds):
+        study_date = str(ds.get('StudyDate', ''))
+        if len(study_date) != 8 or not study_date.isdigit():
+            study_date = datetime.date.today().strftime('%Y%m%d')
+        return [
+            study_date[:4],
+            study_date[4:6],
+            study_date[6:],
+            f'{safe_name(ds.SOPInstanceUID)}.dcm',
+        ]
+
+
+# Layouts that can be selected with 'Layout:' in an ini file
+LAYOUTS = {
+    'flat': FlatLayout,
+    'patient': PatientLayout,
+    'hash': HashLayout,
+    'date': DateLayout,
+}
+
+
+def make_layout(name, root, **kwargs):
+    """Return the StorageLayout registered as name."""
+    try:
+        layout_class = LAYOUTS[name.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown storage layout '{name}', use one of {', '.join(LAYOUTS)}")
+    return layout_class(root, **kwargs)
+
+
+class WriteBehindQueue:
+    """Bounded queue of received instances drained by writer threads.
+
+    write is called by a writer thread for every job put on the queue and
+    must return the path of the file it wrote, or None if nothing was
+    written. put() blocks while the queue
+    is full, so a slow disk pushes back on the sending modality instead of
+    filling up memory.
+
+    observe, if given, is called as observe('fsync', seconds) after every
+    file is flushed to disk.
+
+    A write or fsync that fails is tried again up to retries times,
+    retry_delay seconds apart. After that on_failed, if given, is called as
+    on_failed(job, filename), where filename is None if the job wasn't
+    written and the path it was written to if only the fsync failed.
+    """
+
+    def __init__(self, write, writers=2, depth=64, fsync='none',
+                 fsync_batch_size=32, fsync_batch_latency=1.0, observe=None,
+                 retries=3, retry_delay=1.0, on_failed=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}', use one of {', '.join(FSYNC_POLICIES)}")
+
+        self.write = write
+        self.fsync = fsync
+        self.fsync_batch_size = fsync_batch_size
+        self.fsync_batch_latency = fsync_batch_latency
+        self.observe = observe
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_failed = on_failed
+
+        self.written = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._lock = threading.Lock()
+
+        self._queue = queue.Queue(maxsize=depth)
+        self._threads = [
+            threading.Thread(target=self._run, name=f'writer-{ii}', daemon=True)
+            for ii in range(writers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, job):
+        """Queue job for writing, waiting for space if the queue is full."""
+        self._queue.put(job)
+
+    def depth(self):
+        """Return the number of jobs waiting to be written."""
+        return self._queue.qsize()
+
+    def close(self):
+        """Write everything still queued and stop the writer threads."""
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        unsynced = []
+        oldest = 0.0
+
+        while True:
+            # While there are unsynced files only wait as long as the batch
+            # latency allows before flushing them
+            timeout = None
+            if unsynced:
+                timeout = max(0.0, oldest + self.fsync_batch_latency - time.monotonic())
+
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._sync(unsynced)
+                continue
+
+            if job is _STOP:
+                self._sync(unsynced)
+                return
+
+            start = time.perf_counter()
+            try:
+                filename = self._retry('write a received instance', self.write, job)
+            except Exception:
+                LOGGER.exception('Giving up writing a received instance')
+                self._failed(job, None)
+                continue
+            if filename is None:
+                continue
+            if self.fsync == 'file':
+                try:
+                    self._retry(f'fsync {filename}', self._fsync, filename)
+                except OSError:
+                    LOGGER.exception(f'Giving up flushing {filename} to disk')
+                    self._failed(job, filename)
+                    continue
+
+            latency = time.perf_counter() - start
+            with self._lock:
+                self.written += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+            if self.fsync == 'batch':
+                if not unsynced:
+                    oldest = time.monotonic()
+                unsynced.append((job, filename))
+                if len(unsynced) >= self.fsync_batch_size:
+                    self._sync(unsynced)
+
+    def _sync(self, unsynced):
+        for job, filename in unsynced:
+            try:
+                self._retry(f'fsync {filename}', self._fsync, filename)
+            except OSError:
+                LOGGER.exception(f'Giving up flushing {filename} to disk')
+                self._failed(job, filename)
+        unsynced.clear()
+
+    def _retry(self, what, step, *args):
+        """Return step(*args), trying again up to retries times if it raises."""
+        for attempt in range(self.retries + 1):
+            try:
+                return step(*args)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                LOGGER.warning(f'Failed to {what}, trying again in {self.retry_delay:g}s', exc_info=True)
+                time.sleep(self.retry_delay)
+
+    def _failed(self, job, filename):
+        with self._lock:
+            self.failed += 1
+        if self.on_failed:
+            try:
+                self.on_failed(job, filename)
+            except Exception:
+                LOGGER.exception('Failed to set aside an instance that could not be written')
+
+    def _fsync(self, filename):
+        start = time.perf_counter()
+        fsync_file(filename)
+        if self.observe:
+            self.observe('fsync', time.perf_counter() - start)
+
+
+class Compressor:
+    """Compresses stored files in a pool of worker processes.
+
+    submit() returns straight away. on_compressed, if given, is called with
+    the filename and new transfer syntax UID once a file has been replaced.
+    The workers are started with 'spawn' as forking a process that is
+    running association and writer threads isn't safe.
+    """
+
+    def __init__(self, processes=2, on_compressed=None, fsync=False):
+        self.on_compressed = on_compressed
+        self.fsync = fsync
+        self.compressed = 0
+        self.failed = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, filename, name):
+        with self._lock:
+            self._pending += 1
+        future = self._pool.submit(compress_file, filename, name, self.fsync)
+        future.add_done_callback(functools.partial(self._done, filename))
+
+    def depth(self):
+        """Return the number of files waiting to be compressed."""
+        return self._pending
+
+    def close(self):
+        """Finish compressing the files already submitted."""
+        self._pool.shutdown(wait=True)
+
+    def _done(self, filename, future):
+        with self._lock:
+            self._pending -= 1
+        try:
+            transfer_syntax = future.result()
+        except Exception:
+            LOGGER.exception(f'Failed to compress {filename}')
+            with self._lock:
+                self.failed += 1
+            return
+
+        if transfer_syntax is None:
+            return
+        with self._lock:
+            self.compressed += 1
+        if self.on_compressed:
+            try:
+                self.on_compressed(filename, transfer_syntax)
+            except Exception:
+                LOGGER.exception(f'Failed to record compressing {filename}')
+
+
+class DuplicateDetector:
+    """Recognises instances that have been stored before.
+
+    The SOP Instance UID, data set hash and path of recently stored
+    instances are kept in an LRU cache of up to cache_size entries. lookup,
+    if given, is called with the SOP Instance UID on a cache miss and returns
+    (hash, path) of an instance stored earlier or None, usually
+    InstanceIndex.lookup.
+    """
+
+    def __init__(self, policy='keep', cache_size=100000, lookup=None, lock_stripes=64):
+        if policy not in DUPLICATE_POLICIES:
+            raise ValueError(f"Unknown duplicate policy '{policy}', use one of {', '.join(DUPLICATE_POLICIES)}")
+
+        self.policy = policy
+        self.cache_size = cache_size
+        self.lookup = lookup
+        self._recent = collections.OrderedDict()
+        # SOP Instance UID -> (Event, action, filename) of writes under way
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Instances with the same SOP Instance UID are checked one at a
+        # time, others don't wait for the index lookup and hashing
+        self._uid_locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def check(self, sop_instance_uid, content_hash, filename):
+        """Decide what to do with an instance about to be stored at filename.
+
+        Returns (action, filename) where action is
+          'new'       - not seen before, store it at filename
+          'identical' - stored before with the same content, don't store it
+          'kept'      - stored before with other content, don't store it
+          'replaced'  - stored before with other content, overwrite it
+          'versioned' - stored before with other content, store it at the
+                        returned versioned filename as well
+        For 'new', 'replaced' and 'versioned' the caller must call done()
+        once the instance has been written or has failed to. Until then
+        other instances with the same SOP Instance UID wait in check(), so
+        they are never judged against a write that may not happen.
+        """
+        while True:
+            with self._uid_locks[hash(sop_instance_uid) % len(self._uid_locks)]:
+                with self._lock:
+                    pending = self._pending.get(sop_instance_uid)
+                if pending is None:
+                    action, filename = self._decide(sop_instance_uid, content_hash, filename)
+                    if action in ('new', 'replaced', 'versioned'):
+                        with self._lock:
+                            self._pending[sop_instance_uid] = (threading.Event(), action, filename)
+                    return action, filename
+            pending[0].wait()
+
+    def done(self, sop_instance_uid, content_hash, filename, stored=True):
+        """Record the result of writing an instance check() let through."""
+        with self._lock:
+            event, action, _ = self._pending.pop(sop_instance_uid)
+        if stored:
+            self._remember(sop_instance_uid, content_hash, filename)
+        elif action == 'versioned':
+            # Give the reserved name back
+            try:
+                if os.path.getsize(filename) == 0:
+                    os.remove(filename)
+            except OSError:
+                pass
+        event.set()
+
+    def _decide(self, sop_instance_uid, content_hash, filename):
+        with self._lock:
+            known = self._recent.get(sop_instance_uid)
+            if known is not None:
+                self._recent.move_to_end(sop_instance_uid)
+        if known is None and self.lookup:
+            known = self.lookup(sop_instance_uid)
+
+        if known is None:
+            return 'new', filename
+
+        known_hash, known_path = known
+        if known_hash is None and known_path and os.path.exists(known_path):
+            # Stored before its hash was recorded
+            known_hash = dataset_hash(known_path)
+
+        if known_hash == content_hash:
+            self._remember(sop_instance_uid, known_hash, known_path)
+            return 'identical', known_path
+        if self.policy == 'keep':
+            return 'kept', known_path
+        if self.policy == 'version':
+            return 'versioned', versioned_name(filename)
+        return 'replaced', filename
+
+    def _remember(self, sop_instance_uid, content_hash, filename):
+        with self._lock:
+            self._recent[sop_instance_uid] = (content_hash, filename)
+            self._recent.move_to_end(sop_instance_uid)
+            if len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
@@ -0,0 +1,424 @@
+################################################################################
+# Conversion engine of the JPG2DICOM converters
+#
+# "JPG2DICOM v2_2 RGB.py" and "JPG2DICOM v2_0 Grayscale.py" are entry points
+# to this module, which converts an image to a Secondary Capture DICOM file
+# in colour ('rgb') or in grayscale ('grayscale'):
+#   import jpg2dicom
+#   jpg2dicom.create_dicom_from_jpg('photo.png', 'photo.dcm', colour='grayscale')
+# Any image Pillow reads can be converted: L, LA, RGB, RGBA, palette, CMYK
+# and 16 bit grayscale PNG and TIFF files. Each image is decoded once and the
+# channel handling is done on the decoded pixels with NumPy: alpha is
+# composited over black, CMYK is turned into RGB, grayscale output is the
+# luminance of colour images and 16 bit images are stored with 16 bits
+# allocated. Pillow reads 16 bit colour images as 8 bit RGB. With ybr,
+# colour images are stored as YBR_FULL_422, one Cb and one Cr sample for
+# every two pixels, two thirds of the size of RGB.
+# The patient demographics come from JPG2DICOM.ini, see the entry points.
+################################################################################
+
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import generate_uid, JPEGBaseline8Bit
+from pydicom.encaps import encapsulate
+from pydicom.tag import Tag
+import PIL
+from PIL import Image
+import numpy as np
+import collections
+import configparser
+import datetime
+import argparse
+import os
+import functools
+import jpg2dicom_batch
+from jpg2dicom_jpeg import read_baseline_jpeg
+from jpg2dicom_frames import open_frames, encode_frames, write_multiframe
+
+COLOURS = ('rgb', 'grayscale')
+
+# Pixel data of a decoded image and how it is stored
+Pixels = collections.namedtuple('Pixels', ['data', 'rows', 'columns', 'samples', 'photometric', 'bits'])
+
+# Rows of a colour image converted to YBR_FULL_422 at a time
+_YBR_ROWS = 256
+
+# Patient demographics, read from the config file by load_config()
+NAME = MRN = DOB = GENDER = ACCESSIONNO = MODALITY = None
+JPG_FILE = ""
+
+def load_config():
+    """Load the patient demographics from the config file if not loaded yet."""
+    global NAME, MRN, DOB, GENDER, ACCESSIONNO, MODALITY
+    if NAME is not None:
+        return
+    config = configparser.ConfigParser()
+    config.read('JPG2DICOM.ini')
+    NAME = config['Patient Demographics']['Name']
+    MRN = config['Patient Demographics']['MRN']
+    DOB = config['Patient Demographics']['DOB']
+    GENDER = config['Patient Demographics']['Gender']
+    ACCESSIONNO = config['Patient Demographics']['AccessionNo']
+    MODALITY = config['Patient Demographics']['Modality']
+
+def new_dataset(dicom_path, sop_class_uid, transfer_syntax_uid):
+    """Return a FileDataset with the patient details and new UIDs."""
+    load_config()
+
+    # Create the FileDataset instance
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = sop_class_uid
+    meta.TransferSyntaxUID = transfer_syntax_uid
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.ImplementationClassUID = generate_uid()
+
+    ds = FileDataset(dicom_path, {}, file_meta=meta, preamble=b"\0" * 128)
+
+    # Set patient information
+    ds.PatientName = NAME
+    ds.PatientID = MRN
+    ds.PatientBirthDate = DOB  # Valid format: YYYYMMDD
+    ds.Modality = MODALITY  # Set an appropriate modality
+    ds.SOPClassUID = sop_class_uid
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    ds.SeriesNumber = 1
+    ds.InstanceNumber = 1
+    ds.ImageComments = "Converted from JPEG"
+    return ds
+
+################################################################################
+# Pixel handling
+################################################################################
+
+def image_pixels(img, colour='rgb', ybr=False):
+    """Return the Pixels of a PIL image, decoding it once.
+
+    colour is 'rgb', which keeps grayscale images grayscale, or 'grayscale'.
+    With ybr, colour images with an even number of columns are stored as
+    YBR_FULL_422.
+    """
+    if colour not in COLOURS:
+        raise ValueError(f"Unknown colour '{colour}', expected one of {', '.join(COLOURS)}")
+
+    mode = img.mode
+    if mode in ('P', 'PA'):
+        # Expand the palette, keeping any transparency to composite below
+        has_alpha = mode == 'PA' or 'transparency' in img.info
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+    elif mode == '1':
+        img = img.convert('L')
+    elif mode == 'F':
+        raise ValueError('Floating point images are not supported')
+    elif mode not in ('L', 'LA', 'RGB', 'RGBA', 'CMYK') and not mode.startswith('I'):
+        # YCbCr, LAB, HSV and the premultiplied modes
+        img = img.convert('RGB')
+    mode = img.mode
+    columns, rows = img.size
+
+    if mode == 'L' or (mode == 'RGB' and colour == 'rgb' and not ybr):
+        # Nothing to work out, straight from the image's buffer
+        samples = 3 if mode == 'RGB' else 1
+        return Pixels(img.tobytes(), rows, columns, samples, 'RGB' if samples == 3 else 'MONOCHROME2', 8)
+
+    array = np.asarray(img)
+    if mode.startswith('I'):
+        # 16 bit grayscale, which Pillow may hold as 32 bit integers
+        if array.dtype != np.uint16 and array.size and (array.min() < 0 or array.max() > 0xFFFF):
+            raise ValueError(f'Pixel values of {mode} image are outside 0-65535')
+        return Pixels(array.astype('<u2', copy=False).tobytes(), rows, columns, 1, 'MONOCHROME2', 16)
+
+    if mode in ('LA', 'RGBA'):
+        array = _flatten(array)
+    elif mode == 'CMYK':
+        array = _cmyk_to_rgb(array)
+
+    if array.ndim == 2 or array.shape[2] == 1:
+        return Pixels(array.tobytes(), rows, columns, 1, 'MONOCHROME2', 8)
+    if colour == 'grayscale':
+        return Pixels(_luminance(array).tobytes(), rows, columns, 1, 'MONOCHROME2', 8)
+    if ybr and columns % 2 == 0:
+        return Pixels(_ybr_full_422(array).tobytes(), rows, columns, 3, 'YBR_FULL_422', 8)
+    if ybr:
+        print(f"{columns} columns is odd, YBR_FULL_422 needs pairs of pixels, storing RGB")
+    return Pixels(array.tobytes(), rows, columns, 3, 'RGB', 8)
+
+def _flatten(array):
+    """Return a (rows, columns[, 3]) array of an array with alpha, composited over black."""
+    alpha = array[..., -1:].astype(np.uint16)
+    flat = ((array[..., :-1] * alpha + 127) // 255).astype(np.uint8)
+    return flat[..., 0] if flat.shape[2] == 1 else flat
+
+def _cmyk_to_rgb(array):
+    """Return the RGB array of a CMYK array, as Pillow converts it."""
+    white = 255 - array[..., 3:].astype(np.uint16)
+    return (((255 - array[..., :3]) * white + 127) // 255).astype(np.uint8)
+
+def _luminance(array):
+    """Return the ITU-R 601-2 luma of an RGB array, as Pillow's convert('L')."""
+    rgb = array.astype(np.uint32)
+    return ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+def _ybr_full_422(array):
+    """Return the YBR_FULL_422 pixels of an RGB array with an even number of columns.
+
+    Each pair of pixels is stored as Y1 Y2 Cb Cr, the chroma of the pair
+    averaged. Works through _YBR_ROWS rows at a time to keep the floating
+    point copies small.
+    """
+    rows, columns = array.shape[:2]
+    ybr = np.empty((rows, columns // 2, 4), np.uint8)
+    for start in range(0, rows, _YBR_ROWS):
+        r, g, b = np.moveaxis(array[start:start + _YBR_ROWS].astype(np.float32), 2, 0)
+        y = 0.299 * r + 0.587 * g + 0.114 * b
+        cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+        cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+        strip = np.stack([
+            y[:, 0::2],
+            y[:, 1::2],
+            (cb[:, 0::2] + cb[:, 1::2]) / 2,
+            (cr[:, 0::2] + cr[:, 1::2]) / 2,
+        ], axis=-1)
+        ybr[start:start + _YBR_ROWS] = np.clip(np.rint(strip), 0, 255)
+    return ybr
+
+def preview_image(img):
+    """Return img as an image tkinter can show, 16 bit images scaled to 8 bit."""
+    if img.mode.startswith('I'):
+        return Image.fromarray((np.asarray(img) >> 8).clip(0, 255).astype(np.uint8))
+    if img.mode not in ('L', 'RGB', 'RGBA'):
+        return img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    return img
+
+################################################################################
+# Conversion
+################################################################################
+
+def create_dicom_from_jpg(jpg_path, dicom_path, colour='rgb', passthrough=False, ybr=False):
+    print(f"Creating DICOM from {jpg_path}")
+
+    # A baseline JPEG can be stored as it is without decoding it
+    jpeg = read_baseline_jpeg(jpg_path) if passthrough else None
+    if jpeg and colour == 'grayscale' and jpeg.samples != 1:
+        jpeg = None
+    if passthrough and not jpeg:
+        print(f"{jpg_path} is not a {'grayscale ' if colour == 'grayscale' else ''}baseline JPEG, "
+              f"storing it uncompressed")
+
+    if jpeg:
+        pixels = Pixels(encapsulate([jpeg.data]), jpeg.rows, jpeg.columns, jpeg.samples, jpeg.photometric, 8)
+    else:
+        with Image.open(jpg_path) as img:
+            pixels = image_pixels(img, colour, ybr)
+
+    # Create the FileDataset instance
+    ds = new_dataset(dicom_path, pydicom.uid.SecondaryCaptureImageStorage,
+                     JPEGBaseline8Bit if jpeg else pydicom.uid.ImplicitVRLittleEndian)
+
+    # Set the image data attributes
+    ds.Rows, ds.Columns = pixels.rows, pixels.columns
+    ds.SamplesPerPixel = pixels.samples
+    ds.PhotometricInterpretation = pixels.photometric
+    ds.BitsAllocated = pixels.bits
+    ds.BitsStored = pixels.bits
+    ds.HighBit = pixels.bits - 1
+    ds.PixelRepresentation = 0
+    if ds.SamplesPerPixel > 1:
+        ds.PlanarConfiguration = 0  # Colour by pixel
+
+    if jpeg:
+        ds.LossyImageCompression = "01"
+        ds.LossyImageCompressionMethod = "ISO_10918_1"
+        ds.add_new('PixelData', 'OB', pixels.data)
+        ds['PixelData'].is_undefined_length = True
+    else:
+        ds.PixelData = pixels.data
+        ds['PixelData'].VR = 'OW' if pixels.bits > 8 else 'OB'
+
+    # Set the creation date and time
+    dt = datetime.datetime.now()
+    ds.ContentDate = dt.strftime('%Y%m%d')
+    ds.ContentTime = dt.strftime('%H%M%S')
+
+    # Save the DICOM file
+    ds.save_as(dicom_path)
+
+
+def create_dicom_from_frames(source, dicom_path, colour='rgb', fps=None, quality=90):
+    """Convert a folder of images or a video to one multi-frame DICOM file."""
+    print(f"Creating multi-frame DICOM from {source}")
+    frames, source_fps = open_frames(source)
+    if colour == 'grayscale':
+        sop_class_uid, mode = pydicom.uid.MultiFrameGrayscaleByteSecondaryCaptureImageStorage, 'L'
+    else:
+        sop_class_uid, mode = pydicom.uid.MultiFrameTrueColorSecondaryCaptureImageStorage, 'RGB'
+    ds = new_dataset(dicom_path, sop_class_uid, JPEGBaseline8Bit)
+    ds.ImageComments = "Converted from " + os.path.basename(source.rstrip('/\\'))
+
+    # Frames are a fixed time apart, 25 per second unless known
+    ds.FrameTime = round(1000 / (fps or source_fps or 25), 3)
+    ds.FrameIncrementPointer = Tag('FrameTime')
+
+    dt = datetime.datetime.now()
+    ds.ContentDate = dt.strftime('%Y%m%d')
+    ds.ContentTime = dt.strftime('%H%M%S')
+
+    count = write_multiframe(ds, encode_frames(frames, mode=mode, quality=quality), dicom_path)
+    print(f"{count} frames saved to {dicom_path}")
+
+################################################################################
+# GUI
+################################################################################
+
+def open_gui(colour='rgb', version=''):
+    # Only the GUI needs tkinter
+    import tkinter as tk
+    from tkinter import ttk
+    from tkinter import filedialog
+    from PIL import ImageTk
+
+    load_config()
+
+    def save_dicom_file():
+        global JPG_FILE
+        dicom_path = filedialog.asksaveasfilename(
+            title="Save DICOM file as",
+            defaultextension=".dcm",
+            filetypes=[("DICOM files", "*.dcm"), ("All files", "*.*")]
+        )
+
+        if not dicom_path:
+            return
+
+        global NAME, MRN, DOB, GENDER, ACCESSIONNO, MODALITY
+        NAME = entry_patient_name.get()
+        MRN = entry_patient_id.get()
+        DOB = entry_patient_birthdate.get()
+        GENDER = entry_patient_sex.get()
+        ACCESSIONNO = entry_accession_number.get()
+        MODALITY = entry_modality.get()
+
+        create_dicom_from_jpg(JPG_FILE, dicom_path, colour)
+        print(f"DICOM file saved to {dicom_path}")
+
+    def select_jpg_file():
+        global JPG_FILE
+        JPG_FILE = filedialog.askopenfilename(
+            title="Select image file",
+            filetypes=[("Image files", "*.jpg;*.jpeg;*.png;*.tif;*.tiff;*.bmp"), ("All files", "*.*")]
+        )
+
+        if not JPG_FILE:
+            lbl_image.config(text="No JPEG file selected")
+            return
+
+        img = preview_image(Image.open(JPG_FILE))
+
+        # Resize the image to fit the GUI window, keeping aspect ratio
+        base_width = 500
+        w_percent = (base_width / float(img.size[0]))
+        h_size = int((float(img.size[1]) * float(w_percent)))
+
+        img = img.resize((base_width, h_size), PIL.Image.Resampling.LANCZOS)
+        photo = ImageTk.PhotoImage(img)
+
+        lbl_image.image = photo
+        lbl_image.config(image=photo, text="")
+
+    def exit_application():
+        app.destroy()
+
+    app = tk.Tk()
+    app.title("JPG TO DICOM Converter " + version)
+
+    frame_image = ttk.Frame(app, padding="10")
+    frame_image.grid(row=0, column=0, rowspan=7, padx=10, pady=5, sticky="nsew")
+
+    lbl_image = ttk.Label(frame_image, text="No Image Loaded")
+    lbl_image.pack(expand=True)
+
+    frame_info = ttk.Frame(app, padding="10")
+    frame_info.grid(row=0, column=1, columnspan=2, padx=10, pady=5, sticky="nsew")
+
+    ttk.Label(frame_info, text="Patient Name:").grid(row=0, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_patient_name = ttk.Entry(frame_info)
+    entry_patient_name.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
+    entry_patient_name.insert(0, NAME)
+
+    ttk.Label(frame_info, text="Patient ID:").grid(row=1, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_patient_id = ttk.Entry(frame_info)
+    entry_patient_id.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
+    entry_patient_id.insert(0, MRN)
+
+    ttk.Label(frame_info, text="Patient Birth Date (YYYYMMDD):").grid(row=2, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_patient_birthdate = ttk.Entry(frame_info)
+    entry_patient_birthdate.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
+    entry_patient_birthdate.insert(0, DOB)
+
+    ttk.Label(frame_info, text="Patient Sex (M/F):").grid(row=3, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_patient_sex = ttk.Entry(frame_info)
+    entry_patient_sex.grid(row=3, column=1, padx=5, pady=5, sticky="ew")
+    entry_patient_sex.insert(0, GENDER)
+
+    ttk.Label(frame_info, text="Modality:").grid(row=4, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_modality = ttk.Entry(frame_info)
+    entry_modality.grid(row=4, column=1, padx=5, pady=5, sticky="ew")
+    entry_modality.insert(0, MODALITY)
+
+    ttk.Label(frame_info, text="Accession Number:").grid(row=5, column=0, padx=5, pady=5, sticky=tk.W)
+    entry_accession_number = ttk.Entry(frame_info)
+    entry_accession_number.grid(row=5, column=1, padx=5, pady=5, sticky="ew")
+    entry_accession_number.insert(0, ACCESSIONNO)
+
+    frame_buttons = ttk.Frame(app, padding="10")
+    frame_buttons.grid(row=6, column=1, columnspan=2, padx=10, pady=5, sticky="ew")
+
+    style = ttk.Style()
+    style.configure('TButton', font=('Helvetica', 12), padding=10)
+    style.map('TButton', foreground=[('!active', 'black'), ('active', 'gray')],
+              background=[('!active', 'lightgray'), ('active', 'gray')],
+              relief=[('pressed', 'sunken'), ('!pressed', 'raised')])
+
+    btn_select = ttk.Button(frame_buttons, text="Select JPG", command=select_jpg_file)
+    btn_select.pack(side=tk.LEFT, padx=10, pady=20)
+
+    btn_save = ttk.Button(frame_buttons, text="Save DICOM", command=save_dicom_file)
+    btn_save.pack(side=tk.LEFT, padx=10, pady=20)
+
+    btn_exit = ttk.Button(frame_buttons, text="Exit", command=exit_application)
+    btn_exit.pack(side=tk.LEFT, padx=10, pady=20)
+
+    app.columnconfigure(1, weight=1)
+    frame_info.columnconfigure(1, weight=1)
+    app.mainloop()
+
+################################################################################
+# Main Function - checks command line arguments and if none runs GUI
+################################################################################
+
+def main(colour='rgb', version=''):
+    parser = argparse.ArgumentParser(description="Convert an image to a DICOM file.")
+    parser.add_argument("jpg_file", nargs='?', help="Path to the input image file")
+    parser.add_argument("dicom_file", nargs='?', help="Path to the output DICOM file")
+    parser.add_argument("--passthrough", action="store_true", help="Store baseline JPEGs without decoding them")
+    if colour == 'rgb':
+        parser.add_argument("--ybr", action="store_true", help="Store colour images as YBR_FULL_422, two thirds the size of RGB")
+    parser.add_argument("--frames", action="store_true", help="jpg_file is a folder of images or a video to store as one multi-frame file")
+    parser.add_argument("--fps", type=float, help="Frames per second of --frames, from the video if not given")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG quality of frames that have to be encoded")
+    jpg2dicom_batch.add_arguments(parser)
+    args = parser.parse_args()
+    convert = functools.partial(create_dicom_from_jpg, colour=colour, passthrough=args.passthrough,
+                                ybr=getattr(args, 'ybr', False))
+
+    if args.frames and args.jpg_file:
+        dicom_path = args.dicom_file if args.dicom_file else os.path.splitext(args.jpg_file.rstrip('/\\'))[0] + '.dcm'
+        create_dicom_from_frames(args.jpg_file, dicom_path, colour, fps=args.fps, quality=args.quality)
+    elif args.input_dir:
+        jpg2dicom_batch.run(convert, args)
+    elif args.jpg_file:
+        dicom_path = args.dicom_file if args.dicom_file else os.path.splitext(args.jpg_file)[0] + '.dcm'
+        convert(args.jpg_file, dicom_path)
+    else:
+        open_gui(colour, version)
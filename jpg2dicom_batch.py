@@ -0,0 +1,136 @@
+################################################################################
+# Batch directory mode shared by the JPG2DICOM converters
+#
+# convert_folder() runs a converter's create_dicom_from_jpg(jpg_path,
+# dicom_path) over every image below a folder on a pool of processes, one
+# per CPU by default, so a folder of thousands of photos is converted by a
+# handful of interpreters instead of one per file:
+#   python "JPG2DICOM v2_2 RGB.py" --input-dir photos --output-dir dicom
+# The output keeps the input's sub folders with .dcm in place of the image's
+# extension. Images whose output is already there and newer than the image
+# are skipped, so an interrupted run can be started again. Each file is
+# written under a temporary name and renamed once complete. With ordered
+# the files finish in the order they were found, otherwise in whatever order
+# the processes get through them, which keeps all of them busy.
+################################################################################
+
+import io
+import os
+import sys
+import time
+import fnmatch
+import contextlib
+import multiprocessing
+
+# Images converted unless other patterns are given
+DEFAULT_PATTERNS = ('*.jpg', '*.jpeg')
+
+
+def find_images(input_dir, patterns=DEFAULT_PATTERNS):
+    """Yield the paths below input_dir whose names match one of patterns."""
+    patterns = [pattern.lower() for pattern in patterns]
+    for directory, subdirs, filenames in os.walk(input_dir):
+        subdirs.sort()
+        for filename in sorted(filenames):
+            if any(fnmatch.fnmatch(filename.lower(), pattern) for pattern in patterns):
+                yield os.path.join(directory, filename)
+
+
+def output_path(jpg_path, input_dir, output_dir):
+    """Return where the DICOM file for jpg_path is written."""
+    relative = os.path.relpath(jpg_path, input_dir)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + '.dcm')
+
+
+def is_converted(jpg_path, dicom_path):
+    """Return True if dicom_path exists and is newer than jpg_path."""
+    try:
+        return os.path.getmtime(dicom_path) >= os.path.getmtime(jpg_path)
+    except OSError:
+        return False
+
+
+def _convert(job):
+    """Convert one image in a pool process and return (jpg, dicom, error)."""
+    convert, jpg_path, dicom_path = job
+    partial = f'{dicom_path}.{os.getpid()}.part'
+    try:
+        os.makedirs(os.path.dirname(dicom_path) or '.', exist_ok=True)
+        # The converter prints a line per file, the batch prints a summary
+        with contextlib.redirect_stdout(io.StringIO()):
+            convert(jpg_path, partial)
+        os.replace(partial, dicom_path)
+    except Exception as e:
+        with contextlib.suppress(OSError):
+            os.remove(partial)
+        return jpg_path, dicom_path, f'{type(e).__name__}: {e}'
+    return jpg_path, dicom_path, None
+
+
+def convert_folder(convert, input_dir, output_dir, patterns=DEFAULT_PATTERNS,
+                   processes=None, ordered=False, overwrite=False):
+    """Convert every image below input_dir with convert(jpg_path, dicom_path).
+
+    convert must be importable by the pool's processes, a module level
+    function of the converter script. Returns (converted, skipped, failed).
+    """
+    jobs = []
+    skipped = 0
+    for jpg_path in find_images(input_dir, patterns):
+        dicom_path = output_path(jpg_path, input_dir, output_dir)
+        if not overwrite and is_converted(jpg_path, dicom_path):
+            skipped += 1
+            continue
+        jobs.append((convert, jpg_path, dicom_path))
+
+    processes = min(processes or os.cpu_count() or 1, max(len(jobs), 1))
+    print(f'Converting {len(jobs)} images on {processes} processes, {skipped} already converted')
+
+    converted = failed = 0
+    started = last_print = time.monotonic()
+    if jobs:
+        # A few jobs per task so the processes aren't waiting on the queue
+        chunksize = max(1, min(32, len(jobs) // (processes * 8)))
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.imap if ordered else pool.imap_unordered
+            for jpg_path, dicom_path, error in results(_convert, jobs, chunksize):
+                if error:
+                    failed += 1
+                    print(f'{jpg_path}: {error}', file=sys.stderr)
+                else:
+                    converted += 1
+                now = time.monotonic()
+                if now - last_print >= 2:
+                    last_print = now
+                    print(f'{converted + failed}/{len(jobs)} done, {(converted + failed) / (now - started):.1f} files/s')
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f'Converted {converted} images in {elapsed:.1f} s ({converted / elapsed:.1f} files/s), '
+          f'{skipped} skipped, {failed} failed')
+    return converted, skipped, failed
+
+
+def add_arguments(parser):
+    """Add the batch mode options to a converter's argument parser."""
+    parser.add_argument("--input-dir", help="Convert every image below this folder")
+    parser.add_argument("--output-dir", help="Folder for the DICOM files, the input folder by default")
+    parser.add_argument("--pattern", action="append",
+                        help="File name pattern to convert, may be repeated. Default *.jpg and *.jpeg")
+    parser.add_argument("--processes", type=int, help="Number of conversion processes, one per CPU by default")
+    parser.add_argument("--ordered", action="store_true", help="Finish the files in the order they were found")
+    parser.add_argument("--overwrite", action="store_true", help="Convert images that have already been converted")
+
+
+def run(convert, args):
+    """Run convert_folder() with the options added by add_arguments()."""
+    _, _, failed = convert_folder(
+        convert,
+        args.input_dir,
+        args.output_dir or args.input_dir,
+        patterns=args.pattern or DEFAULT_PATTERNS,
+        processes=args.processes,
+        ordered=args.ordered,
+        overwrite=args.overwrite,
+    )
+    if failed:
+        sys.exit(1)
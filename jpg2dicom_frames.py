@@ -0,0 +1,209 @@
+################################################################################
+# Multi-frame conversion for the JPG2DICOM converters
+#
+# Turns a folder of images, a Motion JPEG stream (.mjpg, .mjpeg) or a video
+# file into the frames of one multi-frame instance, each frame a baseline
+# JPEG fragment:
+#   python "JPG2DICOM v2_2 RGB.py" --frames endoscopy_folder endoscopy.dcm
+#   python "JPG2DICOM v2_2 RGB.py" --frames capture.mp4 capture.dcm --fps 30
+# Frames are read, encoded and written one at a time so memory holds one
+# frame, not the whole clip. Frames that are already baseline JPEGs of the
+# same size and colour space as the first frame are stored as they are,
+# the others are decoded and encoded with quality. The fragments go to a
+# spool file next to the output as they are made, and once the number of
+# frames is known the header, the Basic Offset Table and the fragments are
+# written to the DICOM file, so viewers can seek to any frame.
+# Reading video files other than Motion JPEG needs opencv-python.
+################################################################################
+
+import io
+import os
+import shutil
+import struct
+import tempfile
+from PIL import Image
+from jpg2dicom_batch import find_images
+from jpg2dicom_jpeg import parse_baseline_jpeg, jpeg_end
+
+# Images used as frames when the source is a folder
+FRAME_PATTERNS = ('*.jpg', '*.jpeg', '*.png', '*.bmp', '*.tif', '*.tiff')
+
+MJPEG_EXTENSIONS = ('.mjpg', '.mjpeg')
+
+# Bytes read at a time from a Motion JPEG stream
+_READ_SIZE = 1024 * 1024
+
+# Tags of the encapsulated pixel data items
+_ITEM = b'\xFE\xFF\x00\xE0'
+_SEQUENCE_DELIMITER = b'\xFE\xFF\xDD\xE0\x00\x00\x00\x00'
+_PIXEL_DATA = b'\xE0\x7F\x10\x00OB\x00\x00\xFF\xFF\xFF\xFF'
+
+
+def open_frames(source):
+    """Return (iterator over the frames of source, frames per second or None).
+
+    Each frame is the bytes of a JPEG or a PIL image.
+    """
+    if os.path.isdir(source):
+        return (_read_file(path) for path in find_images(source, FRAME_PATTERNS)), None
+    if source.lower().endswith(MJPEG_EXTENSIONS):
+        return read_mjpeg(source), None
+    return read_video(source)
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def read_mjpeg(path):
+    """Yield the JPEGs of a Motion JPEG stream, the JPEGs one after another."""
+    with open(path, 'rb') as f:
+        buffer = b''
+        while True:
+            chunk = f.read(_READ_SIZE)
+            buffer += chunk
+            while True:
+                start = buffer.find(b'\xFF\xD8')
+                if start < 0:
+                    # Nothing but padding, keep a last 0xFF in case it starts a JPEG
+                    buffer = buffer[-1:]
+                    break
+                end = jpeg_end(buffer, start)
+                if end is None:
+                    if not chunk:
+                        # The stream ends inside a JPEG
+                        return
+                    buffer = buffer[start:]
+                    break
+                if end < 0:
+                    # Not a JPEG after all, look for the next SOI
+                    buffer = buffer[start + 2:]
+                    continue
+                yield buffer[start:end]
+                buffer = buffer[end:]
+            if not chunk:
+                return
+
+
+def read_video(path):
+    """Return (iterator over the frames of a video file, frames per second)."""
+    # OpenCV is slow to import and only needed for video files
+    try:
+        import cv2
+    except ImportError:
+        raise RuntimeError('Reading video files needs opencv-python (pip install opencv-python)')
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f'Unable to open the video {path}')
+    fps = capture.get(cv2.CAP_PROP_FPS) or None
+
+    def frames():
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        finally:
+            capture.release()
+    return frames(), fps
+
+
+def encode_frames(frames, mode='RGB', quality=90):
+    """Yield a BaselineJpeg for every frame, all like the first one.
+
+    mode is 'RGB' or 'L'. A JPEG frame matching the first frame's size and
+    colour space is passed through, anything else is encoded with quality.
+    """
+    target = None
+    for number, frame in enumerate(frames, 1):
+        jpeg = None
+        if isinstance(frame, bytes):
+            jpeg = parse_baseline_jpeg(frame)
+            if jpeg and target is None and (jpeg.samples == 1) != (mode == 'L'):
+                jpeg = None
+            if jpeg and target is not None and jpeg[1:] != target[1:]:
+                jpeg = None
+
+        if jpeg is None:
+            image = Image.open(io.BytesIO(frame)) if isinstance(frame, bytes) else frame
+            jpeg = _encode(image, mode, quality, target)
+            image.close()
+
+        if target is None:
+            target = jpeg
+        elif (jpeg.rows, jpeg.columns) != (target.rows, target.columns):
+            raise ValueError(f'Frame {number} is {jpeg.columns}x{jpeg.rows}, '
+                             f'the first frame is {target.columns}x{target.rows}')
+        yield jpeg
+
+
+def _encode(image, mode, quality, target):
+    """Return image as a BaselineJpeg in mode, with target's colour space if given."""
+    if image.mode != mode:
+        image = image.convert(mode)
+    options = {'quality': quality}
+    if mode == 'RGB':
+        # 4:4:4 for YBR_FULL, 4:2:0 otherwise
+        options['subsampling'] = 0 if target is not None and target.photometric == 'YBR_FULL' else 2
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', **options)
+    return parse_baseline_jpeg(buffer.getvalue())
+
+
+def write_multiframe(ds, jpegs, dicom_path):
+    """Write ds with jpegs as its frames to dicom_path and return the frame count.
+
+    ds is a FileDataset with the JPEG Baseline transfer syntax and no pixel
+    data. Its image pixel attributes and Number of Frames are set from the
+    frames.
+    """
+    folder = os.path.dirname(dicom_path) or '.'
+    offsets = []
+    position = 0
+    first = None
+    with tempfile.TemporaryFile(dir=folder) as spool:
+        for jpeg in jpegs:
+            first = first or jpeg
+            data = jpeg.data + b'\x00' * (len(jpeg.data) % 2)
+            spool.write(_ITEM + struct.pack('<I', len(data)))
+            spool.write(data)
+            offsets.append(position)
+            position += 8 + len(data)
+        if first is None:
+            raise ValueError('No frames to convert')
+
+        ds.NumberOfFrames = len(offsets)
+        ds.Rows, ds.Columns = first.rows, first.columns
+        ds.SamplesPerPixel = first.samples
+        ds.PhotometricInterpretation = first.photometric
+        ds.BitsAllocated = 8
+        ds.BitsStored = 8
+        ds.HighBit = 7
+        ds.PixelRepresentation = 0
+        if first.samples > 1:
+            ds.PlanarConfiguration = 0
+        ds.LossyImageCompression = '01'
+        ds.LossyImageCompressionMethod = 'ISO_10918_1'
+
+        # Offsets are 32 bit, past 4 GB the table has to be left empty
+        if offsets[-1] > 0xFFFFFFFF:
+            offsets = []
+
+        partial = f'{dicom_path}.{os.getpid()}.part'
+        try:
+            with open(partial, 'wb') as f:
+                ds.save_as(f)
+                f.write(_PIXEL_DATA)
+                f.write(_ITEM + struct.pack('<I', 4 * len(offsets)))
+                f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+                spool.seek(0)
+                shutil.copyfileobj(spool, f, _READ_SIZE)
+                f.write(_SEQUENCE_DELIMITER)
+            os.replace(partial, dicom_path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+    return ds.NumberOfFrames
@@ -0,0 +1,137 @@
+################################################################################
+# JPEG pass-through for the JPG2DICOM converters
+#
+# A baseline JPEG can be stored in a DICOM file as it is, encapsulated with
+# the JPEG Baseline transfer syntax, instead of being decoded and stored as
+# uncompressed pixels. Nothing is decoded and the DICOM file is about the
+# size of the JPEG rather than rows x columns x 3 bytes. read_baseline_jpeg()
+# reads the frame header to find the image size and colour space and
+# returns None for JPEGs that can't be stored this way (progressive,
+# extended, lossless or arithmetic coded), which have to be decoded.
+# parse_baseline_jpeg() does the same for a JPEG already in memory, such as
+# a frame of a Motion JPEG stream, and jpeg_end() finds where a JPEG in a
+# stream ends.
+################################################################################
+
+import collections
+
+# Start Of Frame markers, every SOFn except DHT (C4), JPG (C8) and DAC (CC)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Markers without a length
+_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+
+BaselineJpeg = collections.namedtuple(
+    'BaselineJpeg', ['data', 'rows', 'columns', 'samples', 'photometric']
+)
+
+
+def read_baseline_jpeg(path):
+    """Return a BaselineJpeg for the file at path or None if it isn't one."""
+    with open(path, 'rb') as f:
+        return parse_baseline_jpeg(f.read())
+
+
+def parse_baseline_jpeg(data):
+    """Return a BaselineJpeg for the JPEG in data or None if it isn't one."""
+    if data[:2] != b'\xFF\xD8':
+        return None
+
+    adobe_transform = None
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in _STANDALONE_MARKERS:
+            pos += 2
+            continue
+
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == 0xEE and segment[:5] == b'Adobe' and len(segment) >= 12:
+            adobe_transform = segment[11]
+        elif marker in _SOF_MARKERS:
+            # Only SOF0 is the baseline process, which is always 8 bit
+            if marker != 0xC0 or len(segment) < 6:
+                return None
+            rows = int.from_bytes(segment[1:3], 'big')
+            columns = int.from_bytes(segment[3:5], 'big')
+            components = segment[5]
+            if rows == 0 or components not in (1, 3) or len(segment) < 6 + 3 * components:
+                return None
+            return BaselineJpeg(data, rows, columns, components,
+                                _photometric(segment, components, adobe_transform))
+        elif marker == 0xDA:
+            # Start Of Scan before a frame header
+            return None
+        pos += 2 + length
+    return None
+
+
+def jpeg_end(data, start=0):
+    """Return the offset just past the EOI of the JPEG starting at start.
+
+    The marker segments are walked by their lengths, so an EXIF thumbnail
+    with its own SOI and EOI inside APP1 isn't mistaken for the end, and
+    the entropy coded data of each scan is searched for the next marker,
+    skipping stuffed FF 00 bytes and RSTn markers. Returns None if data ends
+    before the EOI and -1 if the JPEG is malformed.
+    """
+    pos = start + 2
+    in_scan = False
+    while True:
+        if in_scan:
+            pos = data.find(b'\xFF', pos)
+            if pos < 0 or pos + 2 > len(data):
+                return None
+            marker = data[pos + 1]
+            if marker == 0x00 or 0xD0 <= marker <= 0xD7:
+                pos += 2
+                continue
+            if marker == 0xFF:
+                # Fill byte
+                pos += 1
+                continue
+            in_scan = False
+
+        if pos + 2 > len(data):
+            return None
+        if data[pos] != 0xFF:
+            return -1
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xD9:
+            return pos + 2
+        if marker == 0xD8:
+            return -1
+        if marker in _STANDALONE_MARKERS:
+            pos += 2
+            continue
+
+        if pos + 4 > len(data):
+            return None
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if length < 2:
+            return -1
+        pos += 2 + length
+        # Start Of Scan, the entropy coded data follows its header
+        in_scan = marker == 0xDA
+
+
+def _photometric(sof, components, adobe_transform):
+    """Return the Photometric Interpretation of a baseline JPEG's pixels."""
+    if components == 1:
+        return 'MONOCHROME2'
+    if adobe_transform == 0:
+        # Adobe JPEGs can hold RGB without a colour transform
+        return 'RGB'
+    # Horizontal and vertical sampling factors of each component
+    sampling = [sof[7 + 3 * ii] for ii in range(components)]
+    return 'YBR_FULL' if len(set(sampling)) == 1 else 'YBR_FULL_422'